@@ -0,0 +1,241 @@
+import argparse
+import time
+from functools import lru_cache
+import numpy as np
+
+from config import DEFAULT_FONT_PATH, DEFAULT_DISTANCE_TILE_BYTES, DEFAULT_NEIGHBOURS, DEFAULT_IVF_PROBES, \
+    DEFAULT_IVF_ITERATIONS, DEFAULT_IVF_TRAINING_SAMPLE
+from feature_store import FeatureStore
+from font_distance import DISTANCE_METRICS, DISTANCE_DTYPES, distance_block, cross_distances, gram_matrix, \
+    pairwise_distances
+from path_search import nearest_neighbours
+
+
+def row_blocks(features, rows, dtype='float64'):
+    """Yield (start, vectors) blocks of feature rows of about DEFAULT_DISTANCE_TILE_BYTES each."""
+    block_size = max(1, DEFAULT_DISTANCE_TILE_BYTES // (max(features.shape[1], 1) * np.dtype(dtype).itemsize))
+    for start in range(0, len(rows), block_size):
+        yield start, np.asarray(features[rows[start:start + block_size]], dtype=dtype)
+
+
+class IVFIndex:
+    """Inverted file index over font features: k-means centroids partition the fonts into lists, and a search computes
+    exact distances to the fonts of the lists with the closest centroids only.
+
+    Memory holds the centroids, the list of every font and the lists probed for its neighbours; the features stay
+    memory mapped and are read in row blocks or column tiles.
+    """
+
+    def __init__(self, features, rows, num_lists=None, num_probes=DEFAULT_IVF_PROBES, metric='euclidean',
+                 dtype='float64', tile_size=None, iterations=DEFAULT_IVF_ITERATIONS, seed=0):
+        self.features = features
+        self.rows = np.asarray(rows)
+        self.metric = metric
+        self.dtype = dtype
+        self.tile_size = tile_size
+
+        num_fonts = len(self.rows)
+        num_lists = min(num_lists or max(int(round(np.sqrt(num_fonts))), 1), max(num_fonts, 1))
+        self.num_probes = min(num_probes, num_lists)
+        self.centroids = self.train(num_lists, iterations, seed)
+        self.probes = self.assign()
+        self.assignment = self.probes[:, 0]
+        self.lists = [np.flatnonzero(self.assignment == i) for i in range(num_lists)]
+
+    def train(self, num_lists, iterations, seed):
+        """Fit k-means centroids on a sample of the fonts, streaming the sample in row blocks."""
+        rng = np.random.default_rng(seed)
+        num_fonts = len(self.rows)
+        sample = np.sort(rng.choice(num_fonts, min(num_fonts, DEFAULT_IVF_TRAINING_SAMPLE * num_lists), replace=False))
+        sample_rows = self.rows[sample]
+        centroids = np.asarray(self.features[np.sort(rng.choice(sample_rows, num_lists, replace=False))],
+                               dtype=self.dtype)
+
+        for iteration in range(iterations):
+            print(f'Training nearest-neighbour index {100 * iteration // iterations} %', end='\r', flush=True)
+            sums = np.zeros_like(centroids)
+            counts = np.zeros(num_lists)
+            for _, vectors in row_blocks(self.features, sample_rows, self.dtype):
+                nearest = np.argmin(distance_block(vectors, centroids, self.metric, self.dtype), axis=1)
+                np.add.at(sums, nearest, vectors)
+                counts += np.bincount(nearest, minlength=num_lists)
+
+            # Centroids of empty lists stay where they are
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+
+        print('Training nearest-neighbour index completed')
+        return centroids
+
+    def assign(self):
+        """Lists probed for the neighbours of every font, closest centroid first."""
+        probes = np.empty((len(self.rows), self.num_probes), dtype=np.int64)
+        for start, vectors in row_blocks(self.features, self.rows, self.dtype):
+            distances = distance_block(vectors, self.centroids, self.metric, self.dtype)
+            closest = np.argpartition(distances, self.num_probes - 1, axis=1)[:, :self.num_probes]
+            order = np.argsort(np.take_along_axis(distances, closest, axis=1), axis=1)
+            probes[start:start + len(vectors)] = np.take_along_axis(closest, order, axis=1)
+        return probes
+
+    def closest_lists(self, vector):
+        """Lists ordered by the distance of their centroid to a feature vector."""
+        return np.argsort(distance_block(vector[None, :], self.centroids, self.metric, self.dtype)[0])
+
+    def knn_graph(self, k, num_probes=None):
+        """Approximate k nearest neighbours of every font (closest first) and their distances.
+
+        The fonts of a list are searched together, among the fonts of all lists probed by any of them.
+        """
+        num_probes = min(num_probes or self.num_probes, self.num_probes)
+        num_fonts = len(self.rows)
+        k = min(k, num_fonts - 1)
+        neighbours = np.empty((num_fonts, max(k, 0)), dtype=np.int64)
+        distances = np.empty((num_fonts, max(k, 0)), dtype=self.dtype)
+        if k <= 0:
+            return neighbours, distances
+
+        evaluated = 0
+        for i, queries in enumerate(self.lists):
+            print(f'Computing nearest-neighbour graph {100 * i // len(self.lists)} %', end='\r', flush=True)
+            if not len(queries):
+                continue
+
+            probed = list(np.unique(self.probes[queries, :num_probes]))
+            if sum(len(self.lists[p]) for p in probed) <= k:
+                # Too few fonts in the probed lists: add the lists closest to this list's centroid
+                for p in self.closest_lists(self.centroids[i]):
+                    if sum(len(self.lists[q]) for q in probed) > k:
+                        break
+                    if p not in probed:
+                        probed.append(p)
+            candidates = np.concatenate([self.lists[p] for p in probed])
+
+            block = cross_distances(self.features, self.rows[queries], self.rows[candidates], self.metric,
+                                    self.dtype, self.tile_size)
+            block[queries[:, None] == candidates[None, :]] = np.inf
+            nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+            nearest_distances = np.take_along_axis(block, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1)
+            neighbours[queries] = candidates[np.take_along_axis(nearest, order, axis=1)]
+            distances[queries] = np.take_along_axis(nearest_distances, order, axis=1)
+            evaluated += block.size
+
+        print(f'Computing nearest-neighbour graph completed: {evaluated} distances, '
+              f'{100 * evaluated / max(num_fonts * num_fonts, 1):.1f} % of the distance matrix')
+        return neighbours, distances
+
+    def farthest(self, font):
+        """Font farthest from the given font, computed from one row of distances."""
+        return int(np.argmax(cross_distances(self.features, self.rows[[font]], self.rows, self.metric, self.dtype,
+                                             self.tile_size)[0]))
+
+    def nearest_unvisited(self, font, visited, unvisited_per_list):
+        """Closest font that is not visited, searched in the closest lists that still hold unvisited fonts."""
+        vector = np.asarray(self.features[self.rows[font]], dtype=self.dtype)
+        probed = [p for p in self.closest_lists(vector) if unvisited_per_list[p]][:self.num_probes]
+        candidates = np.concatenate([self.lists[p] for p in probed])
+        candidates = candidates[~visited[candidates]]
+        distances = cross_distances(self.features, self.rows[[font]], self.rows[candidates], self.metric, self.dtype,
+                                    self.tile_size)[0]
+        return int(candidates[np.argmin(distances)])
+
+
+class FeatureDistances:
+    """Distances between fonts for sorting without a distance matrix.
+
+    Distances of the k-NN graph are kept; any other distance is computed from the two feature rows and the most
+    recent ones are cached, so memory stays O(n * k). Neighbours and distances are (n, k) arrays or lists of lists of
+    any length. Call it as distance(a, b) or index it as distance[a, b].
+    """
+
+    def __init__(self, features, rows, neighbours, distances, metric='euclidean', dtype='float64'):
+        self.features = features
+        self.rows = np.asarray(rows)
+        self.metric = metric
+        self.dtype = dtype
+        self.known = {}
+        if isinstance(neighbours, np.ndarray):
+            neighbours, distances = neighbours.tolist(), distances.tolist()
+        for a, (font_neighbours, font_distances) in enumerate(zip(neighbours, distances)):
+            self.add(a, font_neighbours, font_distances)
+        self.computed = lru_cache(maxsize=max(len(self.known), 1024))(self.feature_distance)
+
+    def add(self, a, fonts, distances):
+        """Keep the distances between a font and other fonts."""
+        for b, distance in zip(fonts, distances):
+            self.known[(a, b) if a < b else (b, a)] = distance
+
+    def feature_distance(self, a, b):
+        vectors = np.asarray(self.features[self.rows[[a, b]]], dtype=self.dtype)
+        return float(distance_block(vectors[:1], vectors[1:], self.metric, self.dtype)[0, 0])
+
+    def __call__(self, a, b):
+        if a == b:
+            return 0.0
+        pair = (a, b) if a < b else (b, a)
+        distance = self.known.get(pair)
+        return distance if distance is not None else self.computed(*pair)
+
+    def __getitem__(self, pair):
+        return self(*pair)
+
+
+#
+# recall benchmark against the exact distance matrix
+#
+def recall_at_k(exact_neighbours, neighbours):
+    """Mean fraction of the exact k nearest neighbours of each font found by the approximate search."""
+    k = exact_neighbours.shape[1]
+    return np.mean([len(np.intersect1d(e, a)) / k for e, a in zip(exact_neighbours, neighbours)])
+
+
+def recall_benchmark(font_directory, k, num_lists, probes, metric, dtype, tile_size):
+    store = FeatureStore(font_directory)
+    features = store.matrix()
+    rows = np.array(store.rows(store.font_names()))
+    print(f'{len(rows)} fonts with {features.shape[1]} feature values')
+
+    start = time.perf_counter()
+    exact = nearest_neighbours(pairwise_distances(gram_matrix(features, rows, dtype, tile_size), metric), k)
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = IVFIndex(features, rows, num_lists, max(probes), metric, dtype, tile_size)
+    index_seconds = time.perf_counter() - start
+
+    results = []
+    for num_probes in sorted(probes):
+        start = time.perf_counter()
+        neighbours, _ = index.knn_graph(k, num_probes)
+        results.append((num_probes, recall_at_k(exact, neighbours), time.perf_counter() - start))
+
+    print(f'\nExact {k}-NN from the distance matrix: {exact_seconds:.2f} s')
+    print(f'Index with {len(index.lists)} lists built in {index_seconds:.2f} s')
+    print(f"{'probes':>8}{f'recall@{k}':>12}{'graph (s)':>12}")
+    for num_probes, recall, seconds in results:
+        print(f'{num_probes:>8}{recall:>12.3f}{seconds:>12.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the recall of the approximate nearest-neighbour graph of '
+                                                 'the sparse sorting mode against the exact distance matrix')
+    parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    parser.add_argument('--neighbours', type=int, default=DEFAULT_NEIGHBOURS, help='Number of nearest neighbours k.')
+    parser.add_argument('--ivf_lists', type=int, default=None,
+                        help='Number of index lists. Default is the square root of the number of fonts.')
+    parser.add_argument('--ivf_probes', type=int, nargs='+', default=[1, 2, 4, DEFAULT_IVF_PROBES, 16],
+                        help='Numbers of probed lists to measure.')
+    parser.add_argument('--metric', type=str, choices=DISTANCE_METRICS, default='euclidean',
+                        help='Distance between font features.')
+    parser.add_argument('--distance_dtype', type=str, choices=DISTANCE_DTYPES, default='float64',
+                        help='Precision of distance computation.')
+    parser.add_argument('--tile_size', type=int, default=None,
+                        help='Number of feature columns read at once.')
+    args = parser.parse_args()
+
+    recall_benchmark(args.font_path, args.neighbours, args.ivf_lists, args.ivf_probes, args.metric,
+                     args.distance_dtype, args.tile_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+"""Benchmarks of the font sorting stages on synthetic feature matrices and bundled fonts.
+
+Run from the repository root:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.compare baseline.json results.json
+"""
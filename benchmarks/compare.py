@@ -0,0 +1,71 @@
+import argparse
+import json
+import sys
+
+
+DEFAULT_TIME_THRESHOLD = 0.1
+DEFAULT_LENGTH_THRESHOLD = 1e-6
+DEFAULT_MIN_SECONDS = 0.005
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return {(result['stage'], result['n']): result for result in json.load(f)['results']}
+
+
+def compare_results(baseline, current, time_threshold=DEFAULT_TIME_THRESHOLD,
+                    length_threshold=DEFAULT_LENGTH_THRESHOLD, min_seconds=DEFAULT_MIN_SECONDS):
+    """Print the stages of two benchmark runs side by side. Returns the regressions: stages that got slower by more
+    than time_threshold (and min_seconds), font paths longer by more than length_threshold and changed images."""
+    regressions = []
+    print(f"{'stage':<16}{'n':>8}{'baseline (s)':>14}{'current (s)':>13}{'change':>9}  notes")
+    for key, result in current.items():
+        base = baseline.get(key)
+        if base is None:
+            print(f'{key[0]:<16}{key[1]:>8}{"":>14}{result["seconds"]:>13.4f}{"":>9}  new')
+            continue
+
+        notes = []
+        change = result['seconds'] / base['seconds'] - 1 if base['seconds'] > 0 else 0.0
+        if change > time_threshold and result['seconds'] - base['seconds'] > min_seconds:
+            notes.append('slower')
+        if 'path_length' in result and 'path_length' in base:
+            length_change = result['path_length'] / base['path_length'] - 1 if base['path_length'] > 0 else 0.0
+            if length_change > length_threshold:
+                notes.append(f'path {100 * length_change:+.3f} % longer')
+            elif length_change < -length_threshold:
+                notes.append(f'path {100 * length_change:+.3f} % shorter')
+        if result.get('checksum') != base.get('checksum'):
+            notes.append('images changed')
+
+        print(f'{key[0]:<16}{key[1]:>8}{base["seconds"]:>14.4f}{result["seconds"]:>13.4f}{100 * change:>+8.1f}%  '
+              + ', '.join(notes))
+        regressions.extend((key, note) for note in notes if 'shorter' not in note)
+
+    for key in baseline.keys() - current.keys():
+        print(f'{key[0]:<16}{key[1]:>8}{baseline[key]["seconds"]:>14.4f}{"":>13}{"":>9}  missing')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark runs and flag regressions')
+    parser.add_argument('baseline', type=str, help='JSON results of the baseline run.')
+    parser.add_argument('current', type=str, help='JSON results of the run to check.')
+    parser.add_argument('--time_threshold', type=float, default=DEFAULT_TIME_THRESHOLD,
+                        help='Fraction by which a stage may get slower, e.g. 0.1 for 10 %%.')
+    parser.add_argument('--length_threshold', type=float, default=DEFAULT_LENGTH_THRESHOLD,
+                        help='Fraction by which a font path may get longer.')
+    parser.add_argument('--min_seconds', type=float, default=DEFAULT_MIN_SECONDS,
+                        help='Slowdowns of fewer seconds are timing noise.')
+    args = parser.parse_args()
+
+    regressions = compare_results(load_results(args.baseline), load_results(args.current), args.time_threshold,
+                                  args.length_threshold, args.min_seconds)
+    if regressions:
+        print(f'\n{len(regressions)} regressions')
+        sys.exit(1)
+    print('\nNo regressions')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+import model_provider
+from config import DEFAULT_FEATURES_CHARACTERS, DEFAULT_FEATURES_TEXTS, DEFAULT_BATCH_SIZE, DEFAULT_NEIGHBOURS, \
+    DEFAULT_MODEL_BACKEND, DEFAULT_MODEL_DIR
+from font_distance import DISTANCE_METRICS, gram_matrix, pairwise_distances
+from font_features import enumerate_font_files, extract_features_batch
+from font_render import render_font_images
+from path_search import nearest_neighbours
+from benchmarks.synthetic import bundled_fonts
+from benchmarks.timing import DEFAULT_BENCHMARK_REPEAT, timed
+
+
+# A mode is a precision, optionally with +compile and +channels_last
+DEFAULT_PRECISION_MODES = ['fp32', 'bf16', 'int8', 'fp32+channels_last', 'fp32+compile']
+DEFAULT_PRECISION_SAMPLE = 100
+
+
+def parse_mode(mode):
+    precision, *options = mode.split('+')
+    return {'precision': precision, 'compiled': 'compile' in options, 'channels_last': 'channels_last' in options}
+
+
+def sample_fonts(font_path, sample_size, seed=0):
+    """Fixed sample of the fonts of a font directory, or the bundled fonts without one."""
+    if font_path is None:
+        return bundled_fonts()
+    fonts = sorted(os.path.join(*font_file) for font_file in enumerate_font_files(font_path))
+    if len(fonts) > sample_size:
+        rng = np.random.default_rng(seed)
+        fonts = [fonts[i] for i in sorted(rng.choice(len(fonts), sample_size, replace=False))]
+    return fonts
+
+
+def embed(font_images, batch_size, feature_mode):
+    """Feature vectors of rendered fonts, one row per font."""
+    return np.stack([np.concatenate(extract_features_batch(images, batch_size, feature_mode))
+                     for images in font_images])
+
+
+def neighbour_agreement(features, reference, k, metric='euclidean'):
+    """Mean fraction of the k nearest neighbours of each font found with the reference features too, and the
+    fraction of fonts with the same nearest neighbour."""
+    rows = np.arange(len(features))
+    nearest = nearest_neighbours(pairwise_distances(gram_matrix(features, rows), metric), k)
+    reference_nearest = nearest_neighbours(pairwise_distances(gram_matrix(reference, rows), metric), k)
+    if nearest.shape[1] == 0:
+        return 1.0, 1.0
+    shared = [len(set(a) & set(b)) for a, b in zip(nearest.tolist(), reference_nearest.tolist())]
+    return float(np.mean(shared)) / nearest.shape[1], float(np.mean(nearest[:, 0] == reference_nearest[:, 0]))
+
+
+def validate_precisions(font_paths, modes, backend, weights_path=None, model_dir=DEFAULT_MODEL_DIR, threads=0,
+                        batch_size=DEFAULT_BATCH_SIZE, feature_mode='meanpool', metric='euclidean',
+                        neighbours=DEFAULT_NEIGHBOURS, repeat=DEFAULT_BENCHMARK_REPEAT,
+                        alphabet=DEFAULT_FEATURES_CHARACTERS, texts=DEFAULT_FEATURES_TEXTS):
+    """Embed the fonts in every mode and compare the features and their nearest neighbours with fp32."""
+    font_images = [render_font_images(font_path, alphabet, texts)[0] for font_path in font_paths]
+    print(f'Rendered {len(font_paths)} fonts')
+    neighbours = max(min(neighbours, len(font_paths) - 1), 0)
+    print(f"{'mode':<22}{'load (s)':>10}{'seconds':>10}{'speedup':>9}{'max dev':>10}{'mean dev':>10}"
+          f"{f'nn@{neighbours}':>8}{'nn@1':>7}")
+
+    results = []
+    reference = reference_seconds = None
+    for mode in ['fp32'] + [mode for mode in modes if mode != 'fp32']:
+        try:
+            model_provider.configure(weights_path=weights_path, backend=backend, model_dir=model_dir, threads=threads,
+                                     **parse_mode(mode))
+        except ValueError as e:
+            print(f'{mode:<22}skipped: {e}')
+            continue
+
+        # Loading, converting and compiling the model, and the first batch, are not part of the inference time
+        start = time.perf_counter()
+        embed(font_images[:1], batch_size, feature_mode)
+        load_seconds = time.perf_counter() - start
+        features, seconds = timed(lambda: embed(font_images, batch_size, feature_mode), repeat)
+
+        if reference is None:
+            reference, reference_seconds = features, min(seconds)
+        deviation = np.abs(features.astype(np.float64) - reference)
+        agreement, top_agreement = neighbour_agreement(features, reference, neighbours, metric)
+        result = {'mode': mode, 'load_seconds': load_seconds, 'seconds': min(seconds), 'runs': seconds,
+                  'speedup': reference_seconds / min(seconds), 'max_deviation': float(deviation.max()),
+                  'mean_deviation': float(deviation.mean()), 'neighbour_agreement': agreement,
+                  'nearest_agreement': top_agreement}
+        results.append(result)
+        print(f"{mode:<22}{load_seconds:>10.2f}{result['seconds']:>10.2f}{result['speedup']:>9.2f}"
+              f"{result['max_deviation']:>10.4f}{result['mean_deviation']:>10.5f}{agreement:>8.3f}"
+              f"{top_agreement:>7.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embed a fixed sample of fonts with every inference precision and '
+                                                 'compare speed, features and nearest neighbours with fp32')
+    parser.add_argument('--font_path', type=str, default=None,
+                        help='Directory with fonts to sample. By default the bundled fonts are embedded.')
+    parser.add_argument('--sample', type=int, default=DEFAULT_PRECISION_SAMPLE,
+                        help='Number of fonts of the sample, the same ones in every run.')
+    parser.add_argument('--modes', type=str, nargs='+', default=DEFAULT_PRECISION_MODES,
+                        help='Modes to compare with fp32: a precision (fp32, bf16, int8), optionally followed by '
+                             '+compile and +channels_last.')
+    parser.add_argument('--feature_mode', type=str, choices=['full', 'cls', 'meanpool'], default='meanpool',
+                        help='Features compared. Full features take about 18 MB per font and mode.')
+    parser.add_argument('--metric', type=str, choices=DISTANCE_METRICS, default='euclidean',
+                        help='Distance between font features.')
+    parser.add_argument('--neighbours', type=int, default=DEFAULT_NEIGHBOURS,
+                        help='Number of nearest neighbours compared.')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of images in one model forward pass.')
+    parser.add_argument('--torch_threads', type=int, default=0,
+                        help='Number of threads used by the model. 0 keeps the backend default.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_BENCHMARK_REPEAT,
+                        help='Number of runs of each mode, the fastest one is reported.')
+    parser.add_argument('--output', type=str, default=None, help='JSON file of the results.')
+    parser.add_argument('--model_weights', type=str, default=None, help='Local file of the model weights.')
+    parser.add_argument('--model_backend', type=str, choices=model_provider.MODEL_BACKENDS,
+                        default=DEFAULT_MODEL_BACKEND, help='Inference backend.')
+    parser.add_argument('--model_dir', type=str, default=DEFAULT_MODEL_DIR, help='Directory of converted models.')
+    args = parser.parse_args()
+
+    results = validate_precisions(sample_fonts(args.font_path, args.sample), args.modes, args.model_backend,
+                                  args.model_weights, args.model_dir, args.torch_threads, args.batch_size,
+                                  args.feature_mode, args.metric, args.neighbours, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model_backend': args.model_backend, 'feature_mode': args.feature_mode, 'results': results},
+                      f, indent=1)
+        print(f'Validation results saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
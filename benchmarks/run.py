@@ -0,0 +1,106 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import numpy as np
+import PIL
+
+from config import DEFAULT_FEATURES_CHARACTERS, DEFAULT_FEATURES_TEXTS
+from font_distance import DISTANCE_METRICS, DISTANCE_DTYPES
+from font_render import render_font_images
+from font_sort import calculate_distance_matrix, optimized_font_path, improve_font_path, path_length
+from benchmarks.synthetic import synthetic_features, bundled_fonts
+from benchmarks.startup import startup_benchmarks
+from benchmarks.timing import DEFAULT_BENCHMARK_REPEAT, REPEAT_SECONDS, timed, stage_result
+
+
+BENCHMARK_STAGES = ['sort', 'render', 'startup']
+DEFAULT_BENCHMARK_SIZES = [100, 1000, 10000]
+
+
+def sort_benchmarks(size, metric='euclidean', dtype='float64', repeat=DEFAULT_BENCHMARK_REPEAT):
+    """Time the distance matrix, the initial font path and its improvement on synthetic features of size fonts, with
+    path lengths as the quality of the font paths."""
+    features = synthetic_features(size)
+    rows = np.arange(size)
+
+    distance_matrix, seconds = timed(lambda: calculate_distance_matrix(features, rows, metric, dtype=dtype), repeat)
+    results = [stage_result('distance_matrix', size, seconds)]
+
+    path, seconds = timed(lambda: optimized_font_path(distance_matrix), repeat)
+    results.append(stage_result('construct', size, seconds, path_length=float(path_length(path, distance_matrix))))
+
+    improved, seconds = timed(lambda: improve_font_path(path, distance_matrix), repeat)
+    results.append(stage_result('improve', size, seconds,
+                                path_length=float(path_length(improved, distance_matrix))))
+    return results
+
+
+def render_benchmark(alphabet=DEFAULT_FEATURES_CHARACTERS, texts=DEFAULT_FEATURES_TEXTS,
+                     repeat=DEFAULT_BENCHMARK_REPEAT):
+    """Time rendering the glyph and text images of the bundled fonts, with a checksum of the images to detect changes
+    of the rendering."""
+    fonts = bundled_fonts()
+    images, seconds = timed(lambda: [render_font_images(font, alphabet, texts)[0] for font in fonts], repeat)
+
+    checksum = hashlib.sha256()
+    for font_images in images:
+        for image in font_images:
+            checksum.update(np.asarray(image.convert('L')).tobytes())
+    return stage_result('render', len(fonts), seconds, images=sum(len(font_images) for font_images in images),
+                        checksum=checksum.hexdigest())
+
+
+def environment():
+    """Machine, library versions and commit of a benchmark run."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pillow': PIL.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'commit': commit}
+
+
+def run_benchmarks(sizes, stages, metric, dtype, repeat):
+    print(f"{'stage':<16}{'n':>8}{'seconds':>12}{'runs':>6}")
+    results = []
+    if 'startup' in stages:
+        results.extend(startup_benchmarks(repeat))
+    if 'render' in stages:
+        results.append(render_benchmark(repeat=repeat))
+    if 'sort' in stages:
+        for size in sizes:
+            results.extend(sort_benchmarks(size, metric, dtype, repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the font sorting stages on synthetic feature matrices and the '
+                                                 'bundled fonts, offline and on the CPU')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_BENCHMARK_SIZES,
+                        help='Numbers of synthetic fonts to sort.')
+    parser.add_argument('--stages', type=str, nargs='+', choices=BENCHMARK_STAGES, default=BENCHMARK_STAGES,
+                        help='Stages to benchmark.')
+    parser.add_argument('--metric', type=str, choices=DISTANCE_METRICS, default='euclidean',
+                        help='Distance between font features.')
+    parser.add_argument('--distance_dtype', type=str, choices=DISTANCE_DTYPES, default='float64',
+                        help='Precision of distance computation.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_BENCHMARK_REPEAT,
+                        help=f'Number of runs of each stage, the fastest one is reported. Stages are not run again '
+                             f'once they took {REPEAT_SECONDS} s.')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='JSON file of the results.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.stages, args.metric, args.distance_dtype, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'metric': args.metric, 'distance_dtype': args.distance_dtype,
+                   'results': results}, f, indent=1)
+    print(f'Benchmark results saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
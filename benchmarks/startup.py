@@ -0,0 +1,65 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+from config import DEFAULT_FEATURES_CHARACTERS, DEFAULT_FEATURES_TEXTS, DEFAULT_FEATURE_MODE, DEFAULT_FEATURE_DTYPE
+from feature_modes import features_info
+from font_features import open_feature_store, font_cache_entry, store_font_features
+from benchmarks.synthetic import bundled_fonts
+from benchmarks.timing import DEFAULT_BENCHMARK_REPEAT, timed, stage_result
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a script as __main__ and reports on stderr whether it imported torch
+STARTUP_SCRIPT = """import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write('torch imported' if 'torch' in sys.modules else 'torch not imported')
+"""
+
+
+def cached_font_directory(directory, alphabet=DEFAULT_FEATURES_CHARACTERS, texts=DEFAULT_FEATURES_TEXTS):
+    """Font directory of the bundled fonts whose features are all in the feature store, so that font_features.py
+    has nothing to compute."""
+    store = open_feature_store(directory, features_info(DEFAULT_FEATURE_MODE, DEFAULT_FEATURE_DTYPE, alphabet, texts))
+    for font_path in bundled_fonts():
+        font_dir = os.path.join(directory, os.path.splitext(os.path.basename(font_path))[0])
+        os.makedirs(font_dir, exist_ok=True)
+        font_file_path = shutil.copy(font_path, font_dir)
+        _, ttf_sha256, key = font_cache_entry(store, font_file_path, alphabet, texts, DEFAULT_FEATURE_MODE)
+        store_font_features(store, font_file_path, np.zeros(16, dtype=np.float32), 0.0, ttf_sha256, key)
+    store.save()
+    return len(bundled_fonts())
+
+
+def run_script(args):
+    """Run a script of the repository in a new interpreter. Returns whether it imported torch."""
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, *args], cwd=REPO_DIR, capture_output=True,
+                            text=True)
+    return result.stderr.endswith('torch imported')
+
+
+def startup_commands(font_directory):
+    """Commands that should start fast: the help of font_features.py and a run in which all features are cached."""
+    return {'startup_help': [os.path.join(REPO_DIR, 'font_features.py'), '--help'],
+            'startup_cached': [os.path.join(REPO_DIR, 'font_features.py'), '--font_path', font_directory,
+                               '--no_render_cache']}
+
+
+def startup_benchmarks(repeat=DEFAULT_BENCHMARK_REPEAT):
+    """Time the startup commands, recording whether they imported torch."""
+    results = []
+    with tempfile.TemporaryDirectory() as font_directory:
+        num_fonts = cached_font_directory(font_directory)
+        for stage, args in startup_commands(font_directory).items():
+            torch_imported, seconds = timed(lambda: run_script(args), repeat)
+            results.append(stage_result(stage, num_fonts if stage == 'startup_cached' else 0, seconds,
+                                        torch_imported=torch_imported))
+    return results
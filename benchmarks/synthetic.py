@@ -0,0 +1,23 @@
+import os
+import numpy as np
+
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+
+# Feature vectors of synthetic fonts, a mixture of clusters like the styles of real font families
+SYNTHETIC_DIM = 256
+SYNTHETIC_FONTS_PER_CLUSTER = 20
+SYNTHETIC_SPREAD = 0.3
+
+
+def synthetic_features(num_fonts, dim=SYNTHETIC_DIM, seed=0):
+    """Feature matrix of num_fonts synthetic fonts, the same for the same arguments on every machine."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(max(num_fonts // SYNTHETIC_FONTS_PER_CLUSTER, 1), dim))
+    features = centres[rng.integers(0, len(centres), num_fonts)] + SYNTHETIC_SPREAD * rng.normal(size=(num_fonts, dim))
+    return features.astype(np.float32)
+
+
+def bundled_fonts():
+    """Paths of the open-licence fonts bundled with the benchmarks."""
+    return [os.path.join(FONTS_DIR, name) for name in sorted(os.listdir(FONTS_DIR)) if name.endswith('.ttf')]
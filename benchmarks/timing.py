@@ -0,0 +1,28 @@
+import contextlib
+import io
+import time
+
+
+DEFAULT_BENCHMARK_REPEAT = 3
+
+# A stage is not run again once its runs took this many seconds
+REPEAT_SECONDS = 30
+
+
+def timed(function, repeat):
+    """Run a function up to repeat times without its progress output. Returns its result and the seconds of each run."""
+    seconds = []
+    while len(seconds) < repeat and sum(seconds) < REPEAT_SECONDS:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        seconds.append(time.perf_counter() - start)
+    return result, seconds
+
+
+def stage_result(stage, size, seconds, **metrics):
+    """Result of a stage, timed by its fastest run."""
+    result = {'stage': stage, 'n': size, 'seconds': min(seconds), 'runs': seconds, **metrics}
+    print(f"{stage:<16}{size:>8}{result['seconds']:>12.4f}{len(seconds):>6}  "
+          + ' '.join(f'{key}={value}' for key, value in metrics.items()))
+    return result
@@ -7,3 +7,58 @@ DEFAULT_FONT_STYLES = ['regular']
 
 DEFAULT_FEATURES_CHARACTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789@?!'
 DEFAULT_FEATURES_TEXTS = ['The quick brown fox jumps over the lazy dog']
+
+DEFAULT_MODEL_NAME = 'vit_base_patch16_224'
+DEFAULT_MODEL_BACKEND = 'torch'
+DEFAULT_MODEL_DIR = './models'
+DEFAULT_MODEL_PRECISION = 'fp32'
+DEFAULT_IMAGE_SIZE = (224, 224)
+
+# One image per forward pass computes the same features bit for bit as earlier versions, larger batches are faster
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_RENDER_WORKERS = 0
+DEFAULT_RENDER_QUEUE_SIZE = 8
+
+DEFAULT_FEATURE_MODE = 'full'
+DEFAULT_FEATURE_DTYPE = 'float32'
+DEFAULT_PCA_COMPONENTS = 64
+DEFAULT_PCA_SAMPLE = 64
+
+DEFAULT_DISTANCE_TILE_BYTES = 256 << 20
+DEFAULT_LOCAL_IMPROVEMENT_PASSES = 3
+DEFAULT_NEIGHBOURS = 10
+
+DEFAULT_IVF_PROBES = 8
+DEFAULT_IVF_ITERATIONS = 10
+DEFAULT_IVF_TRAINING_SAMPLE = 64
+
+DEFAULT_CLUSTER_FONTS = 500
+DEFAULT_CLUSTER_WORKERS = 4
+DEFAULT_SEAM_WINDOW = 20
+
+DEFAULT_RESTARTS = 1
+DEFAULT_RESTART_WORKERS = 4
+DEFAULT_RESTART_SEED = 0
+
+DEFAULT_DENSITY_WORKERS = 4
+DEFAULT_DENSITY_CALIBRATION_SAMPLE = 200
+
+DEFAULT_FINGERPRINT_GRID = 256
+DEFAULT_FINGERPRINT_WORKERS = 4
+
+DEFAULT_SERVICE_HOST = '127.0.0.1'
+DEFAULT_SERVICE_PORT = 8765
+DEFAULT_SERVICE_MAX_BATCH = 64
+DEFAULT_SERVICE_BATCH_WAIT = 0.002
+DEFAULT_SERVICE_MEMORY_BYTES = 4 << 30
+DEFAULT_SERVICE_MAX_FONT_BYTES = 32 << 20
+DEFAULT_SIMILAR_FONTS = 10
+
+DEFAULT_SPECIMEN_PAGE_ROWS = 200
+DEFAULT_SPECIMEN_WORKERS = 4
+
+DEFAULT_FONTS_API_URL = 'https://www.googleapis.com/webfonts/v1/webfonts'
+DEFAULT_HARVEST_CONCURRENCY = 8
+DEFAULT_HARVEST_RETRIES = 5
+DEFAULT_HARVEST_BACKOFF = 0.5
+DEFAULT_HARVEST_TIMEOUT = 60
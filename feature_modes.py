@@ -0,0 +1,85 @@
+import json
+import os
+import numpy as np
+
+
+FEATURE_MODES = ['full', 'cls', 'meanpool', 'pca']
+FEATURE_DTYPES = ['float16', 'float32']
+
+FEATURES_INFO_FILE_NAME = 'features.json'
+PCA_PROJECTION_FILE_NAME = 'pca_projection.npz'
+
+
+#
+# pooling of model outputs
+#
+def pool_features(tokens, feature_mode, projection=None):
+    """Reduce model outputs of shape (images, tokens, dims) to one feature vector per image.
+
+    full keeps all token features, cls keeps the class token, meanpool averages the patch tokens (the class token is
+    excluded, as in timm's average pooling) and pca projects the meanpool vector on the fitted PCA projection.
+    """
+    if feature_mode == 'full':
+        return tokens.reshape(len(tokens), -1)
+    if feature_mode == 'cls':
+        return tokens[:, 0]
+
+    pooled = tokens[:, 1:].mean(axis=1)
+    if feature_mode == 'meanpool':
+        return pooled
+    if feature_mode == 'pca':
+        mean, components = projection
+        return (pooled - mean) @ components.T
+
+    raise ValueError(f'Unknown feature mode: {feature_mode}')
+
+
+def fit_pca_projection(vectors, n_components):
+    """Fit a PCA projection (mean, components) on row vectors."""
+    mean = vectors.mean(axis=0)
+    _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+    return mean.astype(np.float32), vt[:n_components].astype(np.float32)
+
+
+def save_pca_projection(file_path, projection, alphabet, texts):
+    mean, components = projection
+    # Shards fitting the same projection at once must not read a partly written file
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, mean=mean, components=components, characters=alphabet, texts=np.array(texts))
+    os.replace(temp_path, file_path)
+
+
+def load_pca_projection(file_path, alphabet, texts, n_components):
+    """Load a PCA projection, or return None when it is missing or was fitted for other settings."""
+    if not os.path.exists(file_path):
+        return None
+
+    with np.load(file_path) as data:
+        if str(data['characters']) != alphabet or list(data['texts']) != list(texts) \
+                or len(data['components']) != n_components:
+            return None
+        return data['mean'], data['components']
+
+
+#
+# features info stored next to the fonts
+#
+def features_info(feature_mode, feature_dtype, alphabet, texts, pca_components=None, model=None):
+    """Settings the features of a store are computed with. model holds the non-default model settings of
+    ModelProvider.identity()."""
+    info = {'feature_mode': feature_mode, 'feature_dtype': feature_dtype, 'characters': alphabet, 'texts': list(texts)}
+    if feature_mode == 'pca':
+        info['pca_components'] = pca_components
+    info.update(model or {})
+    return info
+
+
+def read_features_info(font_directory):
+    """Read the features info of per-font feature files. Directories without it hold full float32 features."""
+    info_path = os.path.join(font_directory, FEATURES_INFO_FILE_NAME)
+    if not os.path.exists(info_path):
+        return {'feature_mode': 'full', 'feature_dtype': 'float32'}
+
+    with open(info_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
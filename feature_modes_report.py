@@ -0,0 +1,100 @@
+import argparse
+import numpy as np
+
+from config import DEFAULT_FONT_PATH, DEFAULT_PCA_COMPONENTS
+from feature_modes import FEATURE_MODES, fit_pca_projection, pool_features
+from feature_store import FeatureStore
+from font_distance import gram_matrix, pairwise_distances
+from font_sort import load_fonts, optimized_font_path, path_length
+
+
+def sample_mode_features(features, rows, num_images, embed_dim, pca_components):
+    """Derive the features of every mode from full features, reading one image slice of all fonts at a time.
+
+    Returns the full feature distance matrix and a dictionary of per-font feature vectors of the compact modes.
+    """
+    num_fonts = len(rows)
+    image_size = features.shape[1] // num_images
+
+    gram = np.zeros((num_fonts, num_fonts))
+    cls = np.zeros((num_fonts, num_images, embed_dim), dtype=np.float32)
+    meanpool = np.zeros((num_fonts, num_images, embed_dim), dtype=np.float32)
+    for image in range(num_images):
+        print(f'Reading full features of image {image + 1}/{num_images}', end='\r', flush=True)
+
+        tokens = np.stack([features[row, image * image_size:(image + 1) * image_size] for row in rows])
+        tokens = tokens.astype(np.float32)
+        tokens = tokens.reshape(num_fonts, -1, embed_dim)
+        flat = tokens.reshape(num_fonts, -1)
+        gram += (flat @ flat.T).astype(np.float64)
+        cls[:, image] = pool_features(tokens, 'cls')
+        meanpool[:, image] = pool_features(tokens, 'meanpool')
+    print()
+
+    # The report fits the projection on the sampled fonts themselves
+    mean, components = fit_pca_projection(meanpool.reshape(-1, embed_dim), pca_components)
+    pca = (meanpool.reshape(-1, embed_dim) - mean) @ components.T
+
+    mode_features = {'full_size': features.shape[1], 'cls': cls.reshape(num_fonts, -1),
+                     'meanpool': meanpool.reshape(num_fonts, -1), 'pca': pca.reshape(num_fonts, -1)}
+    return pairwise_distances(gram), mode_features
+
+
+def nearest_neighbours_overlap(reference_matrix, distance_matrix, k):
+    """Mean fraction of the k nearest neighbours of each font shared by the two distance matrices."""
+    def nearest(matrix):
+        matrix = matrix + np.diag(np.full(len(matrix), np.inf))
+        return np.argsort(matrix, axis=1)[:, :k]
+
+    reference, neighbours = nearest(reference_matrix), nearest(distance_matrix)
+    return np.mean([len(np.intersect1d(r, n)) / k for r, n in zip(reference, neighbours)])
+
+
+def feature_modes_report(font_directory, sample_size, neighbours, embed_dim, pca_components):
+    info = FeatureStore(font_directory).info
+    if info.get('feature_mode') != 'full':
+        print(f"The report derives every mode from full features, {font_directory} holds {info.get('feature_mode')} "
+              f"features. Run font_features.py with --feature_mode full first.")
+        return
+
+    features, rows, _, _, _ = load_fonts(font_directory)
+    rng = np.random.default_rng(0)
+    if len(rows) > sample_size:
+        rows = [rows[i] for i in sorted(rng.choice(len(rows), sample_size, replace=False))]
+
+    num_images = len(info['characters']) + len(info['texts'])
+    full_matrix, mode_features = sample_mode_features(features, rows, num_images, embed_dim, pca_components)
+    full_path = optimized_font_path(full_matrix)
+    full_length = path_length(full_path, full_matrix)
+
+    print(f'\nOrdering quality of {len(rows)} fonts against full features '
+          f'(path lengths are measured with full feature distances)')
+    print(f"{'mode':<10}{'values/font':>12}{'float16 KB':>12}{'path length':>14}{'vs full':>9}"
+          f"{f'{neighbours}-NN overlap':>16}")
+    full_size = mode_features['full_size']
+    print(f"{'full':<10}{full_size:>12}{full_size * 2 / 1024:>12.0f}{full_length:>14.2f}{1:>9.3f}{1:>16.3f}")
+    for mode in FEATURE_MODES[1:]:
+        vectors = mode_features[mode]
+        distance_matrix = pairwise_distances(gram_matrix(vectors, np.arange(len(vectors))))
+        path = optimized_font_path(distance_matrix)
+        length = path_length(path, full_matrix)
+        overlap = nearest_neighbours_overlap(full_matrix, distance_matrix, neighbours)
+        print(f'{mode:<10}{vectors.shape[1]:>12}{vectors.shape[1] * 2 / 1024:>12.1f}{length:>14.2f}'
+              f'{length / full_length:>9.3f}{overlap:>16.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare font orderings of the feature modes against full features')
+    parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    parser.add_argument('--sample', type=int, default=200, help='Number of fonts compared.')
+    parser.add_argument('--neighbours', type=int, default=10, help='Number of nearest neighbours compared.')
+    parser.add_argument('--embed_dim', type=int, default=768, help='Dimension of model token features.')
+    parser.add_argument('--pca_components', type=int, default=DEFAULT_PCA_COMPONENTS,
+                        help='Number of PCA components per image.')
+    args = parser.parse_args()
+
+    feature_modes_report(args.font_path, args.sample, args.neighbours, args.embed_dim, args.pca_components)
+
+
+if __name__ == "__main__":
+    main()
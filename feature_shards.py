@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import time
+
+from feature_store import FeatureStore, file_sha256, font_store_name
+
+
+SHARD_DIR_NAME = 'feature_shards'
+MANIFEST_FILE_NAME = 'manifest.json'
+MERGED_STATUSES = ('computed', 'cached', 'duplicate')
+
+
+#
+# shard assignment
+#
+def parse_shard(text):
+    """Shard argument i/N as (i, N), with shards numbered from 0."""
+    try:
+        shard, num_shards = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected a shard as i/N, e.g. 0/4, got {text!r}')
+    if not 0 <= shard < num_shards:
+        raise argparse.ArgumentTypeError(f'shard {shard} of {num_shards} is not between 0 and {num_shards - 1}')
+    return shard, num_shards
+
+
+def font_shard(name, num_shards):
+    """Shard of a font from a hash of its store name, the same on every machine and in every run."""
+    return int.from_bytes(hashlib.sha256(name.encode('utf-8')).digest()[:8], 'big') % num_shards
+
+
+def shard_font_files(font_files, shard, num_shards):
+    """The (font directory, font file name) pairs of the fonts assigned to a shard."""
+    return [font_file for font_file in font_files if font_shard(font_store_name(*font_file), num_shards) == shard]
+
+
+def shard_store_path(shard_dir, shard, num_shards):
+    return os.path.join(shard_dir, f'shard_{shard}_of_{num_shards}')
+
+
+#
+# manifests
+#
+class ShardManifest:
+    """Record of a shard run, saved next to the shard's feature store: the settings, the content hash, status and
+    render time of every font of the shard, and the timings of the run.
+
+    The status of a font is computed, cached (features of an earlier run of the shard), duplicate (features copied
+    from a font with the same outlines) or failed.
+    """
+
+    def __init__(self, store_path, shard, num_shards, info):
+        self.path = os.path.join(store_path, MANIFEST_FILE_NAME)
+        self.shard = shard
+        self.num_shards = num_shards
+        self.info = info
+        self.start_time = time.time()
+        self.fonts = {}
+
+    def record(self, name, ttf, sha256, status, seconds=None, error=None):
+        self.fonts[name] = {'ttf': ttf, 'sha256': sha256, 'status': status, 'render_seconds': seconds,
+                            'error': error}
+
+    def save(self, stats, projection_hash=None):
+        manifest = {'shard': self.shard, 'num_shards': self.num_shards, 'info': self.info,
+                    'projection_sha256': projection_hash, 'host': socket.gethostname(), 'pid': os.getpid(),
+                    'start_time': self.start_time, 'end_time': time.time(),
+                    'render_seconds': stats.render_seconds, 'inference_seconds': stats.inference_seconds,
+                    'fonts': self.fonts}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def read_shard_manifests(shard_dir):
+    """Manifests of all shards of a shard directory, ordered by shard.
+
+    Raises ValueError unless every shard of one shard count has a manifest and all shards used the same settings.
+    """
+    manifests = []
+    for entry in sorted(os.listdir(shard_dir)) if os.path.isdir(shard_dir) else []:
+        manifest_path = os.path.join(shard_dir, entry, MANIFEST_FILE_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifests.append(json.load(f))
+    if not manifests:
+        raise ValueError(f'No shard manifests in {shard_dir}')
+
+    shard_counts = {manifest['num_shards'] for manifest in manifests}
+    if len(shard_counts) > 1:
+        raise ValueError(f'{shard_dir} holds shards of {sorted(shard_counts)} shard runs, remove the stale ones')
+    num_shards = shard_counts.pop()
+    manifests.sort(key=lambda manifest: manifest['shard'])
+    missing = sorted(set(range(num_shards)).difference(manifest['shard'] for manifest in manifests))
+    if missing:
+        raise ValueError(f"Shards {', '.join(f'{shard}/{num_shards}' for shard in missing)} have no manifest, run "
+                         f"them first")
+
+    for manifest in manifests[1:]:
+        if manifest['info'] != manifests[0]['info'] \
+                or manifest['projection_sha256'] != manifests[0]['projection_sha256']:
+            raise ValueError(f"Shard {manifest['shard']}/{num_shards} was computed with other feature settings than "
+                             f"shard 0/{num_shards}")
+    return manifests
+
+
+#
+# merge
+#
+def merge_shards(store, manifests, shard_dir, font_file_paths):
+    """Copy the features of the fonts of all shards into the store.
+
+    A font is copied when its manifest status is not failed, it belongs to the shard by its hash, the shard store
+    holds its features and the font file still has the content hash of the manifest. Returns the number of fonts
+    copied, already in the store and skipped, by shard.
+    """
+    font_file_paths = {font_store_name(*os.path.split(font_file_path)): font_file_path
+                       for font_file_path in font_file_paths}
+    results = []
+    for manifest in manifests:
+        shard, num_shards = manifest['shard'], manifest['num_shards']
+        shard_store = FeatureStore(store.font_directory, shard_store_path(shard_dir, shard, num_shards))
+        if shard_store.info != manifest['info']:
+            raise ValueError(f'The feature store of shard {shard}/{num_shards} does not match its manifest')
+        matrix = shard_store.matrix()
+
+        copied = current = skipped = 0
+        for name, font in manifest['fonts'].items():
+            entry = shard_store.fonts.get(name)
+            font_file_path = font_file_paths.get(name)
+            if font['status'] not in MERGED_STATUSES or entry is None or entry['sha256'] != font['sha256'] \
+                    or font_shard(name, num_shards) != shard or font_file_path is None:
+                skipped += 1
+                continue
+            if store.fonts.get(name, {}).get('key') == entry.get('key'):
+                current += 1
+                continue
+
+            # Fonts changed since the shard ran are computed again
+            stat = os.stat(font_file_path)
+            if (entry.get('size'), entry.get('mtime_ns')) != (stat.st_size, stat.st_mtime_ns) \
+                    and file_sha256(font_file_path) != entry['sha256']:
+                skipped += 1
+                continue
+
+            fields = {key: value for key, value in entry.items() if key not in ('row', 'ttf', 'sha256')}
+            store.put(name, font_file_path, entry['sha256'], matrix[entry['row']], shard_store.densities[entry['row']],
+                      **fields)
+            copied += 1
+        results.append((copied, current, skipped))
+        print(f'Merged {shard + 1} of {num_shards} shards', end='\r', flush=True)
+    print()
+    return results
+
+
+def shard_report(manifests, results):
+    """Fonts by status and timings of every shard, and the fonts copied into the store."""
+    print(f"{'shard':<8}{'host':<16}{'computed':>9}{'cached':>8}{'dup':>6}{'failed':>8}{'wall (s)':>10}"
+          f"{'render (s)':>11}{'copied':>8}{'current':>8}{'skipped':>8}")
+    for manifest, (copied, current, skipped) in zip(manifests, results):
+        statuses = [font['status'] for font in manifest['fonts'].values()]
+        print(f"{manifest['shard']:<8}{manifest['host'][:15]:<16}{statuses.count('computed'):>9}"
+              f"{statuses.count('cached'):>8}{statuses.count('duplicate'):>6}{statuses.count('failed'):>8}"
+              f"{manifest['end_time'] - manifest['start_time']:>10.1f}{manifest['render_seconds']:>11.1f}"
+              f"{copied:>8}{current:>8}{skipped:>8}")
@@ -0,0 +1,250 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from config import DEFAULT_FONT_PATH, DEFAULT_FEATURES_CHARACTERS, DEFAULT_FEATURES_TEXTS, DEFAULT_MODEL_NAME, \
+    DEFAULT_IMAGE_SIZE, DEFAULT_PCA_COMPONENTS
+from feature_modes import PCA_PROJECTION_FILE_NAME, read_features_info, load_pca_projection
+
+
+STORE_DIR_NAME = 'feature_store'
+MATRIX_FILE_NAME = 'features.bin'
+DENSITIES_FILE_NAME = 'densities.npy'
+INDEX_FILE_NAME = 'index.json'
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def font_store_name(font_dir, font_file):
+    """Name of a font in the store and in the sorted font list, e.g. Open Sans_regular."""
+    return f"{os.path.basename(font_dir)}_{os.path.splitext(font_file)[0]}"
+
+
+def projection_sha256(projection):
+    if projection is None:
+        return None
+    mean, components = projection
+    return hashlib.sha256(np.ascontiguousarray(mean).tobytes() + np.ascontiguousarray(components).tobytes()).hexdigest()
+
+
+def font_cache_key(ttf_sha256, alphabet, texts, feature_mode, projection_hash=None, model=None):
+    """Key of the features of a font: they are reused as long as neither the font file nor any setting changed.
+    model holds the non-default model settings of ModelProvider.identity()."""
+    key = {'ttf_sha256': ttf_sha256, 'characters': alphabet, 'texts': list(texts), 'model': DEFAULT_MODEL_NAME,
+           'image_size': list(DEFAULT_IMAGE_SIZE), 'feature_mode': feature_mode, 'pca_projection': projection_hash}
+    key.update(model or {})
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FeatureStore:
+    """Features of all fonts of a font directory in a single memory-mappable (rows, dim) matrix file.
+
+    The store directory holds the matrix file, a densities array with one density per row and an index that maps font
+    names to their row, .ttf path (relative to the font directory) and .ttf content hash, together with the features
+    info the features were computed with. The index is written last, and rows of the saved index are never written
+    until another index is saved: new and changed features go to rows no saved font uses, the rows of removed and
+    changed fonts are reused after the next save. An interrupted update thus never changes the features of the saved
+    index, and rows it wrote after the saved ones are overwritten by the next update.
+
+    The store directory is feature_store in the font directory unless another path is given, as for shard stores.
+    """
+
+    def __init__(self, font_directory, path=None):
+        self.font_directory = font_directory
+        self.path = path or os.path.join(font_directory, STORE_DIR_NAME)
+        self.info = {}
+        self.dim = 0
+        self.dtype = None
+        self.num_rows = 0
+        self.fonts = {}
+        self.densities = []
+        self._saved_rows = set()
+        self._free_rows = None
+        self._matrix = None
+
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.info = index['info']
+            self.dim = index['dim']
+            self.dtype = index['dtype']
+            self.num_rows = index['rows']
+            self.fonts = index['fonts']
+            self.densities = np.load(os.path.join(self.path, DENSITIES_FILE_NAME)).tolist()[:self.num_rows]
+            self._saved_rows = {entry['row'] for entry in self.fonts.values()}
+
+    def __len__(self):
+        return len(self.fonts)
+
+    def __contains__(self, name):
+        return name in self.fonts
+
+    def reset(self, info):
+        """Drop all features and start an empty store for features computed with other settings."""
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.info = info
+        self.dim = 0
+        self.dtype = info.get('feature_dtype', 'float32')
+        self.num_rows = 0
+        self.fonts = {}
+        self.densities = []
+        self._saved_rows = set()
+        self._free_rows = None
+        self._matrix = None
+
+    def matrix(self, writable=False):
+        """Memory map of the (rows, dim) feature matrix, rows of removed fonts included."""
+        if self.num_rows == 0:
+            return np.zeros((0, self.dim), dtype=self.dtype)
+        if self._matrix is None or (writable and not self._matrix.flags.writeable):
+            self._matrix = np.memmap(os.path.join(self.path, MATRIX_FILE_NAME), dtype=self.dtype,
+                                     mode='r+' if writable else 'r', shape=(self.num_rows, self.dim))
+        return self._matrix
+
+    def font_names(self):
+        return sorted(self.fonts)
+
+    def rows(self, names):
+        return [self.fonts[name]['row'] for name in names]
+
+    def ttf_path(self, name):
+        return os.path.join(self.font_directory, self.fonts[name]['ttf'])
+
+    def put(self, name, ttf_path, sha256, features, density, **entry):
+        """Store the features and density of a font, in a row that no font of the saved index uses."""
+        features = np.asarray(features, dtype=self.dtype)
+        if not self.dim:
+            self.dim = len(features)
+        if len(features) != self.dim:
+            raise ValueError(f'Features of {name} have {len(features)} values, the store holds {self.dim} per font')
+
+        if self._free_rows is None:
+            used_rows = self._saved_rows.union(e['row'] for e in self.fonts.values())
+            self._free_rows = sorted(set(range(self.num_rows)).difference(used_rows), reverse=True)
+
+        # A row written since the last save is overwritten, a row of the saved index is left to it
+        if name in self.fonts and self.fonts[name]['row'] not in self._saved_rows:
+            row = self.fonts[name]['row']
+        else:
+            row = self._free_rows.pop() if self._free_rows else self.num_rows
+
+        if row < self.num_rows:
+            matrix = self.matrix(writable=True)
+            matrix[row] = features
+            matrix.flush()
+        else:
+            # Rows past the saved ones may hold features of an interrupted update, write at the row's offset
+            os.makedirs(self.path, exist_ok=True)
+            matrix_path = os.path.join(self.path, MATRIX_FILE_NAME)
+            with open(matrix_path, 'r+b' if os.path.exists(matrix_path) else 'wb') as f:
+                f.seek(row * features.nbytes)
+                f.write(features.tobytes())
+            self.num_rows += 1
+            self.densities.append(0.0)
+            self._matrix = None
+
+        self.densities[row] = density
+        self.fonts[name] = {'row': row, 'ttf': os.path.relpath(ttf_path, self.font_directory), 'sha256': sha256,
+                            **entry}
+
+    def remove(self, name):
+        """Remove a font from the index. Its row is reused by a new font once the index is saved."""
+        entry = self.fonts.pop(name, None)
+        if entry is not None and self._free_rows is not None and entry['row'] not in self._saved_rows:
+            self._free_rows.append(entry['row'])
+            self._free_rows.sort(reverse=True)
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        np.save(os.path.join(self.path, DENSITIES_FILE_NAME), np.array(self.densities, dtype=np.float64))
+
+        index = {'info': self.info, 'dim': self.dim, 'dtype': self.dtype, 'rows': self.num_rows, 'fonts': self.fonts}
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+        os.replace(index_path + '.tmp', index_path)
+        self._saved_rows = {entry['row'] for entry in self.fonts.values()}
+        self._free_rows = None
+
+
+#
+# migration of per-font .features.npy and .density files
+#
+def migrate_font_files(font_directory, remove_font_files=False):
+    """Import the per-font feature and density files of a font directory into its feature store."""
+    # model_provider imports this module for file_sha256
+    from model_provider import stored_model
+
+    info = read_features_info(font_directory)
+    info.setdefault('characters', DEFAULT_FEATURES_CHARACTERS)
+    info.setdefault('texts', DEFAULT_FEATURES_TEXTS)
+
+    projection = None
+    if info['feature_mode'] == 'pca':
+        projection = load_pca_projection(os.path.join(font_directory, PCA_PROJECTION_FILE_NAME), info['characters'],
+                                         info['texts'], info.get('pca_components', DEFAULT_PCA_COMPONENTS))
+    projection_hash = projection_sha256(projection)
+
+    store = FeatureStore(font_directory)
+    store.reset(info)
+
+    imported_files = []
+    for root, _, files in os.walk(font_directory):
+        if os.path.abspath(root).startswith(os.path.abspath(store.path)):
+            continue
+        for file in sorted(files):
+            if not file.endswith('.ttf'):
+                continue
+
+            ttf_file_path = os.path.join(root, file)
+            feature_file_path = ttf_file_path + '.features.npy'
+            density_file_path = ttf_file_path + '.density'
+            if not os.path.exists(feature_file_path) or not os.path.exists(density_file_path):
+                continue
+
+            with open(density_file_path, 'r') as f:
+                font_density = float(f.readline().strip())
+            ttf_sha256 = file_sha256(ttf_file_path)
+            stat = os.stat(ttf_file_path)
+            store.put(font_store_name(root, file), ttf_file_path, ttf_sha256, np.load(feature_file_path), font_density,
+                      key=font_cache_key(ttf_sha256, info['characters'], info['texts'], info['feature_mode'],
+                                         projection_hash, stored_model(info)),
+                      size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            imported_files.extend([feature_file_path, density_file_path])
+            print(f'Imported {len(store)} fonts', end='\r', flush=True)
+
+    store.save()
+    print(f'\nImported {len(store)} fonts into {store.path}')
+
+    if remove_font_files:
+        for file_path in imported_files:
+            os.remove(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the feature store of a font directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Import per-font .features.npy and .density files.')
+    migrate_parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    migrate_parser.add_argument('--remove_font_files', action='store_true',
+                                help='Remove the per-font files after they are imported.')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate_font_files(args.font_path, args.remove_font_files)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fontTools.pens.recordingPen import RecordingPen
+from fontTools.ttLib import TTFont
+
+import instrumentation
+import model_provider
+from config import DEFAULT_FINGERPRINT_GRID, DEFAULT_FINGERPRINT_WORKERS
+from feature_store import FeatureStore, font_store_name, font_cache_key
+
+
+#
+# outline fingerprints
+#
+def fingerprint_characters(alphabet, texts):
+    """Characters whose glyphs determine the rendered images of a font."""
+    return ''.join(sorted(set(alphabet).union(*texts)))
+
+
+def outline_fingerprint(font_file_path, characters, grid=DEFAULT_FINGERPRINT_GRID):
+    """Hash of the outlines and advance widths of the glyphs of the characters.
+
+    Coordinates are scaled to the em and rounded to 1/grid em, so that fonts whose outlines differ only in the units
+    per em or by small edits get the same fingerprint. Kerning and hinting are not part of it.
+    """
+    sha256 = hashlib.sha256()
+    with TTFont(font_file_path, lazy=True) as font:
+        scale = grid / font['head'].unitsPerEm
+        cmap = font.getBestCmap() or {}
+        glyf = font['glyf'] if 'glyf' in font else None
+        glyph_set = font.getGlyphSet() if glyf is None else None
+        for char in characters:
+            glyph_name = cmap.get(ord(char), '.notdef')
+            sha256.update(np.int32(round(font['hmtx'][glyph_name][0] * scale)).tobytes())
+            if glyf is not None:
+                coordinates, end_points, flags = glyf[glyph_name].getCoordinates(glyf)
+                sha256.update(np.round(np.array(coordinates.array) * scale).astype(np.int32).tobytes())
+                sha256.update(np.array(end_points, dtype=np.int32).tobytes())
+                sha256.update(np.frombuffer(bytes(flags), dtype=np.uint8) & 1)
+            else:
+                pen = RecordingPen()
+                glyph_set[glyph_name].draw(pen)
+                for operator, points in pen.value:
+                    sha256.update(operator.encode('ascii'))
+                    sha256.update(np.round(np.array(points, dtype=np.float64) * scale).astype(np.int32).tobytes())
+    return sha256.hexdigest()
+
+
+def safe_fingerprint(font_file_path, characters):
+    try:
+        return outline_fingerprint(font_file_path, characters)
+    except Exception:
+        # Fonts fontTools can not read are embedded on their own
+        return None
+
+
+def font_fingerprints(font_file_paths, characters, workers=DEFAULT_FINGERPRINT_WORKERS):
+    """Outline fingerprints of font files computed in a process pool, None for fonts that could not be read."""
+    arguments = (font_file_paths, [characters] * len(font_file_paths))
+    with instrumentation.timer('fingerprint'):
+        if workers > 0 and len(font_file_paths) > 1:
+            chunk_size = max(len(font_file_paths) // (4 * workers), 1)
+            with ProcessPoolExecutor(workers) as executor:
+                return list(executor.map(safe_fingerprint, *arguments, chunksize=chunk_size))
+        return list(map(safe_fingerprint, *arguments))
+
+
+#
+# reusing features of duplicates
+#
+class DuplicateIndex:
+    """Fonts of a feature store with current features by outline fingerprint, so that the features of a font are
+    copied to fonts with the same outlines instead of embedding them again.
+
+    Fingerprints are kept in the store entries next to the features they were computed with, and reused while the
+    font file size and modification time are unchanged. Without stored, only features added from now on are reused,
+    as when all features are recomputed.
+    """
+
+    def __init__(self, store, alphabet, texts, feature_mode, projection_hash=None, stored=True):
+        self.store = store
+        self.characters = fingerprint_characters(alphabet, texts)
+        self.canonical = {}  # fingerprint -> name of the font whose features are reused
+        self.reused = 0
+        model = model_provider.provider().identity()
+        for name in sorted(store.fonts) if stored else []:
+            entry = store.fonts[name]
+            key = font_cache_key(entry['sha256'], alphabet, texts, feature_mode, projection_hash, model)
+            if entry.get('fingerprint') and entry.get('key') == key:
+                self.canonical.setdefault(entry['fingerprint'], name)
+
+    def cached_fingerprint(self, name, font_file_path):
+        """Fingerprint of a font file from the store, or None when the file changed since it was computed."""
+        entry = self.store.fonts.get(name, {})
+        stat = os.stat(font_file_path)
+        if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return entry.get('fingerprint')
+        return None
+
+    def fingerprints(self, font_file_paths, workers=DEFAULT_FINGERPRINT_WORKERS):
+        """Fingerprints of font files by path, computing the ones not cached in the store."""
+        fingerprints = {path: self.cached_fingerprint(font_store_name(*os.path.split(path)), path)
+                        for path in font_file_paths}
+        missing = [path for path, fingerprint in fingerprints.items() if fingerprint is None]
+        fingerprints.update(zip(missing, font_fingerprints(missing, self.characters, workers)))
+        return fingerprints
+
+    def fingerprint(self, font_file_path):
+        name = font_store_name(*os.path.split(font_file_path))
+        return self.cached_fingerprint(name, font_file_path) or safe_fingerprint(font_file_path, self.characters)
+
+    def add(self, name, fingerprint):
+        """Record the fingerprint of a font whose features are current."""
+        if fingerprint:
+            self.store.fonts[name]['fingerprint'] = fingerprint
+            self.canonical.setdefault(fingerprint, name)
+
+    def find(self, fingerprint, name=None):
+        """Name of another font with the fingerprint and current features, or None."""
+        canonical = self.canonical.get(fingerprint) if fingerprint else None
+        return canonical if canonical != name and canonical in self.store.fonts else None
+
+    def reuse(self, font_file_path, canonical, ttf_sha256, key, fingerprint):
+        """Store the features and density of the canonical font for a duplicate font."""
+        row = self.store.fonts[canonical]['row']
+        features = np.array(self.store.matrix()[row])
+        stat = os.stat(font_file_path)
+        with instrumentation.timer('feature_write'):
+            self.store.put(font_store_name(*os.path.split(font_file_path)), font_file_path, ttf_sha256, features,
+                           self.store.densities[row], key=key, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                           fingerprint=fingerprint, duplicate_of=canonical)
+        instrumentation.count('bytes_written', features.nbytes)
+        instrumentation.count('fonts_deduplicated')
+        self.reused += 1
+
+
+#
+# duplicate groups for sorting
+#
+def load_duplicate_groups(font_directory, font_names):
+    """Groups of fonts with the same outline fingerprint, as lists of indices into font_names in font order. Fonts
+    without a fingerprint form groups of their own."""
+    store = FeatureStore(font_directory)
+    groups = {}
+    for i, name in enumerate(font_names):
+        groups.setdefault(store.fonts[name].get('fingerprint') or name, []).append(i)
+    return list(groups.values())
+
+
+def expand_duplicates(path, groups):
+    """Path of all fonts from the path of the groups, each group in place of its node."""
+    return [font for node in path for font in groups[node]]
@@ -0,0 +1,85 @@
+import numpy as np
+
+import instrumentation
+from config import DEFAULT_DISTANCE_TILE_BYTES
+
+
+DISTANCE_METRICS = ['euclidean', 'cosine']
+DISTANCE_DTYPES = ['float32', 'float64']
+
+
+def tile_columns(num_rows, dim, dtype, tile_size=None):
+    """Number of feature columns of all rows that are read and multiplied at once."""
+    if tile_size:
+        return min(tile_size, dim)
+    return int(min(dim, max(1, DEFAULT_DISTANCE_TILE_BYTES // (max(num_rows, 1) * np.dtype(dtype).itemsize))))
+
+
+def gram_matrix(features, rows, dtype='float64', tile_size=None, progress=None):
+    """Compute the Gram matrix of feature rows, streaming the features in column tiles.
+
+    Every feature value is read once, whether the features are an array in memory or a memory map of a feature store
+    that does not fit in RAM; tile_size (in columns) bounds the memory of a tile.
+    """
+    rows = np.asarray(rows)
+    num_fonts, dim = len(rows), features.shape[1]
+    tile = tile_columns(num_fonts, dim, dtype, tile_size)
+
+    gram = np.zeros((num_fonts, num_fonts), dtype=dtype)
+    for start in range(0, dim, tile):
+        if progress:
+            progress(start, dim)
+        with instrumentation.timer('feature_read'):
+            block = np.asarray(features[rows, start:start + tile], dtype=dtype)
+        instrumentation.count('bytes_read', block.shape[0] * block.shape[1] * features.dtype.itemsize)
+        with instrumentation.timer('gram_matrix'):
+            gram += block @ block.T
+    return gram
+
+
+def distances_from_products(products, squared_norms_a, squared_norms_b, metric='euclidean'):
+    """Turn dot products of two sets of vectors into distances using ||a||^2 + ||b||^2 - 2ab."""
+    if metric == 'euclidean':
+        squared = squared_norms_a[:, None] + squared_norms_b[None, :] - 2 * products
+        return np.sqrt(np.maximum(squared, 0, out=squared), out=squared)
+    if metric == 'cosine':
+        norms = np.sqrt(squared_norms_a)[:, None] * np.sqrt(squared_norms_b)[None, :]
+        return 1 - np.divide(products, norms, out=np.zeros_like(products), where=norms > 0)
+
+    raise ValueError(f'Unknown distance metric: {metric}')
+
+
+def distance_block(a, b, metric='euclidean', dtype='float64'):
+    """Distances between the rows of two feature blocks."""
+    a = np.asarray(a, dtype=dtype)
+    b = np.asarray(b, dtype=dtype)
+    return distances_from_products(a @ b.T, np.einsum('ij,ij->i', a, a), np.einsum('ij,ij->i', b, b), metric)
+
+
+def pairwise_distances(gram, metric='euclidean'):
+    """Distance matrix of the vectors of a Gram matrix, exactly symmetric and with a zero diagonal."""
+    gram = (gram + gram.T) / 2
+    squared_norms = np.diag(gram).copy()
+    distance_matrix = distances_from_products(gram, squared_norms, squared_norms, metric)
+    np.fill_diagonal(distance_matrix, 0)
+    return distance_matrix
+
+
+def cross_distances(features, rows_a, rows_b, metric='euclidean', dtype='float64', tile_size=None):
+    """Distances between two sets of feature rows, streaming the features in column tiles like gram_matrix."""
+    rows_a, rows_b = np.asarray(rows_a), np.asarray(rows_b)
+    dim = features.shape[1]
+    tile = tile_columns(len(rows_a) + len(rows_b), dim, dtype, tile_size)
+
+    products = np.zeros((len(rows_a), len(rows_b)), dtype=dtype)
+    squared_norms_a = np.zeros(len(rows_a), dtype=dtype)
+    squared_norms_b = np.zeros(len(rows_b), dtype=dtype)
+    for start in range(0, dim, tile):
+        with instrumentation.timer('feature_read'):
+            a = np.asarray(features[rows_a, start:start + tile], dtype=dtype)
+            b = np.asarray(features[rows_b, start:start + tile], dtype=dtype)
+        instrumentation.count('bytes_read', (a.size + b.size) * features.dtype.itemsize)
+        products += a @ b.T
+        squared_norms_a += np.einsum('ij,ij->i', a, a)
+        squared_norms_b += np.einsum('ij,ij->i', b, b)
+    return distances_from_products(products, squared_norms_a, squared_norms_b, metric)
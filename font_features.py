@@ -1,14 +1,25 @@
 import os
 import sys
+import time
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
-from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
-import torch
-from torchvision import transforms
-import timm
-
-from config import DEFAULT_FEATURES_CHARACTERS, DEFAULT_FEATURES_TEXTS
+from PIL import Image
+
+import instrumentation
+import model_provider
+from config import DEFAULT_FEATURES_CHARACTERS, DEFAULT_FEATURES_TEXTS, DEFAULT_BATCH_SIZE, DEFAULT_RENDER_WORKERS, \
+    DEFAULT_RENDER_QUEUE_SIZE, DEFAULT_FEATURE_MODE, DEFAULT_FEATURE_DTYPE, \
+    DEFAULT_PCA_COMPONENTS, DEFAULT_PCA_SAMPLE, DEFAULT_FINGERPRINT_WORKERS
+from feature_modes import FEATURE_MODES, FEATURE_DTYPES, PCA_PROJECTION_FILE_NAME, pool_features, fit_pca_projection, \
+    save_pca_projection, load_pca_projection, features_info
+from feature_store import FeatureStore, file_sha256, font_store_name, font_cache_key, projection_sha256
+from feature_shards import SHARD_DIR_NAME, ShardManifest, parse_shard, shard_font_files, shard_store_path
+from font_dedup import DuplicateIndex
+from font_render import RENDER_CACHE_DIR_NAME, generate_text_image, calculate_glyph_density, render_font_images, \
+    render_font
 
 
 def print_line(message):
@@ -21,143 +32,522 @@ def print_line(message):
     sys.stdout.flush()
 
 
-# Load pre-trained Vision Transformer model
-model = timm.create_model('vit_base_patch16_224', pretrained=True)
-model.eval()
-
-# Transformation for input image without resizing
-transform = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-])
+# Number of computed fonts after which the feature store index is saved
+STORE_SAVE_INTERVAL = 50
 
 
 #
 # font features
 #
 def extract_features(img):
-    img = transform(img).unsqueeze(0)
-    with torch.no_grad():
-        features = model.forward_features(img).flatten().numpy()
-    return features
-
-
-def generate_text_image(font_path, text, image_size=(224, 224), padding=10):
-    # Initialize font size and create a draw object
-    font_size = 10
-    font_image = Image.new('RGB', image_size, 'white')
-    draw = ImageDraw.Draw(font_image)
-
-    # Increase font size until the text fits the image
-    while True:
-        font_pillow = ImageFont.truetype(font_path, font_size)
-
-        bbox = draw.textbbox((0, 0), text, font=font_pillow)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-
-        if (text_width + padding) > image_size[0] or (text_height + padding) > image_size[1]:
-            font_size -= 1
-            break
-        font_size += 1
-
-    # Load the font with the final size
-    font_pillow = ImageFont.truetype(font_path, font_size)
-
-    # Create the final blank image
-    font_image = Image.new('RGB', image_size, 'white')
-    draw = ImageDraw.Draw(font_image)
-
-    bbox = draw.textbbox((0, 0), text, font=font_pillow)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-    x = (image_size[0] - text_width) / 2 - bbox[0]
-    y = (image_size[1] - text_height) / 2 - bbox[1]
-
-    # Draw the text on the image
-    draw.text((x, y), text, fill='black', font=font_pillow)
-
-    return font_image, text_width, text_height
-
-
-def calculate_glyph_density(font_image, text_width, text_height):
-    # Convert the image to grayscale and calculate the glyph density
-    grayscale_image = font_image.convert('L')
-    image_array = np.array(grayscale_image)
-    threshold = 240
-    non_background_pixels = np.sum(image_array < threshold)
-
-    # Calculate the bounding box area
-    bbox_area = text_width * text_height
-
-    # Glyph density is the ratio of non-background pixels to bounding box area
-    glyph_density = non_background_pixels / bbox_area if bbox_area > 0 else 0
+    return extract_features_batch([img], batch_size=1)[0]
 
-    return glyph_density
 
-
-def font_features(font_file_name, alphabet, texts):
+def extract_features_batch(images, batch_size=DEFAULT_BATCH_SIZE, feature_mode=DEFAULT_FEATURE_MODE, projection=None):
+    """Run the model over the images in batches and return one feature vector per image."""
     features = []
-    glyph_densities = []
-
-    # Process each character in the alphabet
-    for char in alphabet:
-        char_img, char_width, char_height = generate_text_image(font_file_name, char)
-
-        char_features = extract_features(char_img)
-        features.append(char_features)
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        with instrumentation.timer('inference'):
+            tokens = model_provider.provider().forward_features(batch)
+            features.extend(pool_features(tokens, feature_mode, projection))
+        instrumentation.count('images', len(batch))
+    return features
 
-        glyph_density = calculate_glyph_density(char_img, char_width, char_height)
-        glyph_densities.append(glyph_density)
 
-    # Process each string in the text array
-    for txt in texts:
-        text_img, text_width, text_height = generate_text_image(font_file_name, txt)
-        text_features = extract_features(text_img)
-        features.append(text_features)
+def font_features(font_file_name, alphabet, texts, batch_size=DEFAULT_BATCH_SIZE, feature_mode=DEFAULT_FEATURE_MODE,
+                  projection=None, render_cache=None):
+    images, average_glyph_density = render_font_images(font_file_name, alphabet, texts, render_cache)
 
     # Concatenate all character features into a single feature vector
-    features = np.concatenate(features)
-
-    # Calculate the average thickness ratio
-    average_glyph_density = np.mean(glyph_densities)
+    features = np.concatenate(extract_features_batch(images, batch_size, feature_mode, projection))
 
     return features, average_glyph_density
 
 
 #
-# computing font features for font directory
+# rendering and inference pipeline
 #
-def create_font_features_files(font_file, alphabet, texts, features_file_name, density_file_name):
-    features, glyph_density = font_features(font_file, alphabet, texts)
-    np.save(features_file_name, features)
-
-    Path(density_file_name).write_text(f'{glyph_density}\n')
-
+class PipelineStats:
+    """Per-stage counters of the rendering and inference pipeline."""
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.render_workers = 0
+        self.fonts_rendered = 0
+        self.images_rendered = 0
+        self.render_seconds = 0.0
+        self.fonts_failed = 0
+        self.fonts_completed = 0
+        self.images_inferred = 0
+        self.inference_seconds = 0.0
+        self.font_render_seconds = {}  # font file name -> render time
+        self.font_errors = {}  # font file name -> error of a failed font
+
+    def report(self):
+        wall_seconds = time.perf_counter() - self.start_time
+        workers = max(self.render_workers, 1)
+
+        # Worker time is summed over all workers, divide by their number to get the stage's wall time
+        render_wall = self.render_seconds / workers
+        print(f'Rendering: {self.fonts_rendered} fonts, {self.images_rendered} images on {workers} worker(s), '
+              f'{1000 * self.render_seconds / self.fonts_rendered if self.fonts_rendered else 0:.0f} ms/font, '
+              f'{self.fonts_rendered / render_wall if render_wall else 0:.2f} fonts/s, '
+              f'{self.images_rendered / render_wall if render_wall else 0:.1f} images/s')
+        print(f'Inference: {self.images_inferred} images in {self.inference_seconds:.1f} s, '
+              f'{self.images_inferred / self.inference_seconds if self.inference_seconds else 0:.1f} images/s')
+        print(f'Total: {self.fonts_completed} fonts in {wall_seconds:.1f} s, '
+              f'{self.fonts_completed / wall_seconds if wall_seconds else 0:.2f} fonts/s, {self.fonts_failed} failed')
+
+
+def rendered_fonts_serial(font_file_names, alphabet, texts, stats, render_cache=None):
+    """Render fonts one after another in this process."""
+    for font_file_name in font_file_names:
+        start = time.perf_counter()
+        try:
+            with instrumentation.timer('render'):
+                images, average_glyph_density = render_font_images(font_file_name, alphabet, texts, render_cache)
+        except Exception as e:
+            print(f"\nAn error occurred while processing font {font_file_name} : {e}")
+            stats.fonts_failed += 1
+            stats.font_errors[font_file_name] = str(e)
+            continue
+
+        stats.fonts_rendered += 1
+        stats.images_rendered += len(images)
+        stats.font_render_seconds[font_file_name] = time.perf_counter() - start
+        stats.render_seconds += stats.font_render_seconds[font_file_name]
+        yield font_file_name, images, average_glyph_density
+
+
+def rendered_fonts_parallel(font_file_names, alphabet, texts, render_workers, queue_size, stats, render_cache=None):
+    """Render fonts in a pool of rasterizer processes, yielding fonts in the order they finish.
+
+    At most render_workers + queue_size fonts are rendered or waiting for inference at any time. A worker that
+    crashes takes the whole pool down; the pool is then restarted and the fonts that were in flight are rendered
+    again one at a time, so that the font that crashed the worker is identified and skipped.
+    """
+    font_file_names = iter(font_file_names)
+    suspects = deque()
+    in_flight = {}
+    executor = ProcessPoolExecutor(render_workers)
 
-def compute_font_features(font_dir, font_name, alphabet, texts, force_recompute):
-    font_file_path = os.path.join(font_dir, font_name)
-    features_file_name = os.path.join(font_dir, f'{font_name}.features')
-    density_file_name = os.path.join(font_dir, f'{font_name}.density')
-
-    if force_recompute or not os.path.exists(features_file_name) or not os.path.exists(density_file_name):
-        print_line(f'Computing font features for: {font_dir}')
-        create_font_features_files(font_file_path, alphabet, texts, features_file_name, density_file_name)
+    try:
+        while True:
+            while suspects and not in_flight:
+                font_file_name = suspects.popleft()
+                in_flight[executor.submit(render_font, font_file_name, alphabet, texts, render_cache)] = \
+                    (font_file_name, True)
+            while not suspects and len(in_flight) < render_workers + queue_size:
+                font_file_name = next(font_file_names, None)
+                if font_file_name is None:
+                    break
+                in_flight[executor.submit(render_font, font_file_name, alphabet, texts, render_cache)] = \
+                    (font_file_name, False)
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            pool_broken = False
+            for future in done:
+                font_file_name, isolated = in_flight.pop(future)
+                try:
+                    image_arrays, average_glyph_density, seconds = future.result()
+                except BrokenProcessPool:
+                    pool_broken = True
+                    if isolated:
+                        print(f"\nRasterizer worker crashed while processing font {font_file_name}")
+                        stats.fonts_failed += 1
+                        stats.font_errors[font_file_name] = 'rasterizer worker crashed'
+                    else:
+                        suspects.append(font_file_name)
+                    continue
+                except Exception as e:
+                    print(f"\nAn error occurred while processing font {font_file_name} : {e}")
+                    stats.fonts_failed += 1
+                    stats.font_errors[font_file_name] = str(e)
+                    continue
+
+                stats.fonts_rendered += 1
+                stats.images_rendered += len(image_arrays)
+                stats.font_render_seconds[font_file_name] = seconds
+                stats.render_seconds += seconds
+                instrumentation.add_time('render', seconds)
+                instrumentation.count('images_rendered', len(image_arrays))
+                yield font_file_name, [Image.fromarray(a).convert('RGB') for a in image_arrays], average_glyph_density
+
+            if pool_broken:
+                suspects.extend(font_file_name for font_file_name, _ in in_flight.values())
+                in_flight.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(render_workers)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fonts_features(font_file_names, alphabet, texts, batch_size=DEFAULT_BATCH_SIZE,
+                   render_workers=DEFAULT_RENDER_WORKERS, queue_size=DEFAULT_RENDER_QUEUE_SIZE, stats=None,
+                   feature_mode=DEFAULT_FEATURE_MODE, projection=None, render_cache=None):
+    """Compute features of several fonts, filling each model batch with images from consecutive fonts.
+
+    Fonts are rendered in this process when render_workers is 0, otherwise in a pool of rasterizer processes
+    that keeps rendering while the model runs. Yields (font_file_name, features, average_glyph_density) as soon as
+    all images of a font have passed through the model. Rendered images are reused from and added to the render
+    cache directory when one is given.
+    """
+    if stats is None:
+        stats = PipelineStats()
+    stats.render_workers = render_workers
+
+    if render_workers > 0:
+        rendered_fonts = rendered_fonts_parallel(font_file_names, alphabet, texts, render_workers, queue_size, stats,
+                                                 render_cache)
+    else:
+        rendered_fonts = rendered_fonts_serial(font_file_names, alphabet, texts, stats, render_cache)
+
+    pending_images = []
+    pending_fonts = []  # (font_file_name, number of images, average glyph density)
+    image_features = []
+
+    def run_model(images):
+        start = time.perf_counter()
+        image_features.extend(extract_features_batch(images, batch_size, feature_mode, projection))
+        stats.inference_seconds += time.perf_counter() - start
+        stats.images_inferred += len(images)
+
+    def completed_fonts():
+        while pending_fonts and pending_fonts[0][1] <= len(image_features):
+            font_file_name, num_images, average_glyph_density = pending_fonts.pop(0)
+            features = np.concatenate(image_features[:num_images])
+            del image_features[:num_images]
+            stats.fonts_completed += 1
+            instrumentation.count('fonts')
+            yield font_file_name, features, average_glyph_density
+
+    for font_file_name, images, average_glyph_density in rendered_fonts:
+        pending_images.extend(images)
+        pending_fonts.append((font_file_name, len(images), average_glyph_density))
+
+        # Run only full batches while more fonts may follow
+        num_full = len(pending_images) - len(pending_images) % batch_size
+        if num_full:
+            run_model(pending_images[:num_full])
+            del pending_images[:num_full]
+            yield from completed_fonts()
+
+    run_model(pending_images)
+    yield from completed_fonts()
 
 
-def enumerate_fonts(fonts_dir, alphabet, texts, force_recompute):
-    """Enumerate all .ttf font names and compute their features."""
+#
+# computing font features for font directory
+#
+def font_file_sha256(store, name, font_file_path):
+    """Content hash of a font file, taken from the store while the file size and modification time are unchanged."""
+    stat = os.stat(font_file_path)
+    entry = store.fonts.get(name, {})
+    if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+        return entry['sha256']
+    with instrumentation.timer('ttf_hash'):
+        ttf_sha256 = file_sha256(font_file_path)
+    instrumentation.count('bytes_read', stat.st_size)
+    return ttf_sha256
+
+
+def font_cache_entry(store, font_file_path, alphabet, texts, feature_mode, projection_hash=None):
+    """Store name, content hash and cache key of a font file, for features of the configured model."""
+    name = font_store_name(*os.path.split(font_file_path))
+    ttf_sha256 = font_file_sha256(store, name, font_file_path)
+    return name, ttf_sha256, font_cache_key(ttf_sha256, alphabet, texts, feature_mode, projection_hash,
+                                            model_provider.provider().identity())
+
+
+def should_compute_font_features(store, name, key, force_recompute):
+    return force_recompute or store.fonts.get(name, {}).get('key') != key
+
+
+def store_font_features(store, font_file_path, features, glyph_density, ttf_sha256, key, fingerprint=None):
+    stat = os.stat(font_file_path)
+    entry = {'fingerprint': fingerprint} if fingerprint else {}
+    with instrumentation.timer('feature_write'):
+        store.put(font_store_name(*os.path.split(font_file_path)), font_file_path, ttf_sha256, features,
+                  glyph_density, key=key, size=stat.st_size, mtime_ns=stat.st_mtime_ns, **entry)
+    instrumentation.count('bytes_written', features.nbytes)
+
+
+class FeatureComputation:
+    """Computes the features of a stream of fonts into a feature store, as font_features.py and the pipeline do.
+
+    Fonts with cached features are skipped and fonts with the same outlines as a font with current features get a copy
+    of its features. The other fonts are rendered and embedded in batches spanning consecutive fonts. A duplicate of a
+    font that is still being embedded waits for it in finish(), and is embedded itself when that font fails.
+    """
+
+    def __init__(self, store, alphabet, texts, force_recompute, batch_size=DEFAULT_BATCH_SIZE,
+                 render_workers=DEFAULT_RENDER_WORKERS, queue_size=DEFAULT_RENDER_QUEUE_SIZE,
+                 feature_mode=DEFAULT_FEATURE_MODE, projection=None, render_cache=None, duplicates=None,
+                 fingerprints=None, on_progress=None):
+        self.store = store
+        self.alphabet = alphabet
+        self.texts = texts
+        self.force_recompute = force_recompute
+        self.batch_size = batch_size
+        self.render_workers = render_workers
+        self.queue_size = queue_size
+        self.feature_mode = feature_mode
+        self.projection = projection
+        self.projection_hash = projection_sha256(projection)
+        self.render_cache = render_cache
+        self.duplicates = duplicates
+        self.fingerprints = fingerprints or {}  # font file path -> fingerprint computed beforehand
+        self.on_progress = on_progress
+        self.stats = PipelineStats()
+        self.entries = {}  # font file path -> store name, content hash and cache key
+        self.statuses = {}  # font file path -> cached, duplicate or computed; failed fonts have none
+        self.counts = {'cached': 0, 'duplicate': 0, 'computed': 0}
+        self.errors = 0
+        self.misses = {}  # font file path -> content hash, cache key and fingerprint of fonts to embed
+        self.deferred = {}  # font file path -> fingerprint of a font being embedded
+        self.in_flight = set()
+
+    def entry(self, font_file_path):
+        if font_file_path not in self.entries:
+            self.entries[font_file_path] = font_cache_entry(self.store, font_file_path, self.alphabet, self.texts,
+                                                            self.feature_mode, self.projection_hash)
+        return self.entries[font_file_path]
+
+    def fingerprint(self, font_file_path):
+        if font_file_path in self.fingerprints:
+            return self.fingerprints[font_file_path]
+        return self.duplicates.fingerprint(font_file_path)
+
+    def cached(self, font_file_path):
+        name, _, key = self.entry(font_file_path)
+        return not should_compute_font_features(self.store, name, key, self.force_recompute)
+
+    def add_cached_duplicates(self, font_file_paths):
+        """Let fonts with cached features whose fingerprint was computed beforehand be copied to their duplicates."""
+        for font_file_path in font_file_paths:
+            if self.cached(font_file_path):
+                self.duplicates.add(self.entry(font_file_path)[0], self.fingerprints.get(font_file_path))
+
+    def set_status(self, font_file_path, status):
+        self.statuses[font_file_path] = status
+        self.counts[status] += 1
+
+    def select(self, font_file_path):
+        """Decide whether a font is embedded, storing a copy of the features of a duplicate instead."""
+        name, ttf_sha256, key = self.entry(font_file_path)
+        if self.cached(font_file_path):
+            self.set_status(font_file_path, 'cached')
+            return False
+
+        fingerprint = self.fingerprint(font_file_path) if self.duplicates else None
+        canonical = self.duplicates.find(fingerprint, name) if self.duplicates else None
+        if canonical:
+            self.duplicates.reuse(font_file_path, canonical, ttf_sha256, key, fingerprint)
+            self.set_status(font_file_path, 'duplicate')
+            return False
+
+        self.misses[font_file_path] = (ttf_sha256, key, fingerprint)
+        if fingerprint in self.in_flight:
+            self.deferred[font_file_path] = fingerprint
+            return False
+        if fingerprint:
+            self.in_flight.add(fingerprint)
+        return True
+
+    def fonts_to_embed(self, font_file_paths):
+        """The fonts of an iterable of font files, which may still be growing, that have to be embedded."""
+        for font_file_path in font_file_paths:
+            try:
+                if self.select(font_file_path):
+                    yield font_file_path
+            except Exception as e:
+                print(f"\nAn error occurred while processing font {font_file_path} : {e}")
+                self.errors += 1
+            self.progress()
+
+    def embed(self, font_file_paths):
+        """Render and embed the fonts and store their features, saving the store index every STORE_SAVE_INTERVAL
+        embedded fonts."""
+        for font_file_path, features, glyph_density in fonts_features(font_file_paths, self.alphabet, self.texts,
+                                                                      self.batch_size, self.render_workers,
+                                                                      self.queue_size, self.stats, self.feature_mode,
+                                                                      self.projection, self.render_cache):
+            ttf_sha256, key, fingerprint = self.misses[font_file_path]
+            store_font_features(self.store, font_file_path, features, glyph_density, ttf_sha256, key, fingerprint)
+            if self.duplicates:
+                self.duplicates.add(font_store_name(*os.path.split(font_file_path)), fingerprint)
+            self.set_status(font_file_path, 'computed')
+
+            # Keep the index of an interrupted run close to the rows already written
+            if self.stats.fonts_completed % STORE_SAVE_INTERVAL == 0:
+                self.store.save()
+            self.progress()
+
+    def finish(self):
+        """Copy the features of embedded fonts to their waiting duplicates, and embed the duplicates of fonts that
+        failed."""
+        failed = []
+        for font_file_path, fingerprint in self.deferred.items():
+            canonical = self.duplicates.find(fingerprint)
+            if canonical:
+                self.duplicates.reuse(font_file_path, canonical, *self.misses[font_file_path])
+                self.set_status(font_file_path, 'duplicate')
+                self.progress()
+            else:
+                failed.append(font_file_path)
+        self.deferred = {}
+        if failed:
+            self.embed(failed)
+
+    def run(self, font_file_paths):
+        self.embed(self.fonts_to_embed(font_file_paths))
+        self.finish()
+
+    def failed(self):
+        return self.errors + self.stats.fonts_failed
+
+    def progress(self):
+        if self.on_progress:
+            self.on_progress(self)
+
+
+def open_feature_store(fonts_dir, info, path=None):
+    """Feature store of a font directory, emptied when its features were computed with other settings."""
+    # Features computed with other settings can not be mixed with the new ones
+    store = FeatureStore(fonts_dir, path)
+    if store.info != info:
+        store.reset(info)
+    return store
+
+
+def prune_font_features(store, font_file_paths):
+    """Drop the features of deleted fonts. Returns the names of the dropped fonts."""
+    font_names = {font_store_name(*os.path.split(font_file_path)) for font_file_path in font_file_paths}
+    pruned = [name for name in store.font_names() if name not in font_names]
+    for name in pruned:
+        store.remove(name)
+    return pruned
+
+
+def enumerate_font_files(fonts_dir):
+    """Enumerate (font directory, font file name) pairs of all .ttf fonts."""
+    font_files = []
     for font_name in os.listdir(fonts_dir):
         font_dir = os.path.join(fonts_dir, font_name)
         if os.path.isdir(font_dir):
             for font_file in os.listdir(font_dir):
                 if font_file.endswith('.ttf'):
-                    try:
-                        compute_font_features(font_dir, font_file, alphabet, texts, force_recompute)
-                    except Exception as e:
-                        print(f"\nAn error occurred while processing font {font_dir}/{font_file} : {e}")
+                    font_files.append((font_dir, font_file))
+    return font_files
+
+
+def font_pca_projection(fonts_dir, font_file_paths, alphabet, texts, n_components, sample_size,
+                        batch_size=DEFAULT_BATCH_SIZE, render_workers=DEFAULT_RENDER_WORKERS, render_cache=None):
+    """Load the PCA projection of a font directory, fitting it on a sample of fonts when it is missing or stale.
+
+    Fonts embedded with an earlier projection miss the feature cache, as the projection is part of their cache key.
+    """
+    projection_path = os.path.join(fonts_dir, PCA_PROJECTION_FILE_NAME)
+    projection = load_pca_projection(projection_path, alphabet, texts, n_components)
+    if projection is not None:
+        return projection
+
+    rng = np.random.default_rng(0)
+    sample = sorted(font_file_paths)
+    if len(sample) > sample_size:
+        sample = [sample[i] for i in sorted(rng.choice(len(sample), sample_size, replace=False))]
+
+    vectors = []
+    for font_file_path, features, _ in fonts_features(sample, alphabet, texts, batch_size, render_workers,
+                                                      feature_mode='meanpool', render_cache=render_cache):
+        print_line(f'Sampling fonts for PCA projection: {os.path.dirname(font_file_path)}')
+        vectors.append(features.reshape(len(alphabet) + len(texts), -1))
+    print()
+
+    projection = fit_pca_projection(np.concatenate(vectors), n_components)
+    save_pca_projection(projection_path, projection, alphabet, texts)
+    return projection
+
+
+def enumerate_fonts(fonts_dir, alphabet, texts, force_recompute, batch_size=DEFAULT_BATCH_SIZE,
+                    render_workers=DEFAULT_RENDER_WORKERS, queue_size=DEFAULT_RENDER_QUEUE_SIZE,
+                    feature_mode=DEFAULT_FEATURE_MODE, feature_dtype=DEFAULT_FEATURE_DTYPE,
+                    pca_components=DEFAULT_PCA_COMPONENTS, pca_sample=DEFAULT_PCA_SAMPLE, render_cache=None,
+                    dedup=True, fingerprint_workers=DEFAULT_FINGERPRINT_WORKERS, shard=None, shard_dir=None):
+    """Enumerate all .ttf font names and compute their features.
+
+    With dedup, fonts with the same outlines as another font get a copy of its features instead of being embedded.
+    With a shard (i, N), only the fonts of shard i of N are computed, into a store of the shard in the shard directory,
+    and a manifest of the status of each font is saved next to it.
+    """
+    font_files = enumerate_font_files(fonts_dir)
+
+    info = features_info(feature_mode, feature_dtype, alphabet, texts, pca_components,
+                         model_provider.provider().identity())
+    store_path = manifest = None
+    if shard:
+        store_path = shard_store_path(shard_dir or os.path.join(fonts_dir, SHARD_DIR_NAME), *shard)
+        manifest = ShardManifest(store_path, *shard, info)
+    store = open_feature_store(fonts_dir, info, store_path)
+
+    projection = None
+    if feature_mode == 'pca':
+        projection = font_pca_projection(fonts_dir, [os.path.join(*font_file) for font_file in font_files],
+                                         alphabet, texts, pca_components, pca_sample, batch_size, render_workers,
+                                         render_cache)
+    projection_hash = projection_sha256(projection)
+
+    # The projection is fitted on all fonts, the features of the shard's fonts only are computed
+    if shard:
+        font_files = shard_font_files(font_files, *shard)
+    font_file_paths = [os.path.join(font_dir, font_file) for font_dir, font_file in font_files]
+    pruned = prune_font_features(store, font_file_paths)
+
+    def report_progress(computation):
+        print_line(f"Computing font features: {computation.counts['computed']} computed, "
+                   f"{computation.counts['duplicate']} copied from duplicates, {computation.failed()} failed")
+
+    duplicates = None
+    if dedup:
+        duplicates = DuplicateIndex(store, alphabet, texts, feature_mode, projection_hash, stored=not force_recompute)
+    computation = FeatureComputation(store, alphabet, texts, force_recompute, batch_size, render_workers, queue_size,
+                                     feature_mode, projection, render_cache, duplicates, on_progress=report_progress)
+
+    # Fingerprints of all fonts are computed in worker processes once a font has to be embedded, so that fonts with
+    # cached features are found as duplicates as well
+    font_file_paths = sorted(font_file_paths)
+    if dedup and not all(computation.cached(font_file_path) for font_file_path in font_file_paths):
+        computation.fingerprints = duplicates.fingerprints(font_file_paths, fingerprint_workers)
+        computation.add_cached_duplicates(font_file_paths)
+
+    to_embed = list(computation.fonts_to_embed(font_file_paths))
+    hits = computation.counts['cached']
+    print(f'\nFeature cache: {hits} hits, {len(font_file_paths) - hits} misses, {len(pruned)} pruned')
+    computation.embed(to_embed)
+    computation.finish()
+    stats, statuses = computation.stats, computation.statuses
+
+    store.save()
+
+    if manifest:
+        for font_file_path in font_file_paths:
+            manifest.record(font_store_name(*os.path.split(font_file_path)), os.path.relpath(font_file_path, fonts_dir),
+                            computation.entries.get(font_file_path, (None, None, None))[1],
+                            statuses.get(font_file_path, 'failed'),
+                            stats.font_render_seconds.get(font_file_path), stats.font_errors.get(font_file_path))
+        manifest.save(stats, projection_hash)
 
     print()
+    stats.report()
+    if manifest:
+        print(f'Shard {shard[0]}/{shard[1]}: {len(font_file_paths)} fonts, '
+              f"{len(font_file_paths) - len(statuses)} failed; manifest saved to {manifest.path}")
+    if dedup:
+        print(f'Duplicate fonts: features of {duplicates.reused} fonts copied from fonts with the same outlines '
+              f'instead of computed')
 
 
 def main():
@@ -168,11 +558,52 @@ def main():
                         help='Characters for font comparisons in each font.')
     parser.add_argument('--texts', type=str, nargs='+', default=DEFAULT_FEATURES_TEXTS,
                         help='Array of texts for font comparisons.')
-    parser.add_argument('--force_features_recompute', type=bool, default=True,
-                        help='Force features recompute. Must be true unless font features characters, , font subsets, and font styles remain unchanged from the previous run')
+    parser.add_argument('--force_features_recompute', action='store_true',
+                        help='Recompute features of all fonts, including fonts whose features are cached.')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of images in one model forward pass. Batches span consecutive fonts; '
+                             'larger batches are faster, but their features can differ in the last bits.')
+    parser.add_argument('--render_workers', type=int, default=DEFAULT_RENDER_WORKERS,
+                        help='Number of rasterizer processes. 0 renders fonts in the inference process.')
+    parser.add_argument('--render_queue_size', type=int, default=DEFAULT_RENDER_QUEUE_SIZE,
+                        help='Maximum number of rendered fonts waiting for inference.')
+    parser.add_argument('--torch_threads', type=int, default=0,
+                        help='Number of threads used by the model. 0 keeps the backend default.')
+    parser.add_argument('--feature_mode', type=str, choices=FEATURE_MODES, default=DEFAULT_FEATURE_MODE,
+                        help='Features kept per image: all token features (full), the class token (cls), the mean of '
+                             'patch tokens (meanpool) or its PCA projection fitted on a sample of fonts (pca).')
+    parser.add_argument('--feature_dtype', type=str, choices=FEATURE_DTYPES, default=DEFAULT_FEATURE_DTYPE,
+                        help='Data type of stored features.')
+    parser.add_argument('--pca_components', type=int, default=DEFAULT_PCA_COMPONENTS,
+                        help='Number of PCA components per image in pca feature mode.')
+    parser.add_argument('--pca_sample', type=int, default=DEFAULT_PCA_SAMPLE,
+                        help='Number of fonts the PCA projection is fitted on.')
+    parser.add_argument('--no_render_cache', action='store_true',
+                        help='Render all fonts instead of reusing and caching rendered images in the render_cache '
+                             'directory of the font directory.')
+    parser.add_argument('--no_dedup', action='store_true',
+                        help='Compute the features of fonts with the same outlines as another font instead of copying '
+                             'its features.')
+    parser.add_argument('--fingerprint_workers', type=int, default=DEFAULT_FINGERPRINT_WORKERS,
+                        help='Number of processes computing outline fingerprints. 0 reads fonts in this process.')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Compute the features of shard i/N of the fonts only, e.g. 0/4, into a feature store of '
+                             'the shard. Combine the shards with "font-sort merge".')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help=f'Directory of the shard stores and manifests. Default is {SHARD_DIR_NAME} in the font '
+                             'directory.')
+    model_provider.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
-    enumerate_fonts(args.font_path, args.characters, args.texts, args.force_features_recompute)
+    model_provider.configure_from_arguments(parser, args, args.torch_threads)
+
+    with instrumentation.instrumented(args.profile, args.metrics_out):
+        enumerate_fonts(args.font_path, args.characters, args.texts, args.force_features_recompute, args.batch_size,
+                        args.render_workers, args.render_queue_size, args.feature_mode, args.feature_dtype,
+                        args.pca_components, args.pca_sample,
+                        None if args.no_render_cache else os.path.join(args.font_path, RENDER_CACHE_DIR_NAME),
+                        not args.no_dedup, args.fingerprint_workers, args.shard, args.shard_dir)
 
 
 if __name__ == "__main__":
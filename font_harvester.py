@@ -1,26 +1,49 @@
 import os
-import shutil
 import argparse
 import json
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from config import DEFAULT_FONT_PATH, DEFAULT_FONT_SUBSETS, DEFAULT_FONT_STYLES
+import instrumentation
+from config import DEFAULT_FONT_PATH, DEFAULT_FONT_SUBSETS, DEFAULT_FONT_STYLES, DEFAULT_FONTS_API_URL, \
+    DEFAULT_HARVEST_CONCURRENCY, DEFAULT_HARVEST_RETRIES, DEFAULT_HARVEST_BACKOFF, DEFAULT_HARVEST_TIMEOUT
 
 
-# Utility functions
-def fetch_font_list(api_key):
-    url = f'https://www.googleapis.com/webfonts/v1/webfonts?key={api_key}'
-    print(f'fetching font list from Google Fonts')
+DOWNLOADS_FILE_NAME = 'downloads.json'
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
 
-    response = requests.get(url)
+# Utility functions
+def create_session(concurrency=DEFAULT_HARVEST_CONCURRENCY, retries=DEFAULT_HARVEST_RETRIES):
+    """HTTP session shared by all downloads, keeping up to concurrency connections per host open and retrying
+    failed requests with exponential backoff."""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=DEFAULT_HARVEST_BACKOFF, status_forcelist=RETRY_STATUS_CODES,
+                  allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_font_list(api_key, session=None, api_url=DEFAULT_FONTS_API_URL):
+    print(f'fetching font list from {api_url}')
+
+    with instrumentation.timer('font_list'):
+        response = (session or requests).get(api_url, params={'key': api_key}, timeout=DEFAULT_HARVEST_TIMEOUT)
     response.raise_for_status()
     return response.json()['items']
 
 
 def save_json(data, path):
-    with open(path, 'w', encoding='utf-8') as f:
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(path + '.tmp', path)
 
 
 def load_json(path):
@@ -28,11 +51,103 @@ def load_json(path):
         return json.load(f)
 
 
-def download_file(url, path):
-    response = requests.get(url)
-    response.raise_for_status()
-    with open(path, 'wb') as f:
-        f.write(response.content)
+def is_unchanged(previous, metadata, path):
+    """Whether the file at path is the one described by the response headers in metadata."""
+    if previous.get('etag') or metadata.get('etag'):
+        return previous.get('etag') == metadata.get('etag')
+    return metadata.get('last_modified') is not None and previous.get('last_modified') == metadata['last_modified'] \
+        and metadata.get('content_length') is not None and os.path.getsize(path) == int(metadata['content_length'])
+
+
+def partial_download(url, path):
+    """Size and response headers of an interrupted download of url to path, None unless it can be resumed."""
+    temp_path = path + '.part'
+    if not os.path.exists(temp_path) or not os.path.exists(temp_path + '.json'):
+        return None
+    partial = load_json(temp_path + '.json')
+    if partial.get('url') != url or not (partial.get('etag') or partial.get('last_modified')):
+        return None
+    partial['size'] = os.path.getsize(temp_path)
+    return partial if partial['size'] else None
+
+
+def resumed_size(response, partial):
+    """Size of the partial download the response continues, or 0 when it holds the whole file."""
+    if response.status_code != 206:
+        return 0
+    content_range = response.headers.get('Content-Range', '')
+    if not content_range.startswith(f"bytes {partial['size']}-"):
+        raise IOError(f"Unexpected range {content_range!r} of {partial['url']}")
+    return partial['size']
+
+
+def fetch_file(url, path, session=None, previous=None):
+    """One attempt of download_file, continuing an interrupted download of the same file with a range request."""
+    previous = previous if previous and previous.get('url') == url and os.path.exists(path) else {}
+    headers = {}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+
+    # The server sends the rest of the file only if it did not change since the partial download, else all of it
+    partial = partial_download(url, path)
+    if partial:
+        headers['Range'] = f"bytes={partial['size']}-"
+        headers['If-Range'] = partial.get('etag') or partial['last_modified']
+
+    with (session or requests).get(url, headers=headers, stream=True, timeout=DEFAULT_HARVEST_TIMEOUT) as response:
+        if response.status_code == 304:
+            return previous, False
+        response.raise_for_status()
+
+        offset = resumed_size(response, partial)
+        content_length = response.headers.get('Content-Length')
+        if offset:
+            content_length = response.headers['Content-Range'].split('/')[-1]
+            content_length = None if content_length == '*' else content_length
+        metadata = {'url': url, 'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'content_length': content_length}
+        if previous and not offset and is_unchanged(previous, metadata, path):
+            return previous, False
+
+        temp_path = path + '.part'
+        save_json(metadata, temp_path + '.json')
+        size = offset
+        with instrumentation.timer('download'), open(temp_path, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(1 << 16):
+                f.write(chunk)
+                size += len(chunk)
+        instrumentation.count('bytes_downloaded', size - offset)
+
+        # Content-Length counts encoded bytes, compare it only when the body was not compressed
+        expected_size = metadata['content_length']
+        if expected_size is not None and 'Content-Encoding' not in response.headers and size != int(expected_size):
+            os.remove(temp_path)
+            os.remove(temp_path + '.json')
+            raise IOError(f'Incomplete download of {url}: {size} of {expected_size} bytes')
+        os.replace(temp_path, path)
+        os.remove(temp_path + '.json')
+
+    return metadata, True
+
+
+def download_file(url, path, session=None, previous=None, retries=DEFAULT_HARVEST_RETRIES):
+    """Stream a file to a temporary file that is renamed into place once it is complete.
+
+    A file whose ETag, or Last-Modified and Content-Length, match its previous download is not downloaded again. A
+    download interrupted after its headers, which the session does not retry, is continued from the partial file up to
+    retries times, and by a later harvest. Returns the download metadata of the file and whether it was
+    downloaded.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fetch_file(url, path, session, previous)
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+            if attempt == retries or not partial_download(url, path):
+                raise
+            time.sleep(DEFAULT_HARVEST_BACKOFF * 2 ** attempt)
 
 
 def font_file_name(variant, url):
@@ -50,7 +165,29 @@ def print_line(message):
     sys.stdout.write('\r' + message.ljust(terminal_width))
     sys.stdout.flush()
 
-def process_font_files(font, font_dir, styles):
+
+class HarvestStats:
+    """Counters of a harvest shared by the download threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fonts = 0
+        self.failed = 0
+        self.downloaded = 0
+        self.unchanged = 0
+
+    def add(self, counter, count=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + count)
+
+
+def process_font_files(font, font_dir, styles, session=None, stats=None):
+    """Download the font files of the requested styles, keeping the download metadata of each file next to them so
+    that an interrupted or repeated harvest skips files that are already complete and unchanged."""
+    downloads_path = os.path.join(font_dir, DOWNLOADS_FILE_NAME)
+    downloads = load_json(downloads_path) if os.path.exists(downloads_path) else {}
+
+    file_names = set()
     for variant, url in font['files'].items():
 
         if variant not in styles:
@@ -58,9 +195,21 @@ def process_font_files(font, font_dir, styles):
 
         file_name = font_file_name(variant, url)
         file_path = os.path.join(font_dir, file_name)
+        file_names.add(file_name)
 
         print_line(f"Downloading {file_name} for {font['family']}")
-        download_file(url, file_path)
+        downloads[file_name], downloaded = download_file(url, file_path, session, downloads.get(file_name))
+        save_json(downloads, downloads_path)
+        if stats:
+            stats.add('downloaded' if downloaded else 'unchanged')
+
+    # Remove files of earlier harvests that are no longer harvested
+    for file_name in set(downloads) - file_names:
+        file_path = os.path.join(font_dir, file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        del downloads[file_name]
+    save_json(downloads, downloads_path)
 
 
 def should_process_font(font, font_dir, subsets):
@@ -86,33 +235,48 @@ def should_process_font(font, font_dir, subsets):
     return False
 
 
-def harvest_font(font_info, font_dir, styles):
-    if os.path.exists(font_dir):
-        shutil.rmtree(font_dir)
+def harvest_font(font_info, font_dir, styles, session=None, stats=None):
+    # The info file marks a complete harvest of the font version it describes, remove it until the files of the new
+    # version are downloaded
+    json_path = os.path.join(font_dir, 'info.json')
+    if os.path.exists(json_path):
+        os.remove(json_path)
 
-    os.makedirs(font_dir)
-    process_font_files(font_info, font_dir, styles)
+    os.makedirs(font_dir, exist_ok=True)
+    process_font_files(font_info, font_dir, styles, session, stats)
 
     # To ensure idempotency during the harvesting process, the info file should be saved only after all font files
     # have been successfully processed. This prevents partial state persistence and allows for safe re-execution of
     # the harvesting without data corruption or inconsistency.
-    json_path = os.path.join(font_dir, 'info.json')
     save_json(font_info, json_path)
 
 
-def harvest_fonts(api_key, save_path, subsets, styles):
-    fonts = fetch_font_list(api_key)
+def harvest_fonts(api_key, save_path, subsets, styles, concurrency=DEFAULT_HARVEST_CONCURRENCY,
+                  retries=DEFAULT_HARVEST_RETRIES, api_url=DEFAULT_FONTS_API_URL):
+    """Harvest new and updated fonts, downloading up to concurrency font families at once over a shared session."""
+    session = create_session(concurrency, retries)
+    fonts = fetch_font_list(api_key, session, api_url)
+    pending = [(font, os.path.join(save_path, font['family'])) for font in fonts
+               if should_process_font(font, os.path.join(save_path, font['family']), subsets)]
+
+    stats = HarvestStats()
 
-    for font in fonts:
-        font_dir = os.path.join(save_path, font['family'])
+    def harvest(font, font_dir):
+        try:
+            harvest_font(font, font_dir, styles, session, stats)
+            stats.add('fonts')
+            instrumentation.count('fonts')
+        except Exception as e:
+            print(f"\nError harvesting font {font['family']}: {e}")
+            stats.add('failed')
 
-        if should_process_font(font, font_dir, subsets):
-            try:
-                harvest_font(font, font_dir, styles)
-            except Exception as e:
-                print(f"Error harvesting font {font['family']}: {e}")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for font, font_dir in pending:
+            executor.submit(harvest, font, font_dir)
 
     print()
+    print(f'Harvested {stats.fonts} fonts ({stats.downloaded} files downloaded, {stats.unchanged} unchanged), '
+          f'{stats.failed} failed, {len(fonts) - len(pending)} skipped')
 
 
 def main():
@@ -125,14 +289,23 @@ def main():
                         help='Harvest only certain font styles (e.g., regular, italic, bold).')
     parser.add_argument('--subset', type=str, nargs='+', default=DEFAULT_FONT_SUBSETS,
                         help='Harvest only subsets of fonts (e.g., latin).')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_HARVEST_CONCURRENCY,
+                        help='Number of font families downloaded at once.')
+    parser.add_argument('--retries', type=int, default=DEFAULT_HARVEST_RETRIES,
+                        help='Number of retries of a failed request, with exponential backoff.')
+    parser.add_argument('--api_url', type=str, default=DEFAULT_FONTS_API_URL,
+                        help='URL of the font list, e.g. of a local server with a copy of the Google Fonts list.')
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
 
-    if not args.api_key or args.api_key == 'your_google_fonts_api_key':
+    if args.api_url == DEFAULT_FONTS_API_URL and (not args.api_key or args.api_key == 'your_google_fonts_api_key'):
         parser.error(
             'The --api_key argument is required. Please provide a Google Fonts API key (see https://developers.google.com/fonts/docs/developer_api).')
 
-    harvest_fonts(args.api_key, args.save_path, args.subset, args.styles)
+    with instrumentation.instrumented(args.profile, args.metrics_out):
+        harvest_fonts(args.api_key, args.save_path, args.subset, args.styles, args.concurrency, args.retries,
+                      args.api_url)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+import hashlib
+import io
+import os
+import time
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import instrumentation
+from config import DEFAULT_IMAGE_SIZE
+
+
+RENDER_CACHE_DIR_NAME = 'render_cache'
+
+# Text is measured at this size to estimate the size at which it fits the image
+REFERENCE_FONT_SIZE = 100
+MIN_FONT_SIZE = 10
+
+
+#
+# font rendering
+#
+class FontFaces:
+    """Faces of one font file by size. The file is read once, and each size is loaded from memory once."""
+
+    def __init__(self, font_path):
+        with instrumentation.timer('ttf_read'), open(font_path, 'rb') as f:
+            self.data = f.read()
+        instrumentation.count('bytes_read', len(self.data))
+        self.faces = {}
+
+    def __call__(self, size):
+        face = self.faces.get(size)
+        if face is None:
+            with instrumentation.timer('ttf_parse'):
+                face = self.faces[size] = ImageFont.truetype(io.BytesIO(self.data), size)
+        return face
+
+
+def fitting_font_size(faces, draw, text, image_size, padding):
+    """Largest font size at which the text fits the image with padding, one less than the first size from 10 up
+    that does not fit.
+
+    The size is estimated from one measurement, as text extent grows linearly with size up to hinting, and then
+    corrected one size at a time.
+    """
+    def extent(size):
+        bbox = draw.textbbox((0, 0), text, font=faces(size))
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    def fits(size):
+        width, height = extent(size)
+        return width + padding <= image_size[0] and height + padding <= image_size[1]
+
+    width, height = extent(REFERENCE_FONT_SIZE)
+    scale = min((image_size[0] - padding) / width if width > 0 else np.inf,
+                (image_size[1] - padding) / height if height > 0 else np.inf)
+    size = max(int(REFERENCE_FONT_SIZE * scale) if np.isfinite(scale) else REFERENCE_FONT_SIZE, MIN_FONT_SIZE)
+
+    if fits(size):
+        while fits(size + 1):
+            size += 1
+        return size
+
+    while size > MIN_FONT_SIZE and not fits(size - 1):
+        size -= 1
+    return size - 1
+
+
+def generate_text_image(font_path, text, image_size=DEFAULT_IMAGE_SIZE, padding=10, faces=None):
+    if faces is None:
+        faces = FontFaces(font_path)
+
+    # Create the blank image and a draw object, also used to measure the text
+    font_image = Image.new('RGB', image_size, 'white')
+    draw = ImageDraw.Draw(font_image)
+
+    # Load the font with the largest size at which the text fits the image
+    font_pillow = faces(fitting_font_size(faces, draw, text, image_size, padding))
+
+    bbox = draw.textbbox((0, 0), text, font=font_pillow)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    x = (image_size[0] - text_width) / 2 - bbox[0]
+    y = (image_size[1] - text_height) / 2 - bbox[1]
+
+    # Draw the text on the image
+    draw.text((x, y), text, fill='black', font=font_pillow)
+
+    return font_image, text_width, text_height
+
+
+def calculate_glyph_density(font_image, text_width, text_height):
+    # Convert the image to grayscale and calculate the glyph density
+    grayscale_image = font_image.convert('L')
+    image_array = np.array(grayscale_image)
+    threshold = 240
+    non_background_pixels = np.sum(image_array < threshold)
+
+    # Calculate the bounding box area
+    bbox_area = text_width * text_height
+
+    # Glyph density is the ratio of non-background pixels to bounding box area
+    glyph_density = non_background_pixels / bbox_area if bbox_area > 0 else 0
+
+    return glyph_density
+
+
+#
+# cache of rendered images
+#
+def render_cache_path(cache_dir, ttf_sha256, image_size=DEFAULT_IMAGE_SIZE):
+    return os.path.join(cache_dir, f'{ttf_sha256}_{image_size[0]}x{image_size[1]}.npz')
+
+
+def load_rendered_images(cache_path):
+    """Rendered images of a font by text, as (grayscale uint8 array, text width, text height)."""
+    if not os.path.exists(cache_path):
+        return {}
+    instrumentation.count('bytes_read', os.path.getsize(cache_path))
+    try:
+        with instrumentation.timer('render_cache_read'), np.load(cache_path) as cache:
+            return {str(text): (image, int(width), int(height))
+                    for text, image, width, height in zip(cache['texts'], cache['images'], cache['widths'],
+                                                          cache['heights'])}
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_rendered_images(cache_path, rendered):
+    """Save rendered images compressed; text is drawn black on white, so one gray channel holds the RGB image."""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    texts = list(rendered)
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with instrumentation.timer('render_cache_write'), open(temp_path, 'wb') as f:
+        np.savez_compressed(f, texts=np.array(texts), images=np.stack([rendered[t][0] for t in texts]),
+                            widths=np.array([rendered[t][1] for t in texts]),
+                            heights=np.array([rendered[t][2] for t in texts]))
+    os.replace(temp_path, cache_path)
+
+
+def render_font_images(font_file_name, alphabet, texts, cache_dir=None):
+    """Render the glyph and text images of a font and compute its average glyph density.
+
+    With a cache directory, images are reused from and added to the font's render cache, keyed on the font file
+    content, text and image size, so that other models or feature modes do not render the font again.
+    """
+    faces = FontFaces(font_file_name)
+    rendered = {}
+    cache_path = None
+    if cache_dir:
+        cache_path = render_cache_path(cache_dir, hashlib.sha256(faces.data).hexdigest())
+        rendered = load_rendered_images(cache_path)
+    num_cached = len(rendered)
+
+    def text_image(text):
+        if text in rendered:
+            image, width, height = rendered[text]
+            return Image.fromarray(image).convert('RGB'), width, height
+
+        with instrumentation.timer('render_image'):
+            image, width, height = generate_text_image(font_file_name, text, faces=faces)
+        instrumentation.count('images_rendered')
+        rendered[text] = (np.asarray(image.convert('L')), width, height)
+        return image, width, height
+
+    images = []
+    glyph_densities = []
+
+    # Process each character in the alphabet
+    for char in alphabet:
+        char_img, char_width, char_height = text_image(char)
+        images.append(char_img)
+
+        glyph_density = calculate_glyph_density(char_img, char_width, char_height)
+        glyph_densities.append(glyph_density)
+
+    # Process each string in the text array
+    for txt in texts:
+        text_img, _, _ = text_image(txt)
+        images.append(text_img)
+
+    if cache_path and len(rendered) > num_cached:
+        save_rendered_images(cache_path, rendered)
+
+    # Calculate the average thickness ratio
+    average_glyph_density = np.mean(glyph_densities)
+
+    return images, average_glyph_density
+
+
+def render_font(font_file_name, alphabet, texts, cache_dir=None):
+    """Render a font into grayscale uint8 image arrays, a third of the RGB size to pass between processes.
+    Runs in rasterizer worker processes, hence no torch here."""
+    start = time.perf_counter()
+    images, average_glyph_density = render_font_images(font_file_name, alphabet, texts, cache_dir)
+    image_arrays = [np.asarray(img.convert('L')) for img in images]
+    return image_arrays, average_glyph_density, time.perf_counter() - start
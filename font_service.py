@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+import model_provider
+from config import DEFAULT_FONT_PATH, DEFAULT_PCA_COMPONENTS, DEFAULT_SERVICE_HOST, DEFAULT_SERVICE_PORT, \
+    DEFAULT_SERVICE_MAX_BATCH, DEFAULT_SERVICE_BATCH_WAIT, DEFAULT_SERVICE_MEMORY_BYTES, \
+    DEFAULT_SERVICE_MAX_FONT_BYTES, DEFAULT_SIMILAR_FONTS
+from feature_modes import PCA_PROJECTION_FILE_NAME, load_pca_projection
+from feature_store import FeatureStore
+from font_distance import DISTANCE_METRICS, distances_from_products, tile_columns
+
+
+def load_font_positions(font_list_path):
+    """Positions of the fonts in the sorted font list written by font_sort.py; empty when there is no list."""
+    if not os.path.exists(font_list_path):
+        return {}
+    with open(font_list_path, 'r') as f:
+        return {line.rstrip('\n'): i for i, line in enumerate(f)}
+
+
+class FontIndex:
+    """Features of all fonts of a feature store, loaded once and searched for the nearest fonts of query vectors.
+
+    Features that fit in memory_bytes are kept in memory as float32; larger stores stay memory mapped and are streamed
+    in column tiles once per batch of queries.
+    """
+
+    def __init__(self, font_directory, font_list_path, metric='euclidean', memory_bytes=DEFAULT_SERVICE_MEMORY_BYTES):
+        store = FeatureStore(font_directory)
+        self.font_directory = font_directory
+        self.info = store.info
+        self.metric = metric
+        self.font_names = store.font_names()
+        self.index = {name: i for i, name in enumerate(self.font_names)}
+        self.positions = load_font_positions(font_list_path)
+        self.rows = np.array(store.rows(self.font_names), dtype=np.int64)
+
+        matrix = store.matrix()
+        if len(self.rows) * matrix.shape[1] * 4 <= memory_bytes:
+            self.features = np.asarray(matrix[self.rows], dtype=np.float32)
+            self.rows = np.arange(len(self.rows))
+        else:
+            self.features = matrix
+        self.tile = tile_columns(len(self.rows), matrix.shape[1], np.float32)
+
+        self.squared_norms = np.zeros(len(self.rows), dtype=np.float32)
+        for start in range(0, matrix.shape[1], self.tile):
+            block = np.asarray(self.features[self.rows, start:start + self.tile], dtype=np.float32)
+            self.squared_norms += np.einsum('ij,ij->i', block, block)
+
+        self.embed_lock = threading.Lock()
+        self.projection = None
+
+    def __len__(self):
+        return len(self.font_names)
+
+    def vector(self, font):
+        return np.asarray(self.features[self.rows[font]], dtype=np.float32)
+
+    def nearest(self, queries, ks, excluded):
+        """Nearest fonts of each query vector, closest first, as lists of (font, distance).
+
+        One matrix product answers all queries; np.argpartition selects the k nearest fonts without sorting the rows.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        products = np.zeros((len(queries), len(self.rows)), dtype=np.float32)
+        for start in range(0, queries.shape[1], self.tile):
+            block = np.asarray(self.features[self.rows, start:start + self.tile], dtype=np.float32)
+            products += queries[:, start:start + self.tile] @ block.T
+        distances = distances_from_products(products, np.einsum('ij,ij->i', queries, queries), self.squared_norms,
+                                            self.metric)
+
+        results = []
+        for row, k, font in zip(distances, ks, excluded):
+            if font is not None:
+                row[font] = np.inf
+            k = min(k, len(row) - (font is not None))
+            if k <= 0:
+                results.append([])
+                continue
+            nearest = np.argpartition(row, k - 1)[:k]
+            nearest = nearest[np.argsort(row[nearest])]
+            results.append([(int(i), float(row[i])) for i in nearest])
+        return results
+
+    def embed(self, ttf_data):
+        """Features of an uploaded .ttf file, computed with the feature settings of the store."""
+        # The model is loaded with the first upload, queries by font name do not need it
+        from font_features import font_features
+
+        with self.embed_lock:
+            if self.info.get('feature_mode') == 'pca' and self.projection is None:
+                self.projection = load_pca_projection(os.path.join(self.font_directory, PCA_PROJECTION_FILE_NAME),
+                                                      self.info['characters'], self.info['texts'],
+                                                      self.info.get('pca_components', DEFAULT_PCA_COMPONENTS))
+
+            with tempfile.NamedTemporaryFile(suffix='.ttf', delete=False) as f:
+                f.write(ttf_data)
+            try:
+                features, _ = font_features(f.name, self.info['characters'], self.info['texts'],
+                                            feature_mode=self.info.get('feature_mode', 'full'),
+                                            projection=self.projection)
+            finally:
+                os.remove(f.name)
+        return features
+
+
+class QueryBatcher:
+    """Collect concurrent queries for up to max_wait seconds (or max_batch queries) and answer them together."""
+
+    def __init__(self, index, max_batch=DEFAULT_SERVICE_MAX_BATCH, max_wait=DEFAULT_SERVICE_BATCH_WAIT):
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.queries = 0
+        self.batches = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, vector, k, excluded=None):
+        future = Future()
+        self.queue.put((vector, k, excluded, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            vectors, ks, excluded, futures = zip(*batch)
+            try:
+                results = self.index.nearest(np.stack(vectors), ks, excluded)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.queries += len(batch)
+            self.batches += 1
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+class FontServer(ThreadingHTTPServer):
+    # Concurrent clients beyond the default backlog of 5 connections would wait for TCP retransmits
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def service_handler(index, batcher, max_k, max_font_bytes=DEFAULT_SERVICE_MAX_FONT_BYTES):
+    class FontServiceHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def query_k(self, query):
+            k = int(query.get('k', [DEFAULT_SIMILAR_FONTS])[0])
+            if not 0 < k <= max_k:
+                raise ValueError(f'k must be between 1 and {max_k}')
+            return k
+
+        def content_length(self):
+            length = self.headers.get('Content-Length')
+            if length is None or not length.strip().isdigit():
+                raise ValueError(f'Content-Length must be the size of the font file in bytes, got {length!r}')
+            return int(length)
+
+        def similar(self, font, vector, k):
+            neighbours = batcher.submit(vector, k, font).result()
+            return {'font': index.font_names[font] if font is not None else None,
+                    'position': index.positions.get(index.font_names[font]) if font is not None else None,
+                    'neighbours': [{'font': index.font_names[i], 'distance': distance,
+                                    'position': index.positions.get(index.font_names[i])}
+                                   for i, distance in neighbours]}
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/health':
+                self.send_json(200, {'fonts': len(index), 'queries': batcher.queries, 'batches': batcher.batches})
+            elif url.path == '/fonts':
+                self.send_json(200, {'fonts': index.font_names})
+            elif url.path == '/similar':
+                name = query.get('font', [None])[0]
+                if name not in index.index:
+                    self.send_json(404, {'error': f'Unknown font: {name}'})
+                    return
+                try:
+                    k = self.query_k(query)
+                except ValueError as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+                font = index.index[name]
+                self.send_json(200, self.similar(font, index.vector(font), k))
+            else:
+                self.send_json(404, {'error': f'Unknown path: {url.path}'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/similar':
+                self.send_json(404, {'error': f'Unknown path: {url.path}'})
+                return
+            try:
+                k = self.query_k(parse_qs(url.query))
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+
+            # The body of a rejected request is not read, close the connection instead of reading the next request
+            # from it
+            try:
+                length = self.content_length()
+            except ValueError as e:
+                self.close_connection = True
+                self.send_json(400, {'error': str(e)})
+                return
+            if length > max_font_bytes:
+                self.close_connection = True
+                self.send_json(413, {'error': f'Font files are limited to {max_font_bytes} bytes, got {length}'})
+                return
+
+            ttf_data = self.rfile.read(length)
+            try:
+                vector = index.embed(ttf_data)
+            except Exception as e:
+                self.send_json(422, {'error': f'Font could not be embedded: {e}'})
+                return
+            self.send_json(200, self.similar(None, vector, k))
+
+        def log_message(self, format, *args):
+            pass
+
+    return FontServiceHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve nearest-font queries over HTTP/JSON')
+    parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    parser.add_argument('--font_list', type=str, default='./ordered_fonts_list.txt',
+                        help='Sorted font list written by font_sort.py, for the positions of fonts.')
+    parser.add_argument('--metric', type=str, choices=DISTANCE_METRICS, default='euclidean',
+                        help='Distance between font features.')
+    parser.add_argument('--host', type=str, default=DEFAULT_SERVICE_HOST, help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVICE_PORT, help='Port to listen on.')
+    parser.add_argument('--max_batch', type=int, default=DEFAULT_SERVICE_MAX_BATCH,
+                        help='Maximum number of concurrent queries answered together.')
+    parser.add_argument('--batch_wait', type=float, default=DEFAULT_SERVICE_BATCH_WAIT,
+                        help='Seconds a query waits for other queries to join its batch.')
+    parser.add_argument('--max_k', type=int, default=100, help='Maximum number of similar fonts per query.')
+    parser.add_argument('--max_font_bytes', type=int, default=DEFAULT_SERVICE_MAX_FONT_BYTES,
+                        help='Maximum size of an uploaded font file.')
+    parser.add_argument('--preload_model', action='store_true',
+                        help='Load the model at startup instead of with the first uploaded font.')
+    model_provider.add_arguments(parser)
+    args = parser.parse_args()
+
+    model_provider.configure_from_arguments(parser, args)
+
+    start = time.perf_counter()
+    index = FontIndex(args.font_path, args.font_list, args.metric)
+    if model_provider.stored_model(index.info) != model_provider.provider().identity():
+        parser.error(f'The features of {args.font_path} were computed with other model settings: '
+                     f'{model_provider.stored_model(index.info) or "the defaults"}')
+    print(f'Loaded features of {len(index)} fonts in {time.perf_counter() - start:.1f} s, '
+          f'{len(index.positions)} font positions')
+    if args.preload_model:
+        model_provider.provider().load()
+
+    batcher = QueryBatcher(index, args.max_batch, args.batch_wait)
+    server = FontServer((args.host, args.port), service_handler(index, batcher, args.max_k, args.max_font_bytes))
+    print(f'Serving on http://{args.host}:{args.port}/similar?font=<font name>&k={DEFAULT_SIMILAR_FONTS}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
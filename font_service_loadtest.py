@@ -0,0 +1,57 @@
+import argparse
+import json
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from config import DEFAULT_SERVICE_HOST, DEFAULT_SERVICE_PORT, DEFAULT_SIMILAR_FONTS
+
+
+def get_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+def load_test(service_url, num_requests, concurrency, k, seed=0):
+    """Query the service for the similar fonts of random fonts from concurrent clients and report latency and QPS."""
+    font_names = get_json(f'{service_url}/fonts')['fonts']
+    health = get_json(f'{service_url}/health')
+    rng = np.random.default_rng(seed)
+    urls = [f'{service_url}/similar?' + urllib.parse.urlencode({'font': font_names[i], 'k': k})
+            for i in rng.integers(0, len(font_names), num_requests)]
+
+    def query(url):
+        start = time.perf_counter()
+        get_json(url)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(query, urls))) * 1000
+    wall_seconds = time.perf_counter() - start
+
+    after = get_json(f'{service_url}/health')
+    batches = after['batches'] - health['batches']
+    print(f'{num_requests} requests from {concurrency} clients, k={k}, {len(font_names)} fonts')
+    print(f'Latency: p50 {np.percentile(latencies, 50):.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms, '
+          f'max {latencies.max():.2f} ms')
+    print(f'Throughput: {num_requests / wall_seconds:.1f} queries/s, '
+          f'{(after["queries"] - health["queries"]) / max(batches, 1):.1f} queries per batch')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the font similarity service')
+    parser.add_argument('--url', type=str, default=f'http://{DEFAULT_SERVICE_HOST}:{DEFAULT_SERVICE_PORT}',
+                        help='Address of the running font_service.py.')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of queries.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients.')
+    parser.add_argument('--k', type=int, default=DEFAULT_SIMILAR_FONTS, help='Number of similar fonts per query.')
+    args = parser.parse_args()
+
+    load_test(args.url.rstrip('/'), args.requests, args.concurrency, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,46 @@
 import argparse
+import json
 import os
+import time
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
 
-from config import DEFAULT_FONT_PATH
+import instrumentation
+from config import DEFAULT_FONT_PATH, DEFAULT_DISTANCE_TILE_BYTES, DEFAULT_LOCAL_IMPROVEMENT_PASSES, \
+    DEFAULT_NEIGHBOURS, DEFAULT_IVF_PROBES, DEFAULT_SPECIMEN_PAGE_ROWS, DEFAULT_SPECIMEN_WORKERS, \
+    DEFAULT_CLUSTER_WORKERS, DEFAULT_RESTARTS, DEFAULT_RESTART_WORKERS, DEFAULT_RESTART_SEED
+from ann_index import IVFIndex, FeatureDistances
+from feature_store import FeatureStore
+from font_dedup import load_duplicate_groups, expand_duplicates
+from font_distance import DISTANCE_METRICS, DISTANCE_DTYPES, gram_matrix, pairwise_distances, cross_distances
+from path_search import improve_path, nearest_neighbours, mst_weight, insertion_costs, relocate_first_improvement
+from path_construct import greedy_edge_path, mst_preorder_path, hilbert_curve_path
+from path_cluster import sort_fonts_hierarchical
+from path_multistart import multistart_font_path
+from specimen import write_specimen
 
 
-def load_fonts(font_directory):
-    """Load feature vectors and densities for all fonts in the specified directory."""
-    feature_files = []
-    ttf_files = []
-    font_names = []
-    font_densities = []
+SORT_STATE_DIR_NAME = 'sort_state'
+SORT_STATE_INDEX_FILE_NAME = 'state.json'
+SORT_STATE_MATRIX_FILE_NAME = 'distances.npy'
+
+# Fraction of spare slots of the sort state's distance matrix, so that new fonts rarely make it grow
+SORT_STATE_SPARE_SLOTS = 0.25
 
-    for root, _, files in os.walk(font_directory):
-        for file in files:
-            if file.endswith('.ttf'):
-                ttf_file_path = os.path.join(root, file)
-                feature_file_path = ttf_file_path + '.features.npy'
-                density_file_path = ttf_file_path + '.density'
 
-                if os.path.exists(feature_file_path) and os.path.exists(density_file_path):
-                    font_name = f"{os.path.basename(root)}_{os.path.splitext(file)[0]}"
-                    feature_files.append(feature_file_path)
-                    ttf_files.append(ttf_file_path)
-                    font_names.append(font_name)
+def load_fonts(font_directory):
+    """Load the feature matrix and densities of all fonts in the feature store of the specified directory.
 
-                    with open(density_file_path, 'r') as f:
-                        font_density = float(f.readline().strip())
-                    font_densities.append(font_density)
+    The feature matrix is memory mapped; features of font i are in its row rows[i].
+    """
+    store = FeatureStore(font_directory)
+    print(f"Detected {store.info.get('feature_mode', 'full')} features stored as {store.dtype}")
 
-    return feature_files, ttf_files, font_names, font_densities
+    font_names = store.font_names()
+    rows = store.rows(font_names)
+    ttf_files = [store.ttf_path(name) for name in font_names]
+    font_densities = [store.densities[row] for row in rows]
+
+    return store.matrix(), rows, ttf_files, font_names, font_densities
 
 
 def save_font_list(font_names, ordered_indices, list_path):
@@ -57,7 +67,8 @@ def filter_fonts_by_groups(densities, ordered_indices, thresholds):
     return groups
 
 
-def create_image_with_text(ttf_files, font_names, font_indices, text, image_path, display_font_name):
+def create_image_with_text(ttf_files, font_names, font_indices, text, image_path, display_font_name,
+                           page_rows=DEFAULT_SPECIMEN_PAGE_ROWS, workers=DEFAULT_SPECIMEN_WORKERS):
     # Try to find the specified font name in the font_names list
     if display_font_name in font_names:
         name_font_index = font_names.index(display_font_name)
@@ -65,42 +76,29 @@ def create_image_with_text(ttf_files, font_names, font_indices, text, image_path
         # If not found, choose the median font index
         name_font_index = font_indices[len(font_indices) // 2]
 
-    # Get the font for displaying font names
-    display_font = ImageFont.truetype(ttf_files[name_font_index], 20)
-
-    # Create a new image
-    num_fonts = len(font_indices)
-    line_height = 50  # Height of each line
-    image_height = num_fonts * line_height  # Total height of the image
-    image_width = 1200  # Width of the image
-    image = Image.new('RGB', (image_width, image_height), 'white')
-    draw = ImageDraw.Draw(image)
+    # Render the specimen in pages of page_rows fonts, so that memory does not grow with the number of fonts
+    write_specimen(ttf_files, font_names, font_indices, text, image_path, ttf_files[name_font_index], page_rows,
+                   workers)
 
-    # Draw the text for each font
-    for i, idx in enumerate(font_indices):
-        font_path = ttf_files[idx]
-        specimen_font = ImageFont.truetype(font_path, 20)
-        y_position = i * line_height
-        draw.text((10, y_position), font_names[idx].removesuffix('_regular'), font=display_font, fill='black')
-        draw.text((400, y_position), text, font=specimen_font, fill='black')
 
-    # Save the image
-    image.save(image_path)
-
-
-def closest_fonts(font_name, font_names, distance_matrix, n=5):
-    """Display the names of the n closest fonts to the given font_name."""
+def closest_fonts(font_name, font_names, distance_matrix=None, n=5, neighbours=None):
+    """Display the names of the n closest fonts to the given font_name, from the distance matrix or from the
+    nearest-neighbour lists of the sparse mode."""
     try:
         index = font_names.index(font_name)
     except ValueError:
         print(f"Font name '{font_name}' not found in the list of font names.")
         return
 
-    # Get distances for the specified font
-    distances = distance_matrix[index]
+    if neighbours is not None:
+        # Neighbour lists are ordered closest first and exclude the font itself
+        closest_indices = neighbours[index][:n]
+    else:
+        # Get distances for the specified font
+        distances = distance_matrix[index]
 
-    # Get indices of the closest fonts (excluding the font itself)
-    closest_indices = np.argsort(distances)[1:n+1]
+        # Get indices of the closest fonts (excluding the font itself)
+        closest_indices = np.argsort(distances)[1:n+1]
 
     # Display the names of the closest fonts
     closest_font_names = [font_names[i] for i in closest_indices]
@@ -117,33 +115,13 @@ def path_length(ordered_indices, distance_matrix):
     return total_length
 
 
-def load_features(file_path):
-    """Load feature vectors from a .npy file."""
-    try:
-        features = np.load(file_path)
-        return features
-    except Exception as e:
-        print(f"Error loading features from {file_path}: {e}")
-        return None
-
-
-def euclidean_distance(features1, features2):
-    return np.linalg.norm(features1 - features2)
-
+def calculate_distance_matrix(features, rows, metric='euclidean', tile_size=None, dtype='float64'):
+    """Calculate the pairwise distance matrix of font features, reading the feature matrix once in column tiles."""
+    def progress(column, dim):
+        print(f'Calculating font distance matrix {100 * column // dim} %', end='\r', flush=True)
 
-def calculate_distance_matrix(feature_files):
-    """Calculate the pairwise cosine distance matrix by loading features as needed."""
-    num_fonts = len(feature_files)
-    distance_matrix = np.zeros((num_fonts, num_fonts))
-    for i in range(num_fonts):
-        print(f'Calculating font distance matrix {i}/{num_fonts}', end='\r', flush=True)
-
-        features_i = load_features(feature_files[i])
-        for j in range(i + 1, num_fonts):
-            features_j = load_features(feature_files[j])
-            dist = euclidean_distance(features_i, features_j)
-            distance_matrix[i, j] = dist
-            distance_matrix[j, i] = dist
+    gram = gram_matrix(features, rows, dtype, tile_size, progress)
+    distance_matrix = pairwise_distances(gram, metric)
 
     print('Calculating font distance matrix completed')
     return distance_matrix
@@ -151,76 +129,419 @@ def calculate_distance_matrix(feature_files):
 
 def optimized_font_path(distance_matrix):
     """Create a font path starting with the most distant pair of fonts and extending with the closest neighbor."""
-    def closest_neighbor(current_font):
-        closest_font = None
-        min_distance = float('inf')
-        for neighbor in remaining_fonts:
-            if distance_matrix[current_font, neighbor] < min_distance:
-                min_distance = distance_matrix[current_font, neighbor]
-                closest_font = neighbor
-        return closest_font
-
     num_fonts = len(distance_matrix)
-    remaining_fonts = set(range(num_fonts))
+    if num_fonts == 0:
+        return []
 
-    # Find the most distant pair of fonts
-    max_distance = -1
-    start_font = None
-
-    for i in range(num_fonts):
-        for j in range(i + 1, num_fonts):
-            if distance_matrix[i, j] > max_distance:
-                max_distance = distance_matrix[i, j]
-                start_font = i
+    # Find the most distant pair of fonts, the first one in row-major order of the upper triangle
+    start_font = int(np.argmax(np.triu(distance_matrix, k=1))) // num_fonts
 
     # Initialize the path with one of the most distant fonts
     path = [start_font]
-    remaining_fonts.remove(start_font)
+    visited = np.zeros(num_fonts, dtype=bool)
+    visited[start_font] = True
 
-    # Extend the path with the closest neighbor of the current end node
+    # Extend the path with the closest unvisited neighbor of the current end node
     current_font = start_font
-    while remaining_fonts:
-        print(f'Optimizing font path {100 *  (num_fonts - len(remaining_fonts)) // num_fonts} %', end='\r', flush=True)
+    progress_step = max(num_fonts // 100, 1)
+    for step in range(1, num_fonts):
+        if step % progress_step == 0:
+            print(f'Optimizing font path {100 * step // num_fonts} %', end='\r', flush=True)
 
-        next_font = closest_neighbor(current_font)
-        path.append(next_font)
-        remaining_fonts.remove(next_font)
-        current_font = next_font
+        current_font = int(np.argmin(np.where(visited, np.inf, distance_matrix[current_font])))
+        path.append(current_font)
+        visited[current_font] = True
 
     print(f'Optimizing font path completed')
     return path
 
 
-def improve_font_path(ordered_indices, distance_matrix):
-    """Try to move each font to another position to shorten the path."""
+CONSTRUCTIONS = {
+    'greedy': optimized_font_path,
+    'greedy_edge': greedy_edge_path,
+    'mst': mst_preorder_path,
+    'hilbert': hilbert_curve_path,
+}
+
+
+def construct_font_path(distance_matrix, construct='greedy'):
+    """Create the initial font path with one of the construction heuristics."""
+    return CONSTRUCTIONS[construct](distance_matrix)
+
+
+def benchmark_constructions(distance_matrix, improve_seconds=None, neighbours=DEFAULT_NEIGHBOURS):
+    """Compare path length and wall time of the construction heuristics, before and after path improvement."""
+    results = []
+    for construct in CONSTRUCTIONS:
+        start = time.perf_counter()
+        path = construct_font_path(distance_matrix, construct)
+        construct_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        improved = improve_path(path, distance_matrix.item, nearest_neighbours(distance_matrix, neighbours),
+                                time_budget=improve_seconds, distance_matrix=distance_matrix)[0]
+        improve_seconds_spent = time.perf_counter() - start
+        results.append((construct, path_length(path, distance_matrix), construct_seconds,
+                        path_length(improved, distance_matrix), improve_seconds_spent))
+
+    print(f"\n{'construction':<14}{'length':>12}{'time (s)':>10}{'improved':>12}{'time (s)':>10}")
+    for construct, length, construct_seconds, improved_length, improve_seconds_spent in results:
+        print(f'{construct:<14}{length:>12.2f}{construct_seconds:>10.2f}{improved_length:>12.2f}'
+              f'{improve_seconds_spent:>10.2f}')
+
+
+def improve_font_path(ordered_indices, distance_matrix, time_budget=None, target_gap=None,
+                      neighbours=DEFAULT_NEIGHBOURS):
+    """Shorten the path with 2-opt and Or-opt local search over the nearest neighbours of each font.
+
+    The search stops at a local optimum (which is also a local optimum of moving single fonts anywhere in the path),
+    after time_budget seconds, or when the path is within target_gap of the minimum spanning tree lower bound.
+    Moves only shorten the path, so the result is never longer than the input. Without a time budget or target gap,
+    the relocation search of earlier versions also runs from the input and the shorter path is kept: the two searches
+    end in different local optima, and the result is never longer than the one of earlier versions either.
+    """
+    lower_bound = mst_weight(distance_matrix) if target_gap is not None else None
+    path, history = improve_path(ordered_indices, distance_matrix.item, nearest_neighbours(distance_matrix, neighbours),
+                                 time_budget=time_budget, target_gap=target_gap, lower_bound=lower_bound,
+                                 distance_matrix=distance_matrix)
+    print_path_history(history, lower_bound)
+
+    if time_budget is None and target_gap is None:
+        relocated = relocate_first_improvement(ordered_indices, distance_matrix)
+        if path_length(relocated, distance_matrix) < path_length(path, distance_matrix):
+            print(f'Relocation search found a shorter path: {path_length(relocated, distance_matrix):.2f}')
+            path = relocated
+    return path
+
+
+def print_path_history(history, lower_bound=None):
+    print('\nPath length progress:')
+    for elapsed, length in history:
+        gap = f', gap to lower bound {100 * (length - lower_bound) / lower_bound:.2f} %' if lower_bound else ''
+        print(f'{elapsed:8.1f} s  {length:.2f}{gap}')
+
+
+#
+# sparse sorting from a nearest-neighbour graph
+#
+def optimized_sparse_font_path(neighbours, index):
+    """Create a font path from neighbour lists, extending it with the closest unvisited neighbour.
 
-    def calculate_path_length(path):
-        return sum(distance_matrix[path[i], path[i + 1]] for i in range(len(path) - 1))
+    The path starts at the font farthest from the first font. When all neighbours of the end node are visited, the
+    index is searched for the closest unvisited font.
+    """
+    num_fonts = len(neighbours)
+    if num_fonts == 0:
+        return []
 
-    best_path = ordered_indices[:]
-    best_length = calculate_path_length(best_path)
-    improved = True
+    neighbours = neighbours.tolist()
+    visited = np.zeros(num_fonts, dtype=bool)
+    unvisited_per_list = np.array([len(fonts) for fonts in index.lists])
 
-    while improved:
-        improved = False
-        for i in range(len(best_path)):
-            for j in range(len(best_path)):
-                if i == j:
-                    continue
-                new_path = best_path[:i] + best_path[i + 1:]
-                new_path.insert(j, best_path[i])
-                new_length = calculate_path_length(new_path)
-                if new_length < best_length:
-                    best_path = new_path
-                    best_length = new_length
-                    improved = True
-                    print(f'Trying to improve solution: moved font from position {i} to {j}, new best path length: {best_length:.2f}        ', end='\r', flush=True)
-                    break  # Break out of the inner loop to restart the process with the new best path
+    current_font = index.farthest(0)
+    path = [current_font]
+    visited[current_font] = True
+    unvisited_per_list[index.assignment[current_font]] -= 1
 
-    return best_path
+    progress_step = max(num_fonts // 100, 1)
+    searches = 0
+    for step in range(1, num_fonts):
+        if step % progress_step == 0:
+            print(f'Optimizing font path {100 * step // num_fonts} %', end='\r', flush=True)
 
+        next_font = next((font for font in neighbours[current_font] if not visited[font]), None)
+        if next_font is None:
+            next_font = index.nearest_unvisited(current_font, visited, unvisited_per_list)
+            searches += 1
+
+        current_font = next_font
+        path.append(current_font)
+        visited[current_font] = True
+        unvisited_per_list[index.assignment[current_font]] -= 1
+
+    print(f'Optimizing font path completed, {searches} index searches')
+    return path
+
+
+def sort_fonts_sparse(features, rows, metric='euclidean', tile_size=None, dtype='float64',
+                      neighbours=DEFAULT_NEIGHBOURS, num_lists=None, num_probes=DEFAULT_IVF_PROBES, time_budget=None):
+    """Sort fonts from the k-NN graph of an approximate nearest-neighbour index, in O(n * k) memory."""
+    with instrumentation.timer('ann_index'):
+        index = IVFIndex(features, rows, num_lists, num_probes, metric, dtype, tile_size)
+    with instrumentation.timer('knn_graph'):
+        graph, graph_distances = index.knn_graph(neighbours)
+    distances = FeatureDistances(features, rows, graph, graph_distances, metric, dtype)
+
+    with instrumentation.timer('construct'):
+        path = optimized_sparse_font_path(graph, index)
+    print(f'Font path computed. Final path length: {path_length(path, distances):.2f}')
+
+    with instrumentation.timer('improve'):
+        path, history = improve_path(path, distances, graph, time_budget=time_budget)
+    print_path_history(history)
+    print(f'\nImproved font path computed. Final path length: {path_length(path, distances):.2f}')
+    return path
+
+
+def benchmark_hierarchical(features, rows, construct='greedy', metric='euclidean', tile_size=None, dtype='float64',
+                           neighbours=DEFAULT_NEIGHBOURS, num_clusters=None, workers=DEFAULT_CLUSTER_WORKERS,
+                           time_budget=None):
+    """Compare path length and wall time of sorting from the full distance matrix and sorting by clusters.
+
+    Returns the path sorted by clusters.
+    """
+    start = time.perf_counter()
+    distance_matrix = calculate_distance_matrix(features, rows, metric, tile_size, dtype)
+    path = improve_path(construct_font_path(distance_matrix, construct), distance_matrix.item,
+                        nearest_neighbours(distance_matrix, neighbours), time_budget=time_budget,
+                        distance_matrix=distance_matrix)[0]
+    full_seconds = time.perf_counter() - start
+    full_length = path_length(path, distance_matrix)
+    del distance_matrix
+
+    start = time.perf_counter()
+    path, distances = sort_fonts_hierarchical(features, rows, CONSTRUCTIONS[construct], metric, tile_size, dtype,
+                                              neighbours, num_clusters, workers, time_budget)
+    hierarchical_seconds = time.perf_counter() - start
+    hierarchical_length = path_length(path, distances)
+
+    print(f"\n{'solver':<14}{'length':>12}{'time (s)':>10}")
+    print(f"{'full matrix':<14}{full_length:>12.2f}{full_seconds:>10.2f}")
+    print(f"{'hierarchical':<14}{hierarchical_length:>12.2f}{hierarchical_seconds:>10.2f}")
+    penalty = 100 * (hierarchical_length - full_length) / full_length
+    print(f'Path length penalty of hierarchical sorting: {penalty:.2f} %')
+    return path
 
-def save_data(path, font_names, font_densities, ttf_files):
+
+#
+# incremental sorting
+#
+def load_font_keys(font_directory, font_names):
+    """Feature settings of the feature store and the cache keys of the fonts' features."""
+    store = FeatureStore(font_directory)
+    return store.info, [store.fonts[name].get('key', store.fonts[name]['sha256']) for name in font_names]
+
+
+def sort_state_settings(features_info, metric, distance_dtype='float64'):
+    return json.dumps({'features': features_info, 'metric': metric, 'distance_dtype': distance_dtype}, sort_keys=True)
+
+
+def load_sort_state(font_directory, settings):
+    """Load the sort state of the previous run, unless it was sorted with other settings.
+
+    The distance matrix is memory mapped and indexed by slot: row and column i hold the distances of font_names[i],
+    which is None for a free slot. The path and font keys are by slot as well.
+    """
+    state_dir = os.path.join(font_directory, SORT_STATE_DIR_NAME)
+    index_path = os.path.join(state_dir, SORT_STATE_INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if state['settings'] != settings:
+        return None
+    state['distance_matrix'] = np.load(os.path.join(state_dir, SORT_STATE_MATRIX_FILE_NAME), mmap_mode='r+')
+    # An interrupted update may have added slots to the index before the matrix grew
+    if len(state['font_names']) > len(state['distance_matrix']):
+        return None
+    return state
+
+
+def save_sort_state_index(font_directory, settings, font_names, font_keys, path):
+    index_path = os.path.join(font_directory, SORT_STATE_DIR_NAME, SORT_STATE_INDEX_FILE_NAME)
+    with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'settings': settings, 'font_names': font_names, 'font_keys': font_keys,
+                   'path': [int(slot) for slot in path]}, f)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def write_sort_state_matrix(font_directory, distance_matrix, num_slots, block_rows=1024):
+    """Write the distances of the first slots into a new matrix file with spare slots, block by block, and return it
+    memory mapped."""
+    capacity = num_slots + int(num_slots * SORT_STATE_SPARE_SLOTS)
+    matrix_path = os.path.join(font_directory, SORT_STATE_DIR_NAME, SORT_STATE_MATRIX_FILE_NAME)
+    matrix = np.lib.format.open_memmap(matrix_path + '.tmp', mode='w+', dtype=distance_matrix.dtype,
+                                       shape=(capacity, capacity))
+    size = len(distance_matrix)
+    for start in range(0, size, block_rows):
+        end = min(start + block_rows, size)
+        matrix[start:end, :size] = distance_matrix[start:end]
+    matrix.flush()
+    del matrix
+    os.replace(matrix_path + '.tmp', matrix_path)
+    return np.load(matrix_path, mmap_mode='r+')
+
+
+def save_sort_state(font_directory, settings, font_names, font_keys, distance_matrix, path):
+    """Save the distance matrix and font path of a full sort as the sort state, with the fonts in slot order."""
+    state_dir = os.path.join(font_directory, SORT_STATE_DIR_NAME)
+    os.makedirs(state_dir, exist_ok=True)
+
+    # The index of the previous matrix is removed first, so that an interrupted save leaves no sort state
+    index_path = os.path.join(state_dir, SORT_STATE_INDEX_FILE_NAME)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    write_sort_state_matrix(font_directory, distance_matrix, len(font_names))
+    save_sort_state_index(font_directory, settings, list(font_names), list(font_keys), path)
+
+
+def assign_sort_slots(state, font_names, font_keys):
+    """Slots of the fonts in the sort state: fonts of the previous run keep their slot, new fonts take the slots of
+    removed fonts and then new slots. Returns the font names and keys by slot and the slots of new or changed fonts."""
+    previous = {name: slot for slot, name in enumerate(state['font_names']) if name is not None}
+    slot_names = [None] * len(state['font_names'])
+    slot_keys = [None] * len(state['font_names'])
+    changed, new = [], []
+    for name, key in zip(font_names, font_keys):
+        slot = previous.get(name)
+        if slot is None:
+            new.append((name, key))
+            continue
+        slot_names[slot], slot_keys[slot] = name, key
+        if state['font_keys'][slot] != key:
+            changed.append(slot)
+
+    free = [slot for slot, name in enumerate(slot_names) if name is None]
+    for (name, key), slot in zip(new, free + list(range(len(slot_names), len(slot_names) + len(new)))):
+        if slot == len(slot_names):
+            slot_names.append(None)
+            slot_keys.append(None)
+        slot_names[slot], slot_keys[slot] = name, key
+        changed.append(slot)
+    return slot_names, slot_keys, sorted(changed)
+
+
+def update_distance_matrix(distance_matrix, features, slot_rows, changed, metric='euclidean', tile_size=None,
+                           dtype='float64'):
+    """Compute the rows and columns of the slots of new or changed fonts in place. slot_rows holds the feature row of
+    the font in each slot, None for a free slot. Distances between unchanged fonts are neither read nor written."""
+    if not changed:
+        return
+    live = [slot for slot, row in enumerate(slot_rows) if row is not None]
+    distances = cross_distances(features, [slot_rows[slot] for slot in changed], [slot_rows[slot] for slot in live],
+                                metric, dtype, tile_size)
+    distance_matrix[np.ix_(changed, live)] = distances
+    distance_matrix[np.ix_(live, changed)] = distances.T
+
+    changed_distances = distance_matrix[np.ix_(changed, changed)]
+    distance_matrix[np.ix_(changed, changed)] = (changed_distances + changed_distances.T) / 2
+    distance_matrix[changed, changed] = 0
+
+
+def insert_font(path, font, distance_matrix):
+    """Insert a font at the position of the path where it adds the least length."""
+    if not path:
+        return [font]
+    path.insert(int(np.argmin(insertion_costs(path, font, distance_matrix))), font)
+    return path
+
+
+def improve_font_path_locally(path, distance_matrix, fonts, max_passes=DEFAULT_LOCAL_IMPROVEMENT_PASSES):
+    """Move the given fonts, and the fonts next to any moved font, to their cheapest positions in the path.
+
+    Each pass costs O(number of candidate fonts * n), independent of the fonts that did not change.
+    """
+    candidates = set(fonts)
+    for _ in range(max_passes):
+        if len(path) < 3:
+            break
+
+        moved = set()
+        for font in candidates:
+            position = path.index(font)
+            previous_font = path[position - 1] if position > 0 else None
+            next_font = path[position + 1] if position < len(path) - 1 else None
+
+            # Length saved by taking the font out of the path
+            if previous_font is None:
+                gain = distance_matrix[font, next_font]
+            elif next_font is None:
+                gain = distance_matrix[previous_font, font]
+            else:
+                gain = distance_matrix[previous_font, font] + distance_matrix[font, next_font] - \
+                    distance_matrix[previous_font, next_font]
+
+            rest = path[:position] + path[position + 1:]
+            costs = insertion_costs(rest, font, distance_matrix)
+            new_position = int(np.argmin(costs))
+            if costs[new_position] < gain - 1e-12:
+                rest.insert(new_position, font)
+                path = rest
+                moved.update(f for f in (font, previous_font, next_font) if f is not None)
+                moved.update(path[max(new_position - 1, 0):new_position + 2])
+
+        if not moved:
+            break
+        candidates = moved
+
+    return path
+
+
+def update_font_path(state, font_names, changed, distance_matrix, max_passes=DEFAULT_LOCAL_IMPROVEMENT_PASSES):
+    """Update the previous font path: drop deleted fonts, insert new and changed fonts at their cheapest positions
+    and improve the path around them."""
+    index = {name: i for i, name in enumerate(font_names)}
+    changed_set = set(changed)
+
+    path = []
+    touched = set(changed)
+    gap = False
+    for previous_font in state['path']:
+        font = index.get(state['font_names'][previous_font])
+        if font is None or font in changed_set:
+            # The fonts around a removed font get a new neighbour
+            if path:
+                touched.add(path[-1])
+            gap = True
+            continue
+        if gap:
+            touched.add(font)
+            gap = False
+        path.append(font)
+
+    for font in changed:
+        path = insert_font(path, font, distance_matrix)
+
+    return improve_font_path_locally(path, distance_matrix, touched, max_passes)
+
+
+def update_sort_state(font_directory, state, settings, features, rows, font_names, font_keys, metric='euclidean',
+                      tile_size=None, dtype='float64', max_passes=DEFAULT_LOCAL_IMPROVEMENT_PASSES):
+    """Update the sort state of the previous run to the fonts and return their path, as indices into font_names.
+
+    Only the distances of new or changed fonts are computed and written into the memory-mapped distance matrix, and
+    the path is only improved around them, so an update reads and writes O(changed fonts * n) distances. The matrix
+    is copied whole only when new fonts outgrow its spare slots.
+    """
+    slot_names, slot_keys, changed = assign_sort_slots(state, font_names, font_keys)
+    removed = len(set(state['font_names']) - set(font_names) - {None})
+
+    # Until their distances are written, the index holds no keys for the slots of new or changed fonts, so that an
+    # interrupted update computes them again
+    changed_slots = set(changed)
+    save_sort_state_index(font_directory, settings, slot_names,
+                          [None if slot in changed_slots else key for slot, key in enumerate(slot_keys)], state['path'])
+    distance_matrix = state['distance_matrix']
+    if len(slot_names) > len(distance_matrix):
+        distance_matrix = write_sort_state_matrix(font_directory, distance_matrix, len(slot_names))
+
+    index = {name: i for i, name in enumerate(font_names)}
+    slot_rows = [rows[index[name]] if name is not None else None for name in slot_names]
+    with instrumentation.timer('distance_matrix'):
+        update_distance_matrix(distance_matrix, features, slot_rows, changed, metric, tile_size, dtype)
+    print(f'Distance matrix updated: {len(changed)} new or changed fonts, {removed} removed fonts')
+
+    with instrumentation.timer('improve'):
+        path = update_font_path(state, slot_names, changed, distance_matrix, max_passes)
+    print(f'Font path updated. Final path length: {path_length(path, distance_matrix):.2f}')
+    distance_matrix.flush()
+    save_sort_state_index(font_directory, settings, slot_names, slot_keys, path)
+    return [index[slot_names[slot]] for slot in path]
+
+
+def save_data(path, font_names, font_densities, ttf_files, page_rows=DEFAULT_SPECIMEN_PAGE_ROWS,
+              workers=DEFAULT_SPECIMEN_WORKERS):
     save_font_list(font_names, path, './ordered_fonts_list.txt')
 
     # Calculate density groups of fonts
@@ -235,34 +556,204 @@ def save_data(path, font_names, font_densities, ttf_files):
     for i in range(len(glyph_density_groups) + 1):
         group_indices = groups[i]
         if group_indices:
-            create_image_with_text(ttf_files, font_names, group_indices, text, f'font_samples_{i + 1}_{sample_file_name[i]}', 'Open Sans_regular')
+            create_image_with_text(ttf_files, font_names, group_indices, text, f'font_samples_{i + 1}_{sample_file_name[i]}', 'Open Sans_regular',
+                                   page_rows, workers)
         else:
             print(f"No fonts in group {i + 1}")
 
     image_path = 'font_list_samples_all.png'
-    create_image_with_text(ttf_files, font_names, path, text, image_path, 'Open Sans_regular')
+    create_image_with_text(ttf_files, font_names, path, text, image_path, 'Open Sans_regular', page_rows, workers)
     print('font specimen files saved')
 
 
-def main():
-
+def sort_argument_parser():
     parser = argparse.ArgumentParser(description='Sort fonts based in visual similarity')
     parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
-    args = parser.parse_args()
-
-    feature_files, ttf_files, font_names, font_densities = load_fonts(args.font_path)
+    parser.add_argument('--metric', type=str, choices=DISTANCE_METRICS, default='euclidean',
+                        help='Distance between font features.')
+    parser.add_argument('--tile_size', type=int, default=None,
+                        help='Number of feature columns of all fonts read at once. By default a tile takes about '
+                             f'{DEFAULT_DISTANCE_TILE_BYTES >> 20} MB.')
+    parser.add_argument('--distance_dtype', type=str, choices=DISTANCE_DTYPES, default='float64',
+                        help='Precision of distance computation. float32 is faster, float64 keeps distances of '
+                             'nearly identical fonts exact.')
+    parser.add_argument('--construct', type=str, choices=list(CONSTRUCTIONS), default='greedy',
+                        help='Construction heuristic of the initial font path.')
+    parser.add_argument('--benchmark_construct', action='store_true',
+                        help='Compare path length and wall time of all construction heuristics before sorting.')
+    parser.add_argument('--improve_seconds', type=float, default=None,
+                        help='Time budget of the path improvement in seconds. By default it runs to a local optimum.')
+    parser.add_argument('--target_gap', type=float, default=None,
+                        help='Stop the path improvement when the path is within this fraction (e.g. 0.05) of the '
+                             'minimum spanning tree lower bound.')
+    parser.add_argument('--neighbours', type=int, default=DEFAULT_NEIGHBOURS,
+                        help='Number of nearest neighbours per font considered by the path improvement.')
+    parser.add_argument('--restarts', type=int, default=DEFAULT_RESTARTS,
+                        help='Number of paths improved: the constructed path and paths of the nearest-neighbour '
+                             'construction from random start fonts. The shortest one is kept.')
+    parser.add_argument('--restart_workers', type=int, default=DEFAULT_RESTART_WORKERS,
+                        help='Number of processes improving restarts. 0 improves them in the sorting process.')
+    parser.add_argument('--seed', type=int, default=DEFAULT_RESTART_SEED,
+                        help='Seed of the start fonts of the restarts.')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Sort from an approximate k-NN graph instead of the full distance matrix, in O(n * k) '
+                             'memory.')
+    parser.add_argument('--ivf_lists', type=int, default=None,
+                        help='Number of lists of the nearest-neighbour index of the sparse mode. Default is the '
+                             'square root of the number of fonts.')
+    parser.add_argument('--ivf_probes', type=int, default=DEFAULT_IVF_PROBES,
+                        help='Number of index lists searched for the neighbours of a font in the sparse mode.')
+    parser.add_argument('--hierarchical', action='store_true',
+                        help='Split the fonts into k-means clusters, sort the clusters in parallel processes and join '
+                             'their paths. Memory holds the distance matrices of the clusters only.')
+    parser.add_argument('--clusters', type=int, default=None,
+                        help='Number of clusters of the hierarchical mode. By default a cluster has about 500 fonts; '
+                             'larger clusters are split again.')
+    parser.add_argument('--cluster_workers', type=int, default=DEFAULT_CLUSTER_WORKERS,
+                        help='Number of processes sorting clusters in the hierarchical mode. 0 sorts them in the '
+                             'sorting process.')
+    parser.add_argument('--benchmark_hierarchical', action='store_true',
+                        help='Compare path length and wall time of the hierarchical mode with sorting from the full '
+                             'distance matrix.')
+    parser.add_argument('--specimen_page_rows', type=int, default=DEFAULT_SPECIMEN_PAGE_ROWS,
+                        help='Number of fonts per specimen page.')
+    parser.add_argument('--specimen_workers', type=int, default=DEFAULT_SPECIMEN_WORKERS,
+                        help='Number of processes rendering specimen pages. 0 renders in the sorting process.')
+    parser.add_argument('--full_resort', action='store_true',
+                        help='Sort all fonts from scratch instead of updating the distance matrix and font path of '
+                             'the previous run. --construct, --benchmark_construct, --restarts, --improve_seconds '
+                             'and --target_gap also sort from scratch.')
+    parser.add_argument('--local_passes', type=int, default=DEFAULT_LOCAL_IMPROVEMENT_PASSES,
+                        help='Maximum number of local improvement passes around new and changed fonts.')
+    parser.add_argument('--keep_duplicates', action='store_true',
+                        help='Sort fonts with the same outlines as separate fonts instead of placing them next to each '
+                             'other.')
+    instrumentation.add_arguments(parser)
+    return parser
+
+
+def sort_fonts(args):
+    """Sort the fonts of a font directory with the arguments of sort_argument_parser, and save the sorted font list,
+    the sort state and the font specimens."""
+    with instrumentation.timer('load_fonts'):
+        features, rows, ttf_files, font_names, font_densities = load_fonts(args.font_path)
+    instrumentation.count('fonts', len(font_names))
     print('Loaded font names, files, and densities')
 
-    distance_matrix = calculate_distance_matrix(feature_files)
-    print('\nDistance matrix computed')
+    # Fonts with the same outlines have the same features and are sorted as one font
+    if args.keep_duplicates:
+        groups = [[i] for i in range(len(font_names))]
+    else:
+        groups = load_duplicate_groups(args.font_path, font_names)
+    sort_rows = [rows[group[0]] for group in groups]
+    sort_names = [font_names[group[0]] for group in groups]
+    if len(groups) < len(font_names):
+        print(f'{len(font_names) - len(groups)} duplicate fonts sorted next to the font with the same outlines, '
+              f'{len(font_names) ** 2 - len(groups) ** 2} distance matrix cells saved')
+
+    if args.sparse:
+        print('Sort mode: sparse sort from an approximate k-nearest-neighbour graph, without sort state')
+        path = sort_fonts_sparse(features, sort_rows, args.metric, args.tile_size, args.distance_dtype,
+                                 args.neighbours, args.ivf_lists, args.ivf_probes, args.improve_seconds)
+        with instrumentation.timer('specimen'):
+            save_data(expand_duplicates(path, groups), font_names, font_densities, ttf_files, args.specimen_page_rows,
+                      args.specimen_workers)
+        return
+
+    if args.hierarchical:
+        print('Sort mode: hierarchical sort by clusters, without sort state')
+        if args.benchmark_hierarchical:
+            path = benchmark_hierarchical(features, sort_rows, args.construct, args.metric, args.tile_size,
+                                          args.distance_dtype, args.neighbours, args.clusters, args.cluster_workers,
+                                          args.improve_seconds)
+        else:
+            path, distances = sort_fonts_hierarchical(features, sort_rows, CONSTRUCTIONS[args.construct],
+                                                      args.metric, args.tile_size, args.distance_dtype, args.neighbours,
+                                                      args.clusters, args.cluster_workers, args.improve_seconds)
+            print(f'\nFont path computed. Final path length: {path_length(path, distances):.2f}')
+        with instrumentation.timer('specimen'):
+            save_data(expand_duplicates(path, groups), font_names, font_densities, ttf_files, args.specimen_page_rows,
+                      args.specimen_workers)
+        return
+
+    features_info, font_keys = load_font_keys(args.font_path, sort_names)
+    settings = sort_state_settings(features_info, args.metric, args.distance_dtype)
+    resort_flags = full_resort_flags(args)
+    with instrumentation.timer('sort_state_read'):
+        state = None if resort_flags else load_sort_state(args.font_path, settings)
+
+    if state is None:
+        if resort_flags:
+            print(f"Sort mode: full sort, requested by {', '.join(resort_flags)}")
+        else:
+            print('Sort mode: full sort, no sort state of the same feature settings, metric and distance dtype')
+        with instrumentation.timer('distance_matrix'):
+            distance_matrix = calculate_distance_matrix(features, sort_rows, args.metric, args.tile_size,
+                                                        args.distance_dtype)
+        print('\nDistance matrix computed')
+
+        if args.benchmark_construct:
+            benchmark_constructions(distance_matrix, args.improve_seconds, args.neighbours)
+
+        with instrumentation.timer('construct'):
+            path = construct_font_path(distance_matrix, args.construct)
+        print(f'Font path computed. Final path length: {path_length(path, distance_matrix):.2f}')
+
+        with instrumentation.timer('improve'):
+            if args.restarts > 1:
+                path = multistart_font_path(path, distance_matrix, args.restarts, args.restart_workers, args.seed,
+                                            args.neighbours, args.improve_seconds)
+            else:
+                path = improve_font_path(path, distance_matrix, args.improve_seconds, args.target_gap,
+                                         args.neighbours)
+        print(f'\nImproved font path computed. Final path length: {path_length(path, distance_matrix):.2f}')
+        with instrumentation.timer('sort_state_write'):
+            save_sort_state(args.font_path, settings, sort_names, font_keys, distance_matrix, path)
+    else:
+        print('Sort mode: incremental update of the previous font path')
+        path = update_sort_state(args.font_path, state, settings, features, sort_rows, sort_names, font_keys,
+                                 args.metric, args.tile_size, args.distance_dtype, args.local_passes)
+
+    with instrumentation.timer('specimen'):
+        save_data(expand_duplicates(path, groups), font_names, font_densities, ttf_files, args.specimen_page_rows,
+                  args.specimen_workers)
+
+
+def full_resort_flags(args):
+    """Arguments that sort all fonts from scratch instead of updating the previous font path: --full_resort, and the
+    construction and improvement settings, which an incremental update does not use."""
+    flags = {'--full_resort': args.full_resort, '--construct': args.construct != 'greedy',
+             '--benchmark_construct': args.benchmark_construct, '--restarts': args.restarts > 1,
+             '--improve_seconds': args.improve_seconds is not None, '--target_gap': args.target_gap is not None}
+    return [flag for flag, given in flags.items() if given]
+
+
+def validate_sort_arguments(parser, args, feature_mode=None):
+    """Report combinations of the arguments of sort_argument_parser that sort_fonts does not support as errors of
+    the parser, before any fonts are loaded. The feature mode is read from the feature store unless given."""
+    if feature_mode is None:
+        feature_mode = FeatureStore(args.font_path).info.get('feature_mode', 'full')
+    # Distances off the k-NN graph are computed from two feature rows, tens of MB each with full features
+    if args.sparse and feature_mode == 'full':
+        parser.error('--sparse needs cls, meanpool or pca features, compute them with font_features.py '
+                     '--feature_mode')
+    if args.sparse and (args.construct != 'greedy' or args.benchmark_construct or args.target_gap is not None):
+        parser.error('--sparse supports the greedy construction only, without --benchmark_construct and --target_gap')
+    if args.hierarchical and (args.sparse or args.benchmark_construct or args.target_gap is not None):
+        parser.error('--hierarchical cannot be combined with --sparse, --benchmark_construct and --target_gap')
+    if args.benchmark_hierarchical and not args.hierarchical:
+        parser.error('--benchmark_hierarchical needs --hierarchical')
+    if args.restarts > 1 and (args.sparse or args.hierarchical or args.target_gap is not None):
+        parser.error('--restarts cannot be combined with --sparse, --hierarchical and --target_gap')
 
-    path = optimized_font_path(distance_matrix)
-    print(f'Font path computed. Final path length: {path_length(path, distance_matrix):.2f}')
 
-    path = improve_font_path(path, distance_matrix)
-    print(f'\nImproved font path computed. Final path length: {path_length(path, distance_matrix):.2f}')
+def main():
+    parser = sort_argument_parser()
+    args = parser.parse_args()
+    validate_sort_arguments(parser, args)
 
-    save_data(path, font_names, font_densities, ttf_files)
+    with instrumentation.instrumented(args.profile, args.metrics_out):
+        sort_fonts(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fontTools.pens.areaPen import AreaPen
+from fontTools.pens.boundsPen import BoundsPen
+from fontTools.ttLib import TTFont
+
+from config import DEFAULT_FONT_PATH, DEFAULT_FEATURES_CHARACTERS, DEFAULT_DENSITY_WORKERS, \
+    DEFAULT_DENSITY_CALIBRATION_SAMPLE
+from feature_store import font_store_name
+from font_features import enumerate_font_files
+from font_render import generate_text_image, calculate_glyph_density, FontFaces
+
+
+DENSITY_GROUP_NAMES = ['featherweight', 'thin', 'regular', 'bold']
+DENSITY_LIST_FILE_NAME = 'font_densities.txt'
+
+
+#
+# outline area
+#
+def contour_neighbours(contour_ids):
+    """Indices of the next and previous point of every point along its closed contour."""
+    num_points = len(contour_ids)
+    starts = np.flatnonzero(np.r_[True, contour_ids[1:] != contour_ids[:-1]])
+    ends = np.r_[starts[1:], num_points] - 1
+    following = np.arange(1, num_points + 1)
+    following[ends] = starts
+    previous = np.arange(-1, num_points - 1)
+    previous[starts] = ends
+    return following, previous
+
+
+def contour_areas(points, on_curve, contour_ids, num_contours):
+    """Signed areas of TrueType contours of quadratic curves, all contours at once.
+
+    Two consecutive off-curve points imply an on-curve point between them, which is inserted first. A line from P0 to
+    P2 then adds P0 x P2 / 2 to the area and a quadratic curve with control point C adds
+    [2/3 (P0 x C + C x P2) + 1/3 (P0 x P2)] / 2, the shoelace formula integrated along the curve.
+    """
+    following, _ = contour_neighbours(contour_ids)
+    implied = np.flatnonzero(~on_curve & ~on_curve[following])
+    if len(implied):
+        points = np.insert(points, implied + 1, (points[implied] + points[following[implied]]) / 2, axis=0)
+        on_curve = np.insert(on_curve, implied + 1, True)
+        contour_ids = np.insert(contour_ids, implied + 1, contour_ids[implied])
+    following, previous = contour_neighbours(contour_ids)
+
+    def cross(a, b):
+        return points[a, 0] * points[b, 1] - points[a, 1] * points[b, 0]
+
+    indices = np.arange(len(points))
+    weights = np.where(on_curve & on_curve[following], 1.0, 2 / 3)
+    off_curve = np.flatnonzero(~on_curve)
+    areas = np.bincount(contour_ids, weights * cross(indices, following), minlength=num_contours)
+    areas += np.bincount(contour_ids[off_curve], cross(previous[off_curve], following[off_curve]) / 3,
+                         minlength=num_contours)
+    return areas / 2
+
+
+def text_box_area(font, glyph_name, x_min, y_min, x_max, y_max):
+    """Area of the box a glyph is measured in when rendered: from the origin to the advance width, or to the ink
+    where it extends further, and the height of the ink, like Pillow's textbbox."""
+    advance = font['hmtx'][glyph_name][0]
+    return (max(advance, x_max) - min(0, x_min)) * (y_max - y_min)
+
+
+def glyf_densities(font, glyph_names):
+    """Ink coverage of the text box of each glyph of a TrueType outline font."""
+    glyf = font['glyf']
+    points, on_curve, contour_ids, contour_glyphs = [], [], [], []
+    bbox_areas = np.zeros(len(glyph_names))
+    num_contours = 0
+    for i, glyph_name in enumerate(glyph_names):
+        glyph = glyf[glyph_name]
+        coordinates, end_points, flags = glyph.getCoordinates(glyf)
+        if not end_points:
+            continue
+        bbox_areas[i] = text_box_area(font, glyph_name, glyph.xMin, glyph.yMin, glyph.xMax, glyph.yMax)
+        counts = np.diff(np.r_[-1, end_points])
+        points.append(np.array(coordinates.array, dtype=np.float64).reshape(-1, 2))
+        on_curve.append(np.frombuffer(bytes(flags), dtype=np.uint8) & 1 == 1)
+        contour_ids.append(np.repeat(np.arange(num_contours, num_contours + len(counts)), counts))
+        contour_glyphs.extend([i] * len(counts))
+        num_contours += len(counts)
+
+    if not num_contours:
+        return bbox_areas
+    areas = contour_areas(np.concatenate(points), np.concatenate(on_curve), np.concatenate(contour_ids), num_contours)
+    # Outer contours and holes run in opposite directions, so the signed areas of a glyph add up to its ink
+    glyph_areas = np.abs(np.bincount(contour_glyphs, areas, minlength=len(glyph_names)))
+    return np.divide(glyph_areas, bbox_areas, out=np.zeros(len(glyph_names)), where=bbox_areas > 0)
+
+
+def pen_densities(font, glyph_names):
+    """Ink coverage of the text boxes of the glyphs of fonts without a glyf table, e.g. with CFF outlines."""
+    glyph_set = font.getGlyphSet()
+    densities = np.zeros(len(glyph_names))
+    for i, glyph_name in enumerate(glyph_names):
+        area_pen, bounds_pen = AreaPen(glyph_set), BoundsPen(glyph_set)
+        glyph_set[glyph_name].draw(area_pen)
+        glyph_set[glyph_name].draw(bounds_pen)
+        if bounds_pen.bounds:
+            box_area = text_box_area(font, glyph_name, *bounds_pen.bounds)
+            if box_area > 0:
+                densities[i] = abs(area_pen.value) / box_area
+    return densities
+
+
+def outline_density(font_file_name, alphabet=DEFAULT_FEATURES_CHARACTERS):
+    """Average glyph density of a font computed from its glyph outlines, without rendering.
+
+    Like the rendered density, it is the ink area of each character relative to its text box, averaged over the
+    alphabet; characters missing from the font use its .notdef glyph, as rendering does.
+    """
+    with TTFont(font_file_name, lazy=True) as font:
+        cmap = font.getBestCmap() or {}
+        glyph_names = [cmap.get(ord(char), '.notdef') for char in alphabet]
+        if 'glyf' in font:
+            densities = glyf_densities(font, glyph_names)
+        else:
+            densities = pen_densities(font, glyph_names)
+    return float(np.mean(densities))
+
+
+def raster_density(font_file_name, alphabet=DEFAULT_FEATURES_CHARACTERS):
+    """Average glyph density of a font from its rendered characters, as computed with the font features."""
+    faces = FontFaces(font_file_name)
+    densities = []
+    for char in alphabet:
+        image, width, height = generate_text_image(font_file_name, char, faces=faces)
+        densities.append(calculate_glyph_density(image, width, height))
+    return float(np.mean(densities))
+
+
+def safe_density(density, font_file_name, alphabet):
+    try:
+        return density(font_file_name, alphabet)
+    except Exception as e:
+        print(f"\nAn error occurred while processing font {font_file_name} : {e}")
+        return None
+
+
+def font_densities(font_file_names, alphabet=DEFAULT_FEATURES_CHARACTERS, workers=DEFAULT_DENSITY_WORKERS,
+                   density=outline_density):
+    """Densities of fonts computed in a process pool, None for fonts that could not be read."""
+    arguments = ([density] * len(font_file_names), font_file_names, [alphabet] * len(font_file_names))
+    if workers > 0 and len(font_file_names) > 1:
+        chunk_size = max(len(font_file_names) // (4 * workers), 1)
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(safe_density, *arguments, chunksize=chunk_size))
+    return list(map(safe_density, *arguments))
+
+
+#
+# density groups
+#
+def density_groups(densities):
+    """Quartile group of each density, as in the font specimens of font_sort.py."""
+    thresholds = np.percentile(densities, [25, 50, 75])
+    return np.searchsorted(thresholds, densities, side='left')
+
+
+def ranks(values):
+    """Ranks of values from 0, tied values sharing their mean rank."""
+    values = np.asarray(values)
+    order = np.argsort(values, kind='stable')
+    ordered = values[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    result = np.empty(len(values))
+    result[order] = np.repeat((starts + ends - 1) / 2, ends - starts)
+    return result
+
+
+def spearman_correlation(a, b):
+    """Spearman rank correlation of two samples."""
+    return float(np.corrcoef(ranks(a), ranks(b))[0, 1])
+
+
+def calibration_report(font_file_names, alphabet=DEFAULT_FEATURES_CHARACTERS, workers=DEFAULT_DENSITY_WORKERS):
+    """Compare outline densities with rendered densities on the same fonts: rank correlation, agreement of the
+    quartile groups and time per font."""
+    start = time.perf_counter()
+    outline = font_densities(font_file_names, alphabet, workers)
+    outline_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    raster = font_densities(font_file_names, alphabet, workers, raster_density)
+    raster_seconds = time.perf_counter() - start
+
+    valid = [i for i in range(len(font_file_names)) if outline[i] is not None and raster[i] is not None]
+    outline = np.array([outline[i] for i in valid])
+    raster = np.array([raster[i] for i in valid])
+    if len(valid) < 2:
+        print('Calibration needs at least two readable fonts')
+        return
+
+    print(f'\nCalibration on {len(valid)} fonts')
+    print(f'Outline density: {1000 * outline_seconds / len(font_file_names):.2f} ms per font, '
+          f'rendered density: {1000 * raster_seconds / len(font_file_names):.2f} ms per font '
+          f'({raster_seconds / outline_seconds:.0f}x)')
+    print(f'Spearman rank correlation: {spearman_correlation(outline, raster):.4f}')
+    print(f'Same quartile group: {100 * np.mean(density_groups(outline) == density_groups(raster)):.1f} % of fonts')
+    print(f'Mean density: outline {outline.mean():.4f}, rendered {raster.mean():.4f}')
+
+
+def save_font_densities(font_file_paths, densities, list_path):
+    """Write the name, density and quartile group of each font, ordered by density."""
+    fonts = [(font_store_name(*os.path.split(path)), density) for path, density in zip(font_file_paths, densities)
+             if density is not None]
+    fonts.sort(key=lambda font: font[1])
+    groups = density_groups([density for _, density in fonts]) if fonts else []
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for (name, density), group in zip(fonts, groups):
+            f.write(f'{name}\t{density:.6f}\t{DENSITY_GROUP_NAMES[group]}\n')
+    return len(fonts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute glyph densities of fonts from their outlines, without '
+                                                 'rendering, and group the fonts by density quartiles')
+    parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    parser.add_argument('--characters', type=str, default=DEFAULT_FEATURES_CHARACTERS,
+                        help='Characters whose densities are averaged.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_DENSITY_WORKERS,
+                        help='Number of processes reading fonts. 0 reads them in this process.')
+    parser.add_argument('--output', type=str, default=DENSITY_LIST_FILE_NAME,
+                        help='Text file of font names, densities and density groups.')
+    parser.add_argument('--calibrate', type=int, nargs='?', const=DEFAULT_DENSITY_CALIBRATION_SAMPLE, default=None,
+                        help='Compare outline densities with rendered densities on a fixed sample of this many fonts '
+                             f'(default {DEFAULT_DENSITY_CALIBRATION_SAMPLE}) instead of computing all densities.')
+    args = parser.parse_args()
+
+    font_file_paths = sorted(os.path.join(*font_file) for font_file in enumerate_font_files(args.font_path))
+    if args.calibrate is not None:
+        sample = font_file_paths
+        if len(sample) > args.calibrate:
+            rng = np.random.default_rng(0)
+            sample = [sample[i] for i in sorted(rng.choice(len(sample), args.calibrate, replace=False))]
+        calibration_report(sample, args.characters, args.workers)
+        return
+
+    start = time.perf_counter()
+    densities = font_densities(font_file_paths, args.characters, args.workers)
+    num_fonts = save_font_densities(font_file_paths, densities, args.output)
+    print(f'Densities of {num_fonts} fonts computed in {time.perf_counter() - start:.1f} s, '
+          f'{len(font_file_paths) - num_fonts} fonts failed; saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
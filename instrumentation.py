@@ -0,0 +1,141 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Timers and counters are recorded only while instrumentation is enabled; when disabled, timer() returns a shared
+# no-op context manager and count() returns at once
+_enabled = False
+_trace_events = None
+_lock = threading.Lock()
+_start_time = time.perf_counter()
+_null_timer = contextlib.nullcontext()
+
+timers = {}  # name -> [number of calls, seconds]
+counters = {}  # name -> count
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.perf_counter() - self.start, self.start)
+
+
+def enable(trace=False):
+    """Start recording timers and counters, and trace events of every timed call when trace is set."""
+    global _enabled, _trace_events, _start_time
+    _enabled = True
+    _trace_events = [] if trace else None
+    _start_time = time.perf_counter()
+    timers.clear()
+    counters.clear()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def timer(name):
+    """Context manager adding the time spent in its block to the timer of the given name."""
+    return _Timer(name) if _enabled else _null_timer
+
+
+def add_time(name, seconds, start=None, calls=1):
+    """Add time measured elsewhere, e.g. by a worker process, to a timer."""
+    if not _enabled:
+        return
+    with _lock:
+        timer_total = timers.setdefault(name, [0, 0.0])
+        timer_total[0] += calls
+        timer_total[1] += seconds
+        if _trace_events is not None and start is not None:
+            _trace_events.append({'name': name, 'ph': 'X', 'ts': (start - _start_time) * 1e6, 'dur': seconds * 1e6,
+                                  'pid': os.getpid(), 'tid': threading.get_ident()})
+
+
+def count(name, amount=1):
+    if not _enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process and of its finished child processes, or None without resource."""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def summary():
+    """Run summary: wall time, timers, counters, throughput and peak memory."""
+    wall_seconds = time.perf_counter() - _start_time
+    peak_rss, peak_rss_children = peak_rss_bytes()
+    rates = {f'{name}_per_second': counters[name] / wall_seconds
+             for name in ('fonts', 'images') if name in counters and wall_seconds > 0}
+    return {'wall_seconds': wall_seconds,
+            'timers': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in sorted(timers.items())},
+            'counters': dict(sorted(counters.items())), **rates,
+            'peak_rss_bytes': peak_rss, 'peak_rss_children_bytes': peak_rss_children}
+
+
+def write_trace(path):
+    """Write the timed calls as Chrome trace events, viewable in chrome://tracing or Perfetto."""
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': _trace_events or [], 'displayTimeUnit': 'ms'}, f)
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Profile the run into this file: Chrome trace events of the instrumented stages for a '
+                             '.json file, otherwise a cProfile dump for pstats.')
+    parser.add_argument('--metrics_out', type=str, default=None,
+                        help='Write a JSON summary of the run: time per stage, fonts/s, images/s, bytes read and '
+                             'peak memory.')
+
+
+@contextlib.contextmanager
+def instrumented(profile_path=None, metrics_path=None):
+    """Record the run in its block when profile_path or metrics_path is given, and write them when it ends."""
+    if not profile_path and not metrics_path:
+        yield
+        return
+
+    trace = profile_path is not None and profile_path.endswith('.json')
+    profiler = cProfile.Profile() if profile_path and not trace else None
+    enable(trace)
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        disable()
+        if trace:
+            write_trace(profile_path)
+        if metrics_path:
+            with open(metrics_path, 'w') as f:
+                json.dump(summary(), f, indent=1)
@@ -0,0 +1,243 @@
+import os
+import numpy as np
+
+import instrumentation
+from feature_store import file_sha256
+from config import DEFAULT_MODEL_NAME, DEFAULT_MODEL_BACKEND, DEFAULT_MODEL_DIR, DEFAULT_MODEL_PRECISION, \
+    DEFAULT_IMAGE_SIZE
+
+
+MODEL_BACKENDS = ['torch', 'torchscript', 'onnx']
+
+# fp32 is exact; bf16 runs under CPU autocast, int8 quantizes the weights of linear layers dynamically
+MODEL_PRECISIONS = ['fp32', 'bf16', 'int8']
+BACKEND_PRECISIONS = {'torch': ['fp32', 'bf16', 'int8'], 'torchscript': ['fp32', 'int8'], 'onnx': ['fp32', 'int8']}
+
+# Keys of ModelProvider.identity() in the features info of a feature store
+MODEL_INFO_KEYS = ['model', 'model_weights', 'model_backend', 'precision']
+
+
+def preprocess(images):
+    """Stack RGB images into a (batch, 3, height, width) float32 array scaled to [-1, 1], like torchvision's ToTensor
+    followed by Normalize with mean and std 0.5."""
+    batch = np.stack([np.asarray(image, dtype=np.uint8) for image in images]).astype(np.float32) / 255
+    batch = (batch - 0.5) / 0.5
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+class ModelProvider:
+    """Vision transformer of the font features, built on its first use.
+
+    Pretrained weights are downloaded by timm unless weights_path names a local weights file. The torchscript and
+    onnx backends convert the model once and keep the converted model in model_dir, keyed on the model name, the
+    weights file and the precision, for faster CPU inference. The torch backend can also compile the model with
+    torch.compile and run it on channels-last images.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, weights_path=None, backend=DEFAULT_MODEL_BACKEND,
+                 model_dir=DEFAULT_MODEL_DIR, threads=0, precision=DEFAULT_MODEL_PRECISION, compiled=False,
+                 channels_last=False):
+        if backend not in MODEL_BACKENDS:
+            raise ValueError(f'Unknown model backend: {backend}')
+        if precision not in BACKEND_PRECISIONS[backend]:
+            raise ValueError(f'The {backend} model backend supports {", ".join(BACKEND_PRECISIONS[backend])} '
+                             f'precision, not {precision}')
+        if (compiled or channels_last) and backend != 'torch':
+            raise ValueError('Compiled and channels-last models need the torch model backend')
+        self.model_name = model_name
+        self.weights_path = weights_path
+        self.backend = backend
+        self.model_dir = model_dir
+        self.threads = threads
+        self.precision = precision
+        self.compiled = compiled
+        self.channels_last = channels_last
+        self._run = None
+        self._weights_identity = None
+
+    def weights_identity(self):
+        """Identity of the model weights: pretrained, or a hash of the content of the local weights file, the same
+        on every machine."""
+        if self._weights_identity is None:
+            self._weights_identity = file_sha256(self.weights_path)[:16] if self.weights_path else 'pretrained'
+        return self._weights_identity
+
+    def identity(self):
+        """Settings of the model that change the features, without the default ones, for the features info of a
+        feature store: features computed by another model are recomputed."""
+        identity = {}
+        if self.model_name != DEFAULT_MODEL_NAME:
+            identity['model'] = self.model_name
+        if self.weights_path:
+            identity['model_weights'] = self.weights_identity()
+        if self.backend != DEFAULT_MODEL_BACKEND:
+            identity['model_backend'] = self.backend
+        if self.precision != 'fp32':
+            identity['precision'] = self.precision
+        return identity
+
+    def converted_model_path(self, precision=None):
+        """File of the converted model, named after the model, its weights and the precision."""
+        precision = precision or self.precision
+        suffix = '' if precision == 'fp32' else f'_{precision}'
+        extension = 'onnx' if self.backend == 'onnx' else 'pt'
+        return os.path.join(self.model_dir,
+                            f'{self.model_name}_{self.weights_identity()}{suffix}.{self.backend}.{extension}')
+
+    def create_model(self):
+        import timm
+        import torch
+
+        if self.weights_path:
+            model = timm.create_model(self.model_name, pretrained=True,
+                                      pretrained_cfg_overlay={'file': self.weights_path})
+        else:
+            model = timm.create_model(self.model_name, pretrained=True)
+        model.eval()
+
+        class FeatureExtractor(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, images):
+                return self.model.forward_features(images)
+
+        model = FeatureExtractor(model).eval()
+        if self.precision == 'int8' and self.backend != 'onnx':
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def load(self):
+        """Build the model, converting it first when the backend needs a converted model that does not exist."""
+        if self._run is not None:
+            return
+
+        with instrumentation.timer('model_load'):
+            if self.backend == 'onnx':
+                self._run = self.load_onnx()
+            else:
+                self._run = self.load_torch()
+
+    def load_torch(self):
+        import torch
+
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+        if self.backend == 'torch':
+            model = self.create_model()
+            if self.channels_last:
+                model = model.to(memory_format=torch.channels_last)
+            if self.compiled:
+                model = torch.compile(model)
+        else:
+            path = self.converted_model_path()
+            if not os.path.exists(path):
+                print(f'Converting {self.model_name} to TorchScript')
+                model = torch.jit.freeze(torch.jit.script(self.create_model()))
+                os.makedirs(self.model_dir, exist_ok=True)
+                torch.jit.save(model, path + '.tmp')
+                os.replace(path + '.tmp', path)
+            model = torch.jit.load(path, map_location='cpu')
+
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        bf16 = self.precision == 'bf16'
+
+        def run(batch):
+            images = torch.from_numpy(batch).contiguous(memory_format=memory_format)
+            with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+                return model(images).float().numpy()
+        return run
+
+    def load_onnx(self):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx model backend needs onnxruntime: pip install onnxruntime onnx')
+
+        fp32_path = self.converted_model_path('fp32')
+        if not os.path.exists(fp32_path):
+            import torch
+
+            print(f'Converting {self.model_name} to ONNX')
+            os.makedirs(self.model_dir, exist_ok=True)
+            example = torch.zeros((1, 3, DEFAULT_IMAGE_SIZE[1], DEFAULT_IMAGE_SIZE[0]))
+            torch.onnx.export(self.create_model(), example, fp32_path + '.tmp', input_names=['images'],
+                              output_names=['tokens'], dynamic_axes={'images': {0: 'batch'}, 'tokens': {0: 'batch'}},
+                              opset_version=17)
+            os.replace(fp32_path + '.tmp', fp32_path)
+
+        path = self.converted_model_path()
+        if not os.path.exists(path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            print(f'Quantizing {self.model_name} to int8')
+            quantize_dynamic(fp32_path, path + '.tmp', weight_type=QuantType.QInt8)
+            os.replace(path + '.tmp', path)
+
+        options = onnxruntime.SessionOptions()
+        if self.threads > 0:
+            options.intra_op_num_threads = self.threads
+        session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        def run(batch):
+            return session.run(None, {'images': batch})[0]
+        return run
+
+    def forward_features(self, images):
+        """Token features of shape (images, tokens, dims) of a batch of RGB images."""
+        self.load()
+        return self._run(preprocess(images))
+
+
+def stored_model(info):
+    """Model settings of the features info of a feature store, as returned by ModelProvider.identity()."""
+    return {key: info[key] for key in MODEL_INFO_KEYS if key in info}
+
+
+_provider = None
+
+
+def configure(model_name=DEFAULT_MODEL_NAME, weights_path=None, backend=DEFAULT_MODEL_BACKEND,
+              model_dir=DEFAULT_MODEL_DIR, threads=0, precision=DEFAULT_MODEL_PRECISION, compiled=False,
+              channels_last=False):
+    """Set the model used for font features from now on. It is built on its first use."""
+    global _provider
+    _provider = ModelProvider(model_name, weights_path, backend, model_dir, threads, precision, compiled,
+                              channels_last)
+    return _provider
+
+
+def configure_from_arguments(parser, args, threads=0):
+    """Set the model from the arguments of add_arguments, reporting unsupported combinations as parser errors."""
+    try:
+        return configure(weights_path=args.model_weights, backend=args.model_backend, model_dir=args.model_dir,
+                         threads=threads, precision=args.model_precision, compiled=args.model_compile,
+                         channels_last=args.channels_last)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def provider():
+    """Model used for font features, pretrained weights with the torch backend unless configured otherwise."""
+    global _provider
+    if _provider is None:
+        _provider = ModelProvider()
+    return _provider
+
+
+def add_arguments(parser):
+    parser.add_argument('--model_weights', type=str, default=None,
+                        help='Local file of the model weights (.safetensors, .pth or .bin), loaded without network '
+                             'access. By default timm downloads the pretrained weights.')
+    parser.add_argument('--model_backend', type=str, choices=MODEL_BACKENDS, default=DEFAULT_MODEL_BACKEND,
+                        help='Inference backend: torch, or the model converted once to TorchScript or ONNX Runtime.')
+    parser.add_argument('--model_dir', type=str, default=DEFAULT_MODEL_DIR,
+                        help='Directory of converted models.')
+    parser.add_argument('--model_precision', type=str, choices=MODEL_PRECISIONS, default=DEFAULT_MODEL_PRECISION,
+                        help='Inference precision: fp32, bf16 autocast (torch backend) or int8 dynamic quantization. '
+                             'Features of other precisions are recomputed.')
+    parser.add_argument('--model_compile', action='store_true',
+                        help='Compile the model with torch.compile (torch backend).')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='Run the model on channels-last images (torch backend).')
@@ -0,0 +1,197 @@
+import contextlib
+import io
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import instrumentation
+from config import DEFAULT_NEIGHBOURS, DEFAULT_CLUSTER_FONTS, DEFAULT_CLUSTER_WORKERS, DEFAULT_SEAM_WINDOW
+from ann_index import IVFIndex, FeatureDistances, row_blocks
+from font_distance import gram_matrix, pairwise_distances, cross_distances
+from path_search import nearest_neighbours, improve_path
+
+
+def feature_source(features):
+    """Picklable reference to a feature matrix for worker processes; memory maps are passed by file, not content."""
+    if isinstance(features, np.memmap) and features.filename:
+        return features.filename, features.dtype.str, features.shape, features.offset
+    return features
+
+
+def open_features(source):
+    if isinstance(source, tuple):
+        filename, dtype, shape, offset = source
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+    return source
+
+
+def solve_cluster(source, rows, construct, metric='euclidean', dtype='float64', tile_size=None,
+                  neighbours=DEFAULT_NEIGHBOURS, time_budget=None):
+    """Sort the fonts of one cluster from their own distance matrix. Runs in worker processes.
+
+    Returns the path and the nearest neighbours of each font with their distances, all as cluster indices.
+    """
+    # Progress lines of concurrent workers would overwrite each other
+    with contextlib.redirect_stdout(io.StringIO()):
+        distance_matrix = pairwise_distances(gram_matrix(open_features(source), rows, dtype, tile_size), metric)
+        path = construct(distance_matrix)
+        nearest = nearest_neighbours(distance_matrix, neighbours)
+        path, _ = improve_path(path, distance_matrix.item, nearest, time_budget=time_budget,
+                               distance_matrix=distance_matrix)
+    return path, nearest.tolist(), np.take_along_axis(distance_matrix, nearest, axis=1).tolist()
+
+
+def split_clusters(features, rows, num_clusters, max_fonts, metric='euclidean', dtype='float64', tile_size=None):
+    """Split fonts into k-means clusters, splitting clusters of more than max_fonts fonts again (hierarchical
+    k-means), so that the clusters are solved in about the same time. Returns arrays of font indices."""
+    pending = [(np.arange(len(rows)), num_clusters)]
+    clusters = []
+    while pending:
+        fonts, parts = pending.pop()
+        index = IVFIndex(features, rows[fonts], parts, 1, metric, dtype, tile_size)
+        for cluster in index.lists:
+            if len(cluster) > max_fonts and len(cluster) < len(fonts):
+                pending.append((fonts[cluster], math.ceil(2 * len(cluster) / max_fonts)))
+            elif len(cluster):
+                clusters.append(fonts[cluster])
+    return clusters
+
+
+def cluster_centroids(features, rows, clusters, dtype='float64'):
+    """Mean feature vector of each cluster, streaming the features in row blocks."""
+    centroids = np.zeros((len(clusters), features.shape[1]), dtype=dtype)
+    for i, cluster in enumerate(clusters):
+        for _, vectors in row_blocks(features, rows[cluster], dtype):
+            centroids[i] += vectors.sum(axis=0)
+        centroids[i] /= len(cluster)
+    return centroids
+
+
+def cluster_order(centroids, construct, metric='euclidean', dtype='float64'):
+    """Order of the clusters along a short path through their centroids."""
+    if len(centroids) < 2:
+        return list(range(len(centroids)))
+    distance_matrix = pairwise_distances(gram_matrix(centroids, np.arange(len(centroids)), dtype), metric)
+    with contextlib.redirect_stdout(io.StringIO()):
+        path = construct(distance_matrix)
+    path, _ = improve_path(path, distance_matrix.item, nearest_neighbours(distance_matrix, DEFAULT_NEIGHBOURS),
+                           distance_matrix=distance_matrix)
+    return path
+
+
+def stitch_paths(paths, distance):
+    """Join paths in the given order, reversing each one where that shortens the joins.
+
+    The orientations are chosen by dynamic programming over the two orientations of every path, which minimises the
+    total length of the joins.
+    """
+    # Cost of the best joins up to path i ending with path i forward (0) or reversed (1)
+    costs = [0.0, 0.0]
+    choices = []
+    for previous, current in zip(paths, paths[1:]):
+        previous_ends = (previous[-1], previous[0])
+        new_costs, choice = [], []
+        for start in (current[0], current[-1]):
+            options = [costs[o] + distance(previous_ends[o], start) for o in (0, 1)]
+            best = int(np.argmin(options))
+            new_costs.append(options[best])
+            choice.append(best)
+        costs = new_costs
+        choices.append(choice)
+
+    orientation = int(np.argmin(costs))
+    orientations = [orientation]
+    for choice in reversed(choices):
+        orientation = choice[orientation]
+        orientations.append(orientation)
+    orientations.reverse()
+
+    stitched = []
+    seams = []
+    for path, orientation in zip(paths, orientations):
+        if stitched:
+            seams.append(len(stitched))
+        stitched.extend(path[::-1] if orientation else path)
+    return stitched, seams
+
+
+def repair_seams(path, seams, distances, neighbour_lists, neighbour_distances, features, rows, metric='euclidean',
+                 dtype='float64', window=DEFAULT_SEAM_WINDOW, neighbours=DEFAULT_NEIGHBOURS, time_budget=None):
+    """Improve the path around the joins of cluster paths.
+
+    The fonts within window positions of a join also get their nearest neighbours among the fonts on the other side
+    of the join, so that local search can move fonts across it; the search starts from these fonts only.
+    """
+    active = []
+    for seam in seams:
+        fonts = path[max(seam - window, 0):seam + window]
+        block = cross_distances(features, rows[fonts], rows[fonts], metric, dtype)
+        np.fill_diagonal(block, np.inf)
+        k = min(neighbours, len(fonts) - 1)
+        for i, font in enumerate(fonts):
+            nearest = np.argpartition(block[i], k - 1)[:k] if k > 0 else []
+            candidates = dict(zip(neighbour_lists[font], neighbour_distances[font]))
+            candidates.update((fonts[j], float(block[i, j])) for j in nearest)
+            distances.add(font, list(candidates), list(candidates.values()))
+            neighbour_lists[font] = sorted(candidates, key=candidates.get)
+            neighbour_distances[font] = [candidates[f] for f in neighbour_lists[font]]
+        active.extend(fonts)
+
+    return improve_path(path, distances, neighbour_lists, active=active, time_budget=time_budget)
+
+
+def sort_fonts_hierarchical(features, rows, construct, metric='euclidean', tile_size=None, dtype='float64',
+                            neighbours=DEFAULT_NEIGHBOURS, num_clusters=None, workers=DEFAULT_CLUSTER_WORKERS,
+                            time_budget=None):
+    """Sort fonts by clusters: k-means clusters of the features are sorted in parallel worker processes, ordered by
+    a path through their centroids, stitched and improved around the joins.
+
+    Memory holds the distance matrices of the clusters only. Returns the path and the distance function used to
+    measure it.
+    """
+    rows = np.asarray(rows)
+    num_fonts = len(rows)
+    num_clusters = num_clusters or max(math.ceil(num_fonts / DEFAULT_CLUSTER_FONTS), workers, 1)
+
+    start = time.perf_counter()
+    with instrumentation.timer('clusters'):
+        clusters = split_clusters(features, rows, num_clusters, 2 * DEFAULT_CLUSTER_FONTS, metric, dtype, tile_size)
+        order = cluster_order(cluster_centroids(features, rows, clusters, dtype), construct, metric, dtype)
+    clusters = [clusters[i] for i in order]
+    print(f'{len(clusters)} clusters of {min(map(len, clusters))} to {max(map(len, clusters))} fonts in '
+          f'{time.perf_counter() - start:.1f} s')
+
+    source = feature_source(features)
+    arguments = [(source, rows[cluster], construct, metric, dtype, tile_size, neighbours, time_budget)
+                 for cluster in clusters]
+    start = time.perf_counter()
+    with instrumentation.timer('cluster_paths'):
+        if workers > 0 and len(clusters) > 1:
+            with ProcessPoolExecutor(min(workers, len(clusters))) as executor:
+                # The largest clusters go first, so that no worker is left with a large cluster at the end
+                futures = {i: executor.submit(solve_cluster, *arguments[i])
+                           for i in sorted(range(len(clusters)), key=lambda i: -len(clusters[i]))}
+                results = [futures[i].result() for i in range(len(clusters))]
+        else:
+            results = [solve_cluster(*cluster_arguments) for cluster_arguments in arguments]
+    print(f'Cluster paths computed in {time.perf_counter() - start:.1f} s')
+
+    # Cluster indices to font indices
+    neighbour_lists = [None] * num_fonts
+    neighbour_distances = [None] * num_fonts
+    paths = []
+    for cluster, (path, nearest, nearest_distances) in zip(clusters, results):
+        paths.append(cluster[path].tolist())
+        for font, font_neighbours, font_distances in zip(cluster.tolist(), nearest, nearest_distances):
+            neighbour_lists[font] = cluster[font_neighbours].tolist()
+            neighbour_distances[font] = font_distances
+    distances = FeatureDistances(features, rows, neighbour_lists, neighbour_distances, metric, dtype)
+
+    with instrumentation.timer('seam_repair'):
+        path, seams = stitch_paths(paths, distances)
+        length = sum(distances(a, b) for a, b in zip(path, path[1:]))
+        path, history = repair_seams(path, seams, distances, neighbour_lists, neighbour_distances, features, rows,
+                                     metric, dtype, neighbours=neighbours, time_budget=time_budget)
+    print(f'Cluster paths stitched: length {length:.2f}, {history[-1][1]:.2f} after repairing {len(seams)} joins')
+    return path, distances
@@ -0,0 +1,147 @@
+import numpy as np
+
+
+def path_from_adjacency(adjacency, start):
+    """Walk a path given as adjacency lists from one of its endpoints."""
+    path = [start]
+    previous, current = None, start
+    while True:
+        following = [f for f in adjacency[current] if f != previous]
+        if not following:
+            return path
+        previous, current = current, following[0]
+        path.append(current)
+
+
+def greedy_edge_path(distance_matrix):
+    """Add the shortest remaining edges that keep every font at degree 2 or less and close no cycle."""
+    num_fonts = len(distance_matrix)
+    if num_fonts < 2:
+        return list(range(num_fonts))
+
+    first, second = np.triu_indices(num_fonts, k=1)
+    order = np.argsort(distance_matrix[first, second], kind='stable')
+
+    parent = list(range(num_fonts))
+
+    def root(font):
+        while parent[font] != font:
+            parent[font] = parent[parent[font]]
+            font = parent[font]
+        return font
+
+    degree = [0] * num_fonts
+    adjacency = [[] for _ in range(num_fonts)]
+    edges = 0
+    for edge in order:
+        a, b = int(first[edge]), int(second[edge])
+        if degree[a] == 2 or degree[b] == 2:
+            continue
+        root_a, root_b = root(a), root(b)
+        if root_a == root_b:
+            continue
+
+        parent[root_a] = root_b
+        degree[a] += 1
+        degree[b] += 1
+        adjacency[a].append(b)
+        adjacency[b].append(a)
+        edges += 1
+        if edges == num_fonts - 1:
+            break
+
+    return path_from_adjacency(adjacency, degree.index(1))
+
+
+def minimum_spanning_tree(distance_matrix, root=0):
+    """Parent of each font in the minimum spanning tree (Prim), -1 for the root."""
+    num_fonts = len(distance_matrix)
+    parent = np.full(num_fonts, -1)
+    in_tree = np.zeros(num_fonts, dtype=bool)
+    in_tree[root] = True
+    best = np.array(distance_matrix[root], dtype=np.float64)
+    best_parent = np.full(num_fonts, root)
+    best[root] = np.inf
+    for _ in range(num_fonts - 1):
+        font = int(np.argmin(best))
+        parent[font] = best_parent[font]
+        in_tree[font] = True
+        closer = distance_matrix[font] < best
+        best_parent[closer] = font
+        best = np.minimum(best, distance_matrix[font])
+        best[in_tree] = np.inf
+    return parent
+
+
+def mst_preorder_path(distance_matrix):
+    """Christofides-style start: the preorder walk of the minimum spanning tree, visiting nearer children first.
+
+    Shortcutting the doubled tree keeps the path within twice the optimum for metric distances. The minimum-weight
+    matching of Christofides' algorithm, which would tighten the bound to 1.5, is left out: a matching solver costs
+    far more than the local search that follows the construction anyway.
+    """
+    num_fonts = len(distance_matrix)
+    if num_fonts < 2:
+        return list(range(num_fonts))
+
+    # Root the tree at the font farthest from font 0, so the walk starts at the rim of the feature space
+    root = int(np.argmax(distance_matrix[0]))
+    parent = minimum_spanning_tree(distance_matrix, root)
+    children = [[] for _ in range(num_fonts)]
+    for font in range(num_fonts):
+        if parent[font] >= 0:
+            children[parent[font]].append(font)
+    for font in range(num_fonts):
+        children[font].sort(key=lambda child: distance_matrix[font, child])
+
+    path = []
+    stack = [root]
+    while stack:
+        font = stack.pop()
+        path.append(font)
+        stack.extend(reversed(children[font]))
+    return path
+
+
+def classical_mds(distance_matrix, dimensions=2):
+    """Embed the fonts in a low-dimensional space that preserves the distances (classical multidimensional scaling)."""
+    num_fonts = len(distance_matrix)
+    squared = np.asarray(distance_matrix, dtype=np.float64) ** 2
+    centering = np.eye(num_fonts) - 1 / num_fonts
+    gram = -0.5 * centering @ squared @ centering
+    values, vectors = np.linalg.eigh(gram)
+    top = np.argsort(values)[::-1][:dimensions]
+    return vectors[:, top] * np.sqrt(np.maximum(values[top], 0))
+
+
+def hilbert_index(x, y, order):
+    """Distance of integer grid points along the Hilbert curve filling a 2^order x 2^order grid (vectorized)."""
+    x, y = x.copy(), y.copy()
+    index = np.zeros(len(x), dtype=np.int64)
+    n = 1 << order
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant so that the curve of the next level is oriented correctly
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s >>= 1
+    return index
+
+
+def hilbert_curve_path(distance_matrix, order=16):
+    """Order the fonts along a Hilbert space-filling curve over their 2-D multidimensional scaling embedding."""
+    num_fonts = len(distance_matrix)
+    if num_fonts < 2:
+        return list(range(num_fonts))
+
+    embedding = classical_mds(distance_matrix)
+    low, high = embedding.min(axis=0), embedding.max(axis=0)
+    grid = ((embedding - low) / np.where(high > low, high - low, 1) * ((1 << order) - 1)).astype(np.int64)
+    return np.argsort(hilbert_index(grid[:, 0], grid[:, 1], order), kind='stable').tolist()
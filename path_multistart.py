@@ -0,0 +1,106 @@
+import contextlib
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+
+import instrumentation
+from config import DEFAULT_NEIGHBOURS, DEFAULT_RESTART_WORKERS, DEFAULT_RESTART_SEED
+from path_search import improve_path, nearest_neighbours
+
+
+# Distance matrix and neighbour lists of a worker process, attached once by the pool initializer
+_worker = {}
+
+
+@contextlib.contextmanager
+def shared_array(array):
+    """Copy an array into shared memory for worker processes. Yields the name, shape and dtype to attach to it."""
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+        yield memory.name, array.shape, array.dtype.str
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def attach_worker(name, shape, dtype, neighbours):
+    memory = shared_memory.SharedMemory(name=name)
+    _worker.update(memory=memory, distance_matrix=np.ndarray(shape, dtype, buffer=memory.buf), neighbours=neighbours)
+
+
+def nearest_neighbour_path(distance_matrix, start_font):
+    """Create a font path from a start font, extending it with the closest unvisited font."""
+    num_fonts = len(distance_matrix)
+    path = [start_font]
+    visited = np.zeros(num_fonts, dtype=bool)
+    visited[start_font] = True
+    for _ in range(1, num_fonts):
+        start_font = int(np.argmin(np.where(visited, np.inf, distance_matrix[start_font])))
+        path.append(start_font)
+        visited[start_font] = True
+    return path
+
+
+def run_restart(restart, path, seed, time_budget, distance_matrix, neighbours):
+    """Construct and improve the path of one restart. Restart 0 improves the given path, the others start the
+    nearest-neighbour construction at a font drawn from the seed and the restart number.
+
+    Returns the restart, the improved path, its length and the CPU seconds spent.
+    """
+    start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if restart > 0:
+            start_font = int(np.random.default_rng([seed, restart]).integers(len(distance_matrix)))
+            path = nearest_neighbour_path(distance_matrix, start_font)
+        path, history = improve_path(path, distance_matrix.item, neighbours, time_budget=time_budget,
+                                     distance_matrix=distance_matrix)
+    return restart, path, history[-1][1], time.process_time() - start
+
+
+def run_restart_in_worker(restart, path, seed, time_budget):
+    return run_restart(restart, path, seed, time_budget, _worker['distance_matrix'], _worker['neighbours'])
+
+
+def multistart_font_path(path, distance_matrix, restarts, workers=DEFAULT_RESTART_WORKERS, seed=DEFAULT_RESTART_SEED,
+                         neighbours=DEFAULT_NEIGHBOURS, time_budget=None):
+    """Improve the path and restarts - 1 paths of randomized constructions, and keep the shortest one.
+
+    Workers attach to one copy of the distance matrix in shared memory. Without a time budget the result depends
+    only on the path, the seed and the number of restarts, not on the number of workers.
+    """
+    nearest = nearest_neighbours(distance_matrix, neighbours)
+    results = []
+
+    def collect(result):
+        results.append(result)
+        print(f'Restarts completed: {len(results)}/{restarts}', end='\r', flush=True)
+
+    with instrumentation.timer('restarts'):
+        if workers > 0 and restarts > 1:
+            with shared_array(np.ascontiguousarray(distance_matrix)) as (name, shape, dtype), \
+                    ProcessPoolExecutor(min(workers, restarts), initializer=attach_worker,
+                                        initargs=(name, shape, dtype, nearest)) as executor:
+                futures = [executor.submit(run_restart_in_worker, restart, path if restart == 0 else None, seed,
+                                           time_budget) for restart in range(restarts)]
+                for future in as_completed(futures):
+                    collect(future.result())
+        else:
+            for restart in range(restarts):
+                collect(run_restart(restart, path, seed, time_budget, distance_matrix, nearest))
+    results.sort()
+
+    print(f"\n{'restart':<10}{'length':>12}{'cpu (s)':>10}")
+    for restart, _, length, seconds in results:
+        print(f'{restart:<10}{length:>12.2f}{seconds:>10.2f}')
+
+    # Ties go to the lowest restart
+    best = min(results, key=lambda result: (result[2], result[0]))
+    first_length, first_seconds = results[0][2], results[0][3]
+    extra_minutes = (sum(result[3] for result in results) - first_seconds) / 60
+    improvement = 100 * (first_length - best[2]) / first_length if first_length else 0.0
+    rate = f', {improvement / extra_minutes:.3f} % per extra core-minute' if extra_minutes > 0 else ''
+    print(f'Best of {restarts} restarts: restart {best[0]}, {improvement:.2f} % shorter than restart 0{rate}')
+    return best[1]
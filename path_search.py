@@ -0,0 +1,291 @@
+import time
+from collections import deque
+import numpy as np
+
+
+# Moves must shorten the path by more than this to be applied, so that rounding errors never cause endless cycling
+IMPROVEMENT_EPSILON = 1e-10
+
+# Longest segment moved by Or-opt moves
+MAX_SEGMENT_LENGTH = 3
+
+
+def nearest_neighbours(distance_matrix, k, block_size=1024):
+    """Indices of the k nearest neighbours of each font, closest first, computed in row blocks."""
+    num_fonts = len(distance_matrix)
+    k = min(k, num_fonts - 1)
+    neighbours = np.empty((num_fonts, max(k, 0)), dtype=np.int64)
+    if k <= 0:
+        return neighbours
+
+    for start in range(0, num_fonts, block_size):
+        block = np.array(distance_matrix[start:start + block_size], dtype=np.float64)
+        block[np.arange(len(block)), np.arange(start, start + len(block))] = np.inf
+        nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(block, nearest, axis=1), axis=1)
+        neighbours[start:start + len(block)] = np.take_along_axis(nearest, order, axis=1)
+    return neighbours
+
+
+def mst_weight(distance_matrix):
+    """Weight of the minimum spanning tree (Prim), a lower bound of the length of any path through all fonts."""
+    num_fonts = len(distance_matrix)
+    if num_fonts < 2:
+        return 0.0
+
+    in_tree = np.zeros(num_fonts, dtype=bool)
+    in_tree[0] = True
+    best = np.array(distance_matrix[0], dtype=np.float64)
+    best[0] = np.inf
+    weight = 0.0
+    for _ in range(num_fonts - 1):
+        font = int(np.argmin(best))
+        weight += best[font]
+        in_tree[font] = True
+        best = np.minimum(best, distance_matrix[font])
+        best[in_tree] = np.inf
+    return weight
+
+
+def insertion_costs(path, font, distance_matrix):
+    """Path length added by inserting the font at each position 0..len(path) of the path.
+
+    The costs are computed in float64 whatever the dtype of the distance matrix, so that they round like the path
+    edges PathSearch sums.
+    """
+    path = np.asarray(path)
+    costs = np.empty(len(path) + 1)
+    costs[0] = distance_matrix[font, path[0]]
+    costs[-1] = distance_matrix[path[-1], font]
+    costs[1:-1] = distance_matrix[path[:-1], font].astype(np.float64) + distance_matrix[font, path[1:]] - \
+        distance_matrix[path[:-1], path[1:]]
+    return costs
+
+
+def relocate_first_improvement(path, distance_matrix):
+    """Move each font in turn to the first position that shortens the path, in passes until a pass moves no font.
+
+    This is the single-font relocation search font_sort.improve_font_path ran before PathSearch, vectorized over the
+    positions of each font; it returns the same path up to rounding of the path length.
+    """
+    path = list(path)
+    num_fonts = len(path)
+    if num_fonts < 3:
+        return path
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(num_fonts):
+            font = path[i]
+            gain = (distance_matrix[path[i - 1], font] if i > 0 else 0.0) + \
+                (distance_matrix[font, path[i + 1]] if i < num_fonts - 1 else 0.0) - \
+                (distance_matrix[path[i - 1], path[i + 1]] if 0 < i < num_fonts - 1 else 0.0)
+            rest = path[:i] + path[i + 1:]
+            deltas = insertion_costs(rest, font, distance_matrix) - gain
+            deltas[i] = 0.0  # the font's own position
+            shorter = np.flatnonzero(deltas < -IMPROVEMENT_EPSILON)
+            if len(shorter):
+                rest.insert(int(shorter[0]), font)
+                path = rest
+                improved = True
+    return path
+
+
+class PathSearch:
+    """Local search over an open font path with 2-opt and Or-opt moves (segments of 1 to 3 fonts, relocate included).
+
+    Moves are evaluated in O(1) from the few path edges they change. Only moves that connect a font to one of its
+    nearest neighbours are tried, and fonts whose neighbourhood did not change since they were last examined are
+    skipped (don't-look bits): a queue holds the fonts to examine, and fonts touched by an applied move are queued
+    again.
+    """
+
+    def __init__(self, path, distance, neighbours):
+        self.path = list(path)
+        self.distance = distance
+        self.neighbours = neighbours
+        self.position = [-1] * (max(self.path) + 1 if self.path else 0)
+        for i, font in enumerate(self.path):
+            self.position[font] = i
+        self.length = sum(distance(a, b) for a, b in zip(self.path, self.path[1:]))
+
+    def position_of(self, font):
+        return self.position[font] if font < len(self.position) else -1
+
+    def edge(self, i, j):
+        """Distance between the fonts at path positions i and j, 0 when either position is outside the path."""
+        if i < 0 or j < 0 or i >= len(self.path) or j >= len(self.path):
+            return 0.0
+        return self.distance(self.path[i], self.path[j])
+
+    def update_positions(self, start, end):
+        for i in range(start, end):
+            self.position[self.path[i]] = i
+
+    #
+    # 2-opt: reverse the segment at positions i+1..j, replacing edges (i, i+1) and (j, j+1) by (i, j) and (i+1, j+1)
+    #
+    def two_opt_delta(self, i, j):
+        return self.edge(i, j) - self.edge(i, i + 1) + self.edge(i + 1, j + 1) - self.edge(j, j + 1)
+
+    def apply_two_opt(self, i, j):
+        self.path[i + 1:j + 1] = self.path[i + 1:j + 1][::-1]
+        self.update_positions(i + 1, j + 1)
+        return [self.path[p] for p in (i, i + 1, j, j + 1) if 0 <= p < len(self.path)]
+
+    def try_two_opt(self, font):
+        p = self.position[font]
+        radius = max(self.edge(p, p - 1), self.edge(p, p + 1))
+        for neighbour in self.neighbours[font]:
+            q = self.position_of(neighbour)
+            if q < 0:
+                continue
+            if self.distance(font, neighbour) >= radius:
+                break
+            if abs(p - q) < 2:
+                continue
+
+            # Both reversals create the edge between the font and its neighbour
+            low, high = min(p, q), max(p, q)
+            for i, j in ((low, high), (low - 1, high - 1)):
+                delta = self.two_opt_delta(i, j)
+                if delta < -IMPROVEMENT_EPSILON:
+                    self.length += delta
+                    return self.apply_two_opt(i, j)
+        return None
+
+    #
+    # Or-opt: move the segment at positions s..e, possibly reversed, into the gap between positions g and g+1
+    #
+    def or_opt_delta(self, s, e, g, reverse):
+        removal = self.edge(s - 1, s) + self.edge(e, e + 1) - self.edge(s - 1, e + 1)
+        first, last = (e, s) if reverse else (s, e)
+        insertion = self.edge(g, first) + self.edge(last, g + 1) - self.edge(g, g + 1)
+        return insertion - removal
+
+    def apply_or_opt(self, s, e, g, reverse):
+        segment = self.path[s:e + 1]
+        if reverse:
+            segment.reverse()
+        touched = [self.path[p] for p in (s - 1, e + 1, g, g + 1) if 0 <= p < len(self.path)] + segment
+
+        if g < s:
+            self.path[g + 1:e + 1] = segment + self.path[g + 1:s]
+            self.update_positions(g + 1, e + 1)
+        else:
+            self.path[s:g + 1] = self.path[e + 1:g + 1] + segment
+            self.update_positions(s, g + 1)
+        return touched
+
+    def try_or_opt(self, font):
+        p = self.position[font]
+        num_fonts = len(self.path)
+        for length in range(1, MAX_SEGMENT_LENGTH + 1):
+            for s in (p, p - length + 1) if length > 1 else (p,):
+                e = s + length - 1
+                if s < 0 or e >= num_fonts or length >= num_fonts:
+                    continue
+
+                candidates = set(self.neighbours[self.path[s]]).union(self.neighbours[self.path[e]])
+                for neighbour in candidates:
+                    q = self.position_of(neighbour)
+                    if q < 0 or s <= q <= e:
+                        continue
+                    for g in (q - 1, q):
+                        # Gaps next to the segment leave the path unchanged
+                        if s - 1 <= g <= e:
+                            continue
+                        for reverse in (False, True):
+                            delta = self.or_opt_delta(s, e, g, reverse)
+                            if delta < -IMPROVEMENT_EPSILON:
+                                self.length += delta
+                                return self.apply_or_opt(s, e, g, reverse)
+        return None
+
+    def relocate_exhaustively(self, distance_matrix):
+        """Move every font to its best position in the whole path, vectorized over positions.
+
+        Returns the fonts touched by the applied moves. A path without such moves is a local optimum of the
+        relocation neighbourhood.
+        """
+        touched = []
+        for font in list(self.path):
+            p = self.position[font]
+            gain = self.edge(p - 1, p) + self.edge(p, p + 1) - self.edge(p - 1, p + 1)
+            rest = self.path[:p] + self.path[p + 1:]
+            if not rest:
+                continue
+
+            costs = insertion_costs(rest, font, distance_matrix)
+            costs[p] = np.inf  # the font's own position
+            new_position = int(np.argmin(costs))
+            if costs[new_position] - gain < -IMPROVEMENT_EPSILON:
+                touched.extend(self.path[max(p - 1, 0):p + 2])
+                self.length += costs[new_position] - gain
+                rest.insert(new_position, font)
+                self.path = rest
+                self.update_positions(min(p, new_position), max(p, new_position) + 1)
+                touched.extend(self.path[max(new_position - 1, 0):new_position + 2])
+        return touched
+
+    def run(self, active=None, time_budget=None, target_gap=None, lower_bound=None, distance_matrix=None,
+            progress_interval=1.0):
+        """Improve the path until no move improves it, the time budget (s) is spent or the gap to the lower bound
+        falls under target_gap. Only fonts in active are examined first; all fonts when active is None.
+
+        With a distance matrix, every local optimum is also checked with exhaustive relocation of each font.
+        Returns the history of (elapsed seconds, path length).
+        """
+        start_time = time.perf_counter()
+        history = [(0.0, self.length)]
+        last_report = start_time
+
+        queue = deque(self.path if active is None else active)
+        queued = set(queue)
+
+        def done():
+            if time_budget is not None and time.perf_counter() - start_time >= time_budget:
+                return True
+            return target_gap is not None and lower_bound and (self.length - lower_bound) / lower_bound <= target_gap
+
+        while not done():
+            if not queue:
+                if distance_matrix is None:
+                    break
+                touched = self.relocate_exhaustively(distance_matrix)
+                if not touched:
+                    break
+                queue.extend(f for f in touched if f not in queued)
+                queued.update(touched)
+                continue
+
+            font = queue.popleft()
+            queued.discard(font)
+            touched = self.try_two_opt(font) or self.try_or_opt(font)
+            if touched:
+                for f in touched:
+                    if f not in queued:
+                        queue.append(f)
+                        queued.add(f)
+
+            now = time.perf_counter()
+            if now - last_report >= progress_interval:
+                last_report = now
+                history.append((now - start_time, self.length))
+                print(f'Improving font path: length {self.length:.2f}, {len(queue)} fonts to examine        ',
+                      end='\r', flush=True)
+
+        history.append((time.perf_counter() - start_time, self.length))
+        return history
+
+
+def improve_path(path, distance, neighbours, active=None, time_budget=None, target_gap=None, lower_bound=None,
+                 distance_matrix=None):
+    """Improve a font path with local search. Returns the improved path and its length history."""
+    if len(path) < 3:
+        return list(path), [(0.0, sum(distance(a, b) for a, b in zip(path, path[1:])))]
+
+    search = PathSearch(path, distance, neighbours)
+    history = search.run(active, time_budget, target_gap, lower_bound, distance_matrix)
+    return search.path, history
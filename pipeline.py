@@ -0,0 +1,365 @@
+import argparse
+import os
+import queue
+import shlex
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+import model_provider
+from config import DEFAULT_FONT_PATH, DEFAULT_FONT_SUBSETS, DEFAULT_FONT_STYLES, DEFAULT_FEATURES_CHARACTERS, \
+    DEFAULT_FEATURES_TEXTS, DEFAULT_BATCH_SIZE, DEFAULT_FEATURE_MODE, DEFAULT_FEATURE_DTYPE, DEFAULT_PCA_COMPONENTS, \
+    DEFAULT_PCA_SAMPLE, DEFAULT_FONTS_API_URL, DEFAULT_HARVEST_CONCURRENCY, DEFAULT_HARVEST_RETRIES, \
+    DEFAULT_RENDER_WORKERS, DEFAULT_RENDER_QUEUE_SIZE
+from feature_modes import FEATURE_MODES, FEATURE_DTYPES, PCA_PROJECTION_FILE_NAME, features_info, load_pca_projection
+from feature_shards import SHARD_DIR_NAME, read_shard_manifests, merge_shards, shard_report
+from feature_store import FeatureStore, font_store_name, projection_sha256
+from font_dedup import DuplicateIndex
+from font_features import FeatureComputation, print_line, enumerate_font_files, enumerate_fonts, font_pca_projection, \
+    open_feature_store, prune_font_features, font_cache_entry, should_compute_font_features
+from font_harvester import HarvestStats, create_session, fetch_font_list, should_process_font, harvest_font
+from font_render import RENDER_CACHE_DIR_NAME
+from font_sort import sort_argument_parser, validate_sort_arguments, full_resort_flags, sort_fonts, load_sort_state, \
+    sort_state_settings
+
+
+class StageMetrics:
+    """Number of items, wall time and busy time of a pipeline stage."""
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.start_time = None
+        self.end_time = None
+
+    def begin(self):
+        self.start_time = time.perf_counter()
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def wall_seconds(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def report(self):
+        wall = self.wall_seconds()
+        print(f'{self.name:<10}{self.items:>8} {self.unit:<9}{wall:>10.1f}{self.busy_seconds:>10.1f}'
+              f'{self.items / wall if wall else 0:>10.2f}')
+
+
+def font_files_in(font_dir):
+    return [(font_dir, font_file) for font_file in sorted(os.listdir(font_dir)) if font_file.endswith('.ttf')]
+
+
+#
+# dry run
+#
+def dry_run_report(args, info, sort_args, pending, local_fonts):
+    """Report what a pipeline run would harvest, compute, prune and sort, without changing anything."""
+    print(f'Harvest: {len(pending)} new or updated font families')
+    for font, _ in pending[:20]:
+        print(f"  {font['family']}")
+    if len(pending) > 20:
+        print(f'  ... and {len(pending) - 20} more')
+
+    store = FeatureStore(args.font_path)
+    projection = None
+    if args.feature_mode == 'pca':
+        projection = load_pca_projection(os.path.join(args.font_path, PCA_PROJECTION_FILE_NAME), args.characters,
+                                         args.texts, args.pca_components)
+
+    if store.info != info or (args.feature_mode == 'pca' and projection is None):
+        recompute = len(local_fonts)
+        print(f'Features: settings changed, features of all {recompute} local fonts would be computed')
+    else:
+        recompute = 0
+        for font_dir, font_file in local_fonts:
+            name, _, key = font_cache_entry(store, os.path.join(font_dir, font_file), args.characters, args.texts,
+                                            args.feature_mode, projection_sha256(projection))
+            recompute += should_compute_font_features(store, name, key, args.force_features_recompute)
+        print(f'Features: {recompute} of {len(local_fonts)} local fonts would be computed')
+    print(f'          and the fonts of {len(pending)} harvested families')
+
+    pending_dirs = {os.path.normpath(font_dir) for _, font_dir in pending}
+    local_names = {font_store_name(font_dir, font_file) for font_dir, font_file in local_fonts}
+    pruned = [name for name in store.font_names() if name not in local_names
+              and os.path.normpath(os.path.dirname(store.ttf_path(name))) not in pending_dirs]
+    print(f'          features of {len(pruned)} deleted fonts would be pruned')
+
+    if sort_args.sparse or sort_args.hierarchical or full_resort_flags(sort_args):
+        print('Sort: all fonts would be sorted from scratch')
+    elif load_sort_state(args.font_path, sort_state_settings(info, sort_args.metric, sort_args.distance_dtype)) is None:
+        print('Sort: no sort state of the same settings, all fonts would be sorted from scratch')
+    else:
+        print('Sort: the previous font path would be updated incrementally')
+
+
+#
+# streaming run
+#
+def run_pipeline(args, sort_args):
+    """Harvest fonts, compute their features and sort them, computing the features of each font as soon as its
+    family is downloaded, and sorting once all features are stored.
+
+    Fonts are rendered and embedded in batches spanning consecutive fonts, as by font_features.py, while further
+    families are downloading.
+    """
+    info = features_info(args.feature_mode, args.feature_dtype, args.characters, args.texts, args.pca_components,
+                         model_provider.provider().identity())
+    render_cache = None if args.no_render_cache else os.path.join(args.font_path, RENDER_CACHE_DIR_NAME)
+    os.makedirs(args.font_path, exist_ok=True)
+
+    session = None
+    pending = []
+    if not args.skip_harvest:
+        session = create_session(args.concurrency, args.retries)
+        fonts = fetch_font_list(args.api_key, session, args.api_url)
+        pending = [(font, os.path.join(args.font_path, font['family'])) for font in fonts
+                   if should_process_font(font, os.path.join(args.font_path, font['family']), args.subset)]
+    pending_dirs = {font_dir for _, font_dir in pending}
+    local_fonts = [(font_dir, font_file) for font_dir, font_file in enumerate_font_files(args.font_path)
+                   if font_dir not in pending_dirs]
+
+    if args.dry_run:
+        dry_run_report(args, info, sort_args, pending, local_fonts)
+        return
+
+    harvest_metrics = StageMetrics('harvest', 'families')
+    features_metrics = StageMetrics('features', 'fonts')
+    sort_metrics = StageMetrics('sort', 'fonts')
+    harvest_stats = HarvestStats()
+
+    # Fonts ready for feature extraction, None once all families are harvested
+    ready = queue.Queue()
+    for font_file in local_fonts:
+        ready.put(font_file)
+
+    def harvest_family(font, font_dir):
+        try:
+            harvest_font(font, font_dir, args.styles, session, harvest_stats)
+        except Exception as e:
+            print(f"\nError harvesting font {font['family']}: {e}")
+            harvest_stats.add('failed')
+            return
+        harvest_stats.add('fonts')
+        for font_file in font_files_in(font_dir):
+            ready.put(font_file)
+
+    def harvest_families():
+        harvest_metrics.begin()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for font, font_dir in pending:
+                executor.submit(harvest_family, font, font_dir)
+        harvest_metrics.items = harvest_stats.fonts
+        harvest_metrics.busy_seconds = harvest_metrics.wall_seconds()
+        harvest_metrics.finish()
+        ready.put(None)
+
+    store = open_feature_store(args.font_path, info)
+    projection = None
+    if args.feature_mode == 'pca':
+        # The projection is fitted on a sample of all fonts, so all families are harvested before features
+        harvest_families()
+        font_file_paths = [os.path.join(*font_file) for font_file in enumerate_font_files(args.font_path)]
+        projection = font_pca_projection(args.font_path, font_file_paths, args.characters, args.texts,
+                                         args.pca_components, args.pca_sample, args.batch_size,
+                                         render_cache=render_cache)
+    else:
+        threading.Thread(target=harvest_families, daemon=True).start()
+
+    duplicates = None
+    if not args.no_dedup:
+        duplicates = DuplicateIndex(store, args.characters, args.texts, args.feature_mode,
+                                    projection_sha256(projection), stored=not args.force_features_recompute)
+
+    features_metrics.begin()
+    waiting_seconds = 0.0
+
+    def report_progress(computation):
+        # Once all families are harvested, the queue also holds the end marker
+        waiting = ready.qsize() - (harvest_metrics.end_time is not None)
+        print_line(f"Harvested {harvest_stats.fonts}/{len(pending)} families, features of "
+                   f"{computation.counts['computed'] + computation.counts['duplicate']} fonts computed, "
+                   f"{computation.counts['cached']} cached, {computation.failed()} failed, {waiting} fonts waiting")
+
+    def ready_fonts():
+        """Font files from the ready queue until all families are harvested."""
+        nonlocal waiting_seconds
+        while True:
+            start = time.perf_counter()
+            font_file = ready.get()
+            waiting_seconds += time.perf_counter() - start
+            if font_file is None:
+                return
+            yield os.path.join(*font_file)
+
+    computation = FeatureComputation(store, args.characters, args.texts, args.force_features_recompute,
+                                     args.batch_size, args.render_workers, args.render_queue_size, args.feature_mode,
+                                     projection, render_cache, duplicates, on_progress=report_progress)
+    computation.run(ready_fonts())
+    computed = computation.counts['computed'] + computation.counts['duplicate']
+    cached, failed = computation.counts['cached'], computation.failed()
+    stats = computation.stats
+
+    pruned = prune_font_features(store, [os.path.join(*font_file)
+                                         for font_file in enumerate_font_files(args.font_path)])
+    store.save()
+    features_metrics.finish()
+    features_metrics.items = computed + cached + failed
+    features_metrics.busy_seconds = features_metrics.wall_seconds() - waiting_seconds
+    print(f'\nFeatures of {computed} fonts computed, {cached} cached, {failed} failed, {len(pruned)} pruned')
+    stats.report()
+    if duplicates:
+        print(f'Duplicate fonts: features of {duplicates.reused} fonts copied from fonts with the same outlines '
+              f'instead of computed')
+
+    if len(store):
+        sort_metrics.begin()
+        sort_fonts(sort_args)
+        sort_metrics.items = len(store)
+        sort_metrics.busy_seconds = sort_metrics.wall_seconds()
+        sort_metrics.finish()
+    else:
+        print('No font features to sort')
+
+    print(f"\n{'stage':<10}{'items':>8} {'':<9}{'wall (s)':>10}{'busy (s)':>10}{'items/s':>10}")
+    for metrics in (harvest_metrics, features_metrics, sort_metrics):
+        metrics.report()
+    print(f'Harvest: {harvest_stats.downloaded} files downloaded, {harvest_stats.unchanged} unchanged, '
+          f'{harvest_stats.failed} families failed')
+
+
+#
+# merge of feature shards
+#
+def run_merge(parser, args):
+    """Validate the shard stores of a font directory, copy their features into its feature store and compute the
+    features of the fonts that failed or were in no shard."""
+    shard_dir = args.shard_dir or os.path.join(args.font_path, SHARD_DIR_NAME)
+    try:
+        manifests = read_shard_manifests(shard_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    info = manifests[0]['info']
+    if model_provider.stored_model(info) != model_provider.provider().identity():
+        parser.error(f'The shards were embedded with other model settings: '
+                     f'{model_provider.stored_model(info) or "the defaults"}')
+
+    store = open_feature_store(args.font_path, info)
+    font_file_paths = [os.path.join(*font_file) for font_file in enumerate_font_files(args.font_path)]
+    results = merge_shards(store, manifests, shard_dir, font_file_paths)
+    pruned = prune_font_features(store, font_file_paths)
+    store.save()
+    shard_report(manifests, results)
+
+    missing = [font_file_path for font_file_path in font_file_paths
+               if font_store_name(*os.path.split(font_file_path)) not in store]
+    print(f'{sum(copied for copied, _, _ in results)} fonts merged into {store.path}, {len(pruned)} pruned, '
+          f'{len(missing)} of {len(font_file_paths)} fonts failed or were in no shard')
+
+    # Fonts merged from the shards are feature cache hits, so only the missing fonts are computed
+    if missing and not args.no_retry:
+        enumerate_fonts(args.font_path, info['characters'], info['texts'], False, args.batch_size, args.render_workers,
+                        feature_mode=info['feature_mode'], feature_dtype=info['feature_dtype'],
+                        pca_components=info.get('pca_components', DEFAULT_PCA_COMPONENTS),
+                        render_cache=None if args.no_render_cache else os.path.join(args.font_path,
+                                                                                    RENDER_CACHE_DIR_NAME))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='font-sort', description='Font sorting system')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', help='Harvest fonts, compute their features and sort them in one streaming run.')
+    pipeline_parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    pipeline_parser.add_argument('--dry_run', action='store_true',
+                                 help='Report what would be harvested, computed, pruned and sorted, and stop.')
+
+    pipeline_parser.add_argument('--skip_harvest', action='store_true', help='Only compute features and sort.')
+    pipeline_parser.add_argument('--api_key', type=str, default=os.getenv('GOOGLE_FONTS_API_KEY'),
+                                 help='Google Fonts API key.')
+    pipeline_parser.add_argument('--api_url', type=str, default=DEFAULT_FONTS_API_URL, help='URL of the font list.')
+    pipeline_parser.add_argument('--styles', type=str, nargs='+', default=DEFAULT_FONT_STYLES,
+                                 help='Harvest only certain font styles (e.g., regular, italic, bold).')
+    pipeline_parser.add_argument('--subset', type=str, nargs='+', default=DEFAULT_FONT_SUBSETS,
+                                 help='Harvest only subsets of fonts (e.g., latin).')
+    pipeline_parser.add_argument('--concurrency', type=int, default=DEFAULT_HARVEST_CONCURRENCY,
+                                 help='Number of font families downloaded at once.')
+    pipeline_parser.add_argument('--retries', type=int, default=DEFAULT_HARVEST_RETRIES,
+                                 help='Number of retries of a failed request.')
+
+    pipeline_parser.add_argument('--characters', type=str, default=DEFAULT_FEATURES_CHARACTERS,
+                                 help='Characters for font comparisons in each font.')
+    pipeline_parser.add_argument('--texts', type=str, nargs='+', default=DEFAULT_FEATURES_TEXTS,
+                                 help='Array of texts for font comparisons.')
+    pipeline_parser.add_argument('--force_features_recompute', action='store_true',
+                                 help='Recompute features of all fonts, including fonts whose features are cached.')
+    pipeline_parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                                 help='Number of images in one model forward pass. Batches span consecutive fonts; '
+                                      'larger batches are faster, but their features can differ in the last bits.')
+    pipeline_parser.add_argument('--render_workers', type=int, default=DEFAULT_RENDER_WORKERS,
+                                 help='Number of rasterizer processes. 0 renders fonts in the inference process.')
+    pipeline_parser.add_argument('--render_queue_size', type=int, default=DEFAULT_RENDER_QUEUE_SIZE,
+                                 help='Maximum number of rendered fonts waiting for inference.')
+    pipeline_parser.add_argument('--feature_mode', type=str, choices=FEATURE_MODES, default=DEFAULT_FEATURE_MODE,
+                                 help='Features kept per image.')
+    pipeline_parser.add_argument('--feature_dtype', type=str, choices=FEATURE_DTYPES, default=DEFAULT_FEATURE_DTYPE,
+                                 help='Data type of stored features.')
+    pipeline_parser.add_argument('--pca_components', type=int, default=DEFAULT_PCA_COMPONENTS,
+                                 help='Number of PCA components per image in pca feature mode.')
+    pipeline_parser.add_argument('--pca_sample', type=int, default=DEFAULT_PCA_SAMPLE,
+                                 help='Number of fonts the PCA projection is fitted on.')
+    pipeline_parser.add_argument('--no_render_cache', action='store_true',
+                                 help='Render all fonts instead of reusing cached rendered images.')
+    pipeline_parser.add_argument('--no_dedup', action='store_true',
+                                 help='Compute the features of fonts with the same outlines as another font instead '
+                                      'of copying its features.')
+
+    pipeline_parser.add_argument('--sort_args', type=str, default='',
+                                 help='Arguments of font_sort.py, e.g. "--metric cosine --improve_seconds 60".')
+    model_provider.add_arguments(pipeline_parser)
+    instrumentation.add_arguments(pipeline_parser)
+
+    merge_parser = subparsers.add_parser(
+        'merge', help='Combine the feature stores of shards computed with font_features.py --shard and compute the '
+                      'features of fonts that failed.')
+    merge_parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    merge_parser.add_argument('--shard_dir', type=str, default=None,
+                              help=f'Directory of the shard stores and manifests. Default is {SHARD_DIR_NAME} in the '
+                                   'font directory.')
+    merge_parser.add_argument('--no_retry', action='store_true',
+                              help='Only merge the shards, without computing the features of fonts that failed.')
+    merge_parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                              help='Number of images in one model forward pass.')
+    merge_parser.add_argument('--render_workers', type=int, default=DEFAULT_RENDER_WORKERS,
+                              help='Number of rasterizer processes. 0 renders fonts in the inference process.')
+    merge_parser.add_argument('--no_render_cache', action='store_true',
+                              help='Render all fonts instead of reusing cached rendered images.')
+    model_provider.add_arguments(merge_parser)
+    instrumentation.add_arguments(merge_parser)
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        model_provider.configure_from_arguments(parser, args)
+        with instrumentation.instrumented(args.profile, args.metrics_out):
+            run_merge(parser, args)
+        return
+
+    if not args.skip_harvest and args.api_url == DEFAULT_FONTS_API_URL and not args.api_key:
+        parser.error('The --api_key argument is required to harvest Google Fonts, or use --skip_harvest.')
+    sort_args = sort_argument_parser().parse_args(['--font_path', args.font_path] + shlex.split(args.sort_args))
+    validate_sort_arguments(parser, sort_args, args.feature_mode)
+    model_provider.configure_from_arguments(parser, args)
+
+    with instrumentation.instrumented(args.profile, args.metrics_out):
+        run_pipeline(args, sort_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,29 @@ from setuptools import setup, find_packages
 setup(
     name="font-sorting",
     version="0.1.0",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
+    py_modules=[
+        "ann_index", "config", "feature_modes", "feature_modes_report", "feature_shards", "feature_store",
+        "font_dedup", "font_distance", "font_features", "font_harvester", "font_render", "font_service",
+        "font_service_loadtest", "font_sort", "glyph_density", "instrumentation", "model_provider", "path_cluster",
+        "path_construct", "path_multistart", "path_search", "pipeline", "specimen"
+    ],
+    entry_points={
+        "console_scripts": ["font-sort=pipeline:main"],
+    },
     install_requires=[
         "numpy==1.26.4",
         "pillow==10.3.0",
         "torch==2.3.0",
         "torchvision==0.18.0",
         "timm==1.0.3",
-        "requests==2.32.3"
+        "requests==2.32.3",
+        "fonttools==4.53.0"
     ],
+    extras_require={
+        "onnx": ["onnx", "onnxruntime"],
+        "tests": ["pytest"],
+    },
     python_requires='>=3.6',
     author="Matevž Kovačič",
     author_email="matevz.celje@gmail.com",
@@ -0,0 +1,134 @@
+import argparse
+import html
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+
+from config import DEFAULT_FONT_PATH, DEFAULT_SPECIMEN_PAGE_ROWS, DEFAULT_SPECIMEN_WORKERS
+from feature_store import FeatureStore
+
+
+SPECIMEN_TEXT = 'The quick brown fox jumps over the lazy dog'
+LINE_HEIGHT = 50
+IMAGE_WIDTH = 1200
+FONT_SIZE = 20
+
+# Fonts used for font names, loaded once per process
+_display_fonts = {}
+
+
+def draw_specimen_row(draw, y_position, ttf_file, font_name, text, display_font):
+    """Draw one specimen line, the font name followed by the text in the font."""
+    draw.text((10, y_position), font_name.removesuffix('_regular'), font=display_font, fill='black')
+    try:
+        draw.text((400, y_position), text, font=ImageFont.truetype(ttf_file, FONT_SIZE), fill='black')
+    except Exception as e:
+        draw.text((400, y_position), f'[font could not be rendered: {e}]', font=display_font, fill='black')
+
+
+def render_specimen_page(file_path, rows, text, display_font_path):
+    """Render the specimen lines of the (ttf file, font name) rows on one RGB page and save it as PNG.
+
+    Lines are drawn LINE_HEIGHT apart on the page, so glyphs taller than a line reach into the next line as in a
+    specimen of a single image; only glyphs crossing a page boundary are cut.
+    """
+    display_font = _display_fonts.get(display_font_path)
+    if display_font is None:
+        display_font = _display_fonts[display_font_path] = ImageFont.truetype(display_font_path, FONT_SIZE)
+
+    image = Image.new('RGB', (IMAGE_WIDTH, LINE_HEIGHT * max(len(rows), 1)), 'white')
+    draw = ImageDraw.Draw(image)
+    for i, (ttf_file, font_name) in enumerate(rows):
+        draw_specimen_row(draw, i * LINE_HEIGHT, ttf_file, font_name, text, display_font)
+    image.save(file_path)
+
+
+def page_file_name(image_path, page, num_pages):
+    """File of a specimen page; a single page keeps the name of the specimen."""
+    if num_pages == 1:
+        return image_path
+    stem, extension = os.path.splitext(image_path)
+    return f'{stem}_{page + 1:03d}{extension}'
+
+
+def write_contact_sheet(html_path, pages):
+    """HTML page showing all specimen pages, loading page images only when they are scrolled into view."""
+    lines = ['<!DOCTYPE html>', '<html>', '<head>', '<meta charset="utf-8">',
+             f'<title>{html.escape(os.path.basename(html_path))}</title>',
+             '<style>body { margin: 0; } img { display: block; max-width: 100%; height: auto; }</style>',
+             '</head>', '<body>']
+    for page in pages:
+        lines.append(f'<img src="{html.escape(page["file"])}" width="{IMAGE_WIDTH}" '
+                     f'height="{LINE_HEIGHT * len(page["fonts"])}" loading="lazy" '
+                     f'alt="{html.escape(page["fonts"][0])} - {html.escape(page["fonts"][-1])}">')
+    lines.extend(['</body>', '</html>'])
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_specimen(ttf_files, font_names, font_indices, text, image_path, display_font_path,
+                   page_rows=DEFAULT_SPECIMEN_PAGE_ROWS, workers=DEFAULT_SPECIMEN_WORKERS):
+    """Write the specimen of the fonts as PNG pages of up to page_rows lines, with a JSON index of the fonts on each
+    page and an HTML contact sheet.
+
+    Pages are rendered and saved by a pool of processes when workers > 0, each holding one page in memory, so memory
+    does not grow with the number of fonts.
+    """
+    num_pages = max((len(font_indices) + page_rows - 1) // page_rows, 1)
+    pages = []
+    page_rows_of_fonts = []
+    for page in range(num_pages):
+        indices = font_indices[page * page_rows:(page + 1) * page_rows]
+        file_path = page_file_name(image_path, page, num_pages)
+        pages.append({'file': os.path.basename(file_path), 'first': page * page_rows,
+                      'fonts': [font_names[idx] for idx in indices]})
+        page_rows_of_fonts.append((file_path, [(ttf_files[idx], font_names[idx]) for idx in indices]))
+
+    if workers > 0 and num_pages > 1:
+        with ProcessPoolExecutor(min(workers, num_pages)) as executor:
+            futures = [executor.submit(render_specimen_page, file_path, rows, text, display_font_path)
+                       for file_path, rows in page_rows_of_fonts]
+            for future in futures:
+                future.result()
+    else:
+        for file_path, rows in page_rows_of_fonts:
+            render_specimen_page(file_path, rows, text, display_font_path)
+
+    stem = os.path.splitext(image_path)[0]
+    with open(f'{stem}.json', 'w', encoding='utf-8') as f:
+        json.dump({'text': text, 'line_height': LINE_HEIGHT, 'pages': pages}, f, ensure_ascii=False, indent=1)
+    write_contact_sheet(f'{stem}.html', pages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the specimen of a sorted font list')
+    parser.add_argument('--font_path', type=str, default=DEFAULT_FONT_PATH, help='Directory with fonts.')
+    parser.add_argument('--font_list', type=str, default='./ordered_fonts_list.txt',
+                        help='Sorted font list written by font_sort.py.')
+    parser.add_argument('--output', type=str, default='font_list_samples_all.png', help='Specimen image file.')
+    parser.add_argument('--text', type=str, default=SPECIMEN_TEXT, help='Text rendered in every font.')
+    parser.add_argument('--display_font', type=str, default='Open Sans_regular',
+                        help='Font of the font names. The middle font of the list when it is not in the list.')
+    parser.add_argument('--page_rows', type=int, default=DEFAULT_SPECIMEN_PAGE_ROWS, help='Fonts per page.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_SPECIMEN_WORKERS,
+                        help='Number of rendering processes. 0 renders in this process.')
+    args = parser.parse_args()
+
+    store = FeatureStore(args.font_path)
+    with open(args.font_list, 'r') as f:
+        font_names = [line.rstrip('\n') for line in f if line.rstrip('\n') in store]
+    if not font_names:
+        print(f'No font of {args.font_list} is in the feature store of {args.font_path}, no specimen saved')
+        sys.exit(1)
+    ttf_files = [store.ttf_path(name) for name in font_names]
+    display_font = args.display_font if args.display_font in font_names else font_names[len(font_names) // 2]
+
+    write_specimen(ttf_files, font_names, list(range(len(font_names))), args.text, args.output,
+                   ttf_files[font_names.index(display_font)], args.page_rows, args.workers)
+    print(f'Specimen of {len(font_names)} fonts saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the repository are top-level modules run as scripts, import them from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feature_modes import features_info  # noqa: E402
+
+
+@pytest.fixture
+def fonts_dir(tmp_path):
+    path = tmp_path / 'fonts'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def write_font(fonts_dir):
+    """Write a stand-in .ttf file of a family in the font directory and return its path. Only the content hash, size
+    and modification time of font files matter to the feature store."""
+    def write(family, variant='regular', data=None):
+        font_dir = os.path.join(fonts_dir, family)
+        os.makedirs(font_dir, exist_ok=True)
+        path = os.path.join(font_dir, f'{variant}.ttf')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(64) if data is None else data)
+        return path
+    return write
+
+
+@pytest.fixture
+def alphabet():
+    return 'ABC'
+
+
+@pytest.fixture
+def texts():
+    return ['Abc']
+
+
+@pytest.fixture
+def info(alphabet, texts):
+    """Settings of the test feature stores: mean-pooled features of a short alphabet and text."""
+    return features_info('meanpool', 'float32', alphabet, texts)
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+from feature_shards import ShardManifest, font_shard, merge_shards, read_shard_manifests, shard_store_path
+from feature_store import FeatureStore, font_store_name
+from font_features import PipelineStats, font_cache_entry, open_feature_store, store_font_features
+
+NUM_SHARDS = 2
+
+
+def run_shard(fonts_dir, shard_dir, shard, font_file_paths, info, failed=()):
+    """Store random features of the fonts of a shard in its shard store and save its manifest, as a shard run of
+    font_features.py does. Returns the features by font name."""
+    store = open_feature_store(fonts_dir, info, shard_store_path(shard_dir, shard, NUM_SHARDS))
+    manifest = ShardManifest(store.path, shard, NUM_SHARDS, info)
+    features = {}
+    for path in font_file_paths:
+        name, sha256, key = font_cache_entry(store, path, info['characters'], info['texts'], info['feature_mode'])
+        if font_shard(name, NUM_SHARDS) != shard:
+            continue
+        if name in failed:
+            manifest.record(name, os.path.relpath(path, fonts_dir), sha256, 'failed', error='broken font')
+            continue
+        features[name] = np.random.rand(4).astype(np.float32)
+        store_font_features(store, path, features[name], 0.5, sha256, key)
+        manifest.record(name, os.path.relpath(path, fonts_dir), sha256, 'computed', 0.1)
+    store.save()
+    manifest.save(PipelineStats())
+    return features
+
+
+@pytest.fixture
+def sharded_fonts(fonts_dir, write_font):
+    paths = [write_font(f'Family{i}') for i in range(12)]
+    shards = {font_shard(font_store_name(*os.path.split(path)), NUM_SHARDS) for path in paths}
+    assert shards == {0, 1}
+    return paths, os.path.join(fonts_dir, 'shards')
+
+
+def test_merge_two_shard_stores(fonts_dir, sharded_fonts, info):
+    paths, shard_dir = sharded_fonts
+    features = {}
+    for shard in range(NUM_SHARDS):
+        features.update(run_shard(fonts_dir, shard_dir, shard, paths, info))
+
+    manifests = read_shard_manifests(shard_dir)
+    assert [manifest['shard'] for manifest in manifests] == [0, 1]
+    store = open_feature_store(fonts_dir, manifests[0]['info'])
+    results = merge_shards(store, manifests, shard_dir, paths)
+    store.save()
+
+    assert sum(copied for copied, _, _ in results) == len(paths)
+    store = FeatureStore(fonts_dir)
+    assert store.font_names() == sorted(features)
+    for name, vector in features.items():
+        np.testing.assert_array_equal(store.matrix()[store.fonts[name]['row']], vector)
+        assert store.densities[store.fonts[name]['row']] == 0.5
+
+    # Merging again finds all fonts current
+    assert merge_shards(store, manifests, shard_dir, paths) == [(0, copied, 0) for copied, _, _ in results]
+
+
+def test_merge_skips_failed_and_changed_fonts(fonts_dir, write_font, sharded_fonts, info):
+    paths, shard_dir = sharded_fonts
+    names = [font_store_name(*os.path.split(path)) for path in paths]
+    failed = names[0]
+    features = {}
+    for shard in range(NUM_SHARDS):
+        features.update(run_shard(fonts_dir, shard_dir, shard, paths, info, failed=[failed]))
+
+    # A font that changed after the shards ran and a font deleted since
+    changed_path = paths[1]
+    write_font(os.path.basename(os.path.dirname(changed_path)), data=os.urandom(80))
+    deleted_path = paths[2]
+    os.remove(deleted_path)
+    current_paths = [path for path in paths if path != deleted_path]
+
+    store = open_feature_store(fonts_dir, info)
+    results = merge_shards(store, read_shard_manifests(shard_dir), shard_dir, current_paths)
+    assert sum(skipped for _, _, skipped in results) == 3
+    assert store.font_names() == sorted(set(names) - {failed, names[1], names[2]})
+
+
+def test_manifests_of_incomplete_or_mixed_runs_are_rejected(fonts_dir, sharded_fonts, info):
+    paths, shard_dir = sharded_fonts
+    with pytest.raises(ValueError, match='No shard manifests'):
+        read_shard_manifests(shard_dir)
+
+    run_shard(fonts_dir, shard_dir, 0, paths, info)
+    with pytest.raises(ValueError, match='1/2 have no manifest'):
+        read_shard_manifests(shard_dir)
+
+    run_shard(fonts_dir, shard_dir, 1, paths, dict(info, feature_mode='cls'))
+    with pytest.raises(ValueError, match='other feature settings'):
+        read_shard_manifests(shard_dir)
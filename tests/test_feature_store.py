@@ -0,0 +1,169 @@
+import json
+import os
+
+import numpy as np
+
+import model_provider
+from feature_modes import FEATURES_INFO_FILE_NAME, features_info
+from feature_store import FeatureStore, font_cache_key, migrate_font_files
+from font_features import font_cache_entry, open_feature_store, prune_font_features, should_compute_font_features, \
+    store_font_features
+
+
+def store_fonts(store, font_file_paths, dim=4):
+    """Store random features of the fonts, as font_features.py does after computing them."""
+    features = {}
+    for path in font_file_paths:
+        name, sha256, key = font_cache_entry(store, path, store.info['characters'], store.info['texts'],
+                                             store.info['feature_mode'])
+        features[name] = np.random.rand(dim).astype(np.float32)
+        store_font_features(store, path, features[name], 0.25, sha256, key)
+    store.save()
+    return features
+
+
+def test_store_round_trip(fonts_dir, write_font, info):
+    store = open_feature_store(fonts_dir, info)
+    features = store_fonts(store, [write_font('Alpha'), write_font('Beta', 'italic')])
+
+    store = FeatureStore(fonts_dir)
+    assert store.info == info and store.font_names() == ['Alpha_regular', 'Beta_italic']
+    np.testing.assert_array_equal(store.matrix()[store.rows(['Beta_italic'])[0]], features['Beta_italic'])
+    assert store.ttf_path('Beta_italic') == os.path.join(fonts_dir, 'Beta', 'italic.ttf')
+
+
+def test_unchanged_fonts_are_cached(fonts_dir, write_font, info, alphabet, texts):
+    path = write_font('Alpha')
+    store = open_feature_store(fonts_dir, info)
+    store_fonts(store, [path])
+
+    store = open_feature_store(fonts_dir, info)
+    name, _, key = font_cache_entry(store, path, alphabet, texts, 'meanpool')
+    assert not should_compute_font_features(store, name, key, force_recompute=False)
+    assert should_compute_font_features(store, name, key, force_recompute=True)
+
+
+def test_key_changes_recompute(fonts_dir, write_font, info, alphabet, texts):
+    path = write_font('Alpha')
+    store = open_feature_store(fonts_dir, info)
+    store_fonts(store, [path])
+    name, sha256, key = font_cache_entry(store, path, alphabet, texts, 'meanpool')
+
+    for other_key in [font_cache_key(sha256, 'ABD', texts, 'meanpool'),
+                      font_cache_key(sha256, alphabet, ['Abd'], 'meanpool'),
+                      font_cache_key(sha256, alphabet, texts, 'cls'),
+                      font_cache_key(sha256, alphabet, texts, 'meanpool', projection_hash='0' * 64),
+                      font_cache_key(sha256, alphabet, texts, 'meanpool', model={'precision': 'bf16'})]:
+        assert other_key != key
+        assert should_compute_font_features(store, name, other_key, force_recompute=False)
+
+    # A new version of the font file has another content hash
+    write_font('Alpha', data=os.urandom(80))
+    assert font_cache_entry(store, path, alphabet, texts, 'meanpool')[2] != key
+
+
+
+def test_key_follows_the_configured_model(fonts_dir, write_font, info, alphabet, texts, monkeypatch):
+    path = write_font('Alpha')
+    store = open_feature_store(fonts_dir, info)
+    _, sha256, key = font_cache_entry(store, path, alphabet, texts, 'meanpool')
+    assert key == font_cache_key(sha256, alphabet, texts, 'meanpool')
+
+    monkeypatch.setattr(model_provider, '_provider', model_provider.ModelProvider(weights_path=path))
+    model_key = font_cache_entry(store, path, alphabet, texts, 'meanpool')[2]
+    assert model_key != key
+    assert model_key == font_cache_key(sha256, alphabet, texts, 'meanpool',
+                                       model={'model_weights': model_provider.provider().weights_identity()})
+
+
+def test_other_settings_reset_the_store(fonts_dir, write_font, info, alphabet, texts):
+    store = open_feature_store(fonts_dir, info)
+    store_fonts(store, [write_font('Alpha')])
+
+    store = open_feature_store(fonts_dir, features_info('cls', 'float32', alphabet, texts))
+    assert len(store) == 0 and store.num_rows == 0
+    assert len(open_feature_store(fonts_dir, info)) == 0
+
+
+def test_deleted_fonts_are_pruned_and_their_rows_reused(fonts_dir, write_font, info):
+    paths = [write_font('Alpha'), write_font('Beta'), write_font('Gamma')]
+    store = open_feature_store(fonts_dir, info)
+    store_fonts(store, paths)
+    beta_row = store.fonts['Beta_regular']['row']
+
+    os.remove(paths[1])
+    assert prune_font_features(store, [paths[0], paths[2]]) == ['Beta_regular']
+    store.save()
+    store = FeatureStore(fonts_dir)
+    assert store.font_names() == ['Alpha_regular', 'Gamma_regular']
+
+    features = store_fonts(store, [write_font('Delta')])
+    assert store.fonts['Delta_regular']['row'] == beta_row and store.num_rows == 3
+    np.testing.assert_array_equal(store.matrix()[beta_row], features['Delta_regular'])
+
+
+def test_migrate_per_font_files(fonts_dir, write_font, info, alphabet, texts):
+    with open(os.path.join(fonts_dir, FEATURES_INFO_FILE_NAME), 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    features = {}
+    for family in ['Alpha', 'Beta']:
+        path = write_font(family)
+        features[f'{family}_regular'] = np.random.rand(4).astype(np.float32)
+        np.save(path + '.features.npy', features[f'{family}_regular'])
+        with open(path + '.density', 'w') as f:
+            f.write('0.5\n')
+
+    migrate_font_files(fonts_dir, remove_font_files=True)
+    store = FeatureStore(fonts_dir)
+    assert store.info == info and store.font_names() == sorted(features)
+    for name, vector in features.items():
+        np.testing.assert_array_equal(store.matrix()[store.fonts[name]['row']], vector)
+        assert not should_compute_font_features(store, name, font_cache_entry(
+            store, store.ttf_path(name), alphabet, texts, 'meanpool')[2], force_recompute=False)
+    assert not [file for family in ['Alpha', 'Beta'] for file in os.listdir(os.path.join(fonts_dir, family))
+                if not file.endswith('.ttf')]
+
+
+def test_interrupted_update_leaves_the_saved_index_intact(fonts_dir, info):
+    store = FeatureStore(fonts_dir)
+    store.reset(info)
+    store.put('A', os.path.join(fonts_dir, 'A.ttf'), 'a', np.full(4, 1.0), 0.1)
+    store.save()
+    store.put('B', os.path.join(fonts_dir, 'B.ttf'), 'b', np.full(4, 2.0), 0.2)
+    store.put('A', os.path.join(fonts_dir, 'A.ttf'), 'a2', np.full(4, 5.0), 0.5)
+    store.remove('A')
+
+    # The run stops before it saves: the saved index still reads the features it was saved with
+    store = FeatureStore(fonts_dir)
+    assert store.font_names() == ['A']
+    np.testing.assert_array_equal(store.matrix()[store.fonts['A']['row']], np.full(4, 1.0))
+
+    # Rows of the interrupted run are overwritten, not referenced
+    store.put('C', os.path.join(fonts_dir, 'C.ttf'), 'c', np.full(4, 3.0), 0.3)
+    store.save()
+    store = FeatureStore(fonts_dir)
+    np.testing.assert_array_equal(store.matrix()[store.fonts['A']['row']], np.full(4, 1.0))
+    np.testing.assert_array_equal(store.matrix()[store.fonts['C']['row']], np.full(4, 3.0))
+    assert [store.densities[row] for row in store.rows(['A', 'C'])] == [0.1, 0.3]
+
+
+def test_rows_of_changed_fonts_are_reused_after_save(fonts_dir, info):
+    store = FeatureStore(fonts_dir)
+    store.reset(info)
+    for name in 'ABC':
+        store.put(name, os.path.join(fonts_dir, f'{name}.ttf'), name, np.zeros(4), 0.0)
+    store.save()
+
+    # Changed features go to a new row until the index is saved, then the old rows are free again
+    store.put('A', os.path.join(fonts_dir, 'A.ttf'), 'a2', np.ones(4), 1.0)
+    store.remove('B')
+    assert store.fonts['A']['row'] == 3
+    store.save()
+    store.put('D', os.path.join(fonts_dir, 'D.ttf'), 'd', np.full(4, 4.0), 4.0)
+    store.put('E', os.path.join(fonts_dir, 'E.ttf'), 'e', np.full(4, 5.0), 5.0)
+    store.save()
+
+    store = FeatureStore(fonts_dir)
+    assert store.num_rows == 4 and sorted(store.rows(['D', 'E'])) == [0, 1]
+    for name, value in [('A', 1.0), ('C', 0.0), ('D', 4.0), ('E', 5.0)]:
+        np.testing.assert_array_equal(store.matrix()[store.fonts[name]['row']], np.full(4, value))
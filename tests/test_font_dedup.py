@@ -0,0 +1,58 @@
+import numpy as np
+
+from feature_store import FeatureStore
+from font_dedup import DuplicateIndex, expand_duplicates, load_duplicate_groups
+from font_features import font_cache_entry, open_feature_store, store_font_features
+
+
+def test_features_of_duplicates_are_reused(fonts_dir, write_font, info, alphabet, texts):
+    store = open_feature_store(fonts_dir, info)
+    original, copy, other = write_font('Original'), write_font('Copy'), write_font('Other')
+    features = np.random.rand(4).astype(np.float32)
+    name, sha256, key = font_cache_entry(store, original, alphabet, texts, 'meanpool')
+    store_font_features(store, original, features, 0.3, sha256, key, fingerprint='outlines-a')
+    store.save()
+
+    # Fingerprints stored with current features are found again when the store is reopened
+    duplicates = DuplicateIndex(FeatureStore(fonts_dir), alphabet, texts, 'meanpool')
+    assert duplicates.find('outlines-a') == 'Original_regular'
+    assert duplicates.find('outlines-a', name='Original_regular') is None
+    assert duplicates.find('outlines-b') is None and duplicates.find(None) is None
+
+    copy_name, copy_sha256, copy_key = font_cache_entry(duplicates.store, copy, alphabet, texts, 'meanpool')
+    duplicates.reuse(copy, 'Original_regular', copy_sha256, copy_key, 'outlines-a')
+    entry = duplicates.store.fonts[copy_name]
+    assert duplicates.reused == 1
+    assert entry['duplicate_of'] == 'Original_regular' and entry['key'] == copy_key
+    np.testing.assert_array_equal(duplicates.store.matrix()[entry['row']], features)
+    assert duplicates.store.densities[entry['row']] == 0.3
+
+    other_name, other_sha256, other_key = font_cache_entry(duplicates.store, other, alphabet, texts, 'meanpool')
+    store_font_features(duplicates.store, other, np.zeros(4, np.float32), 0.1, other_sha256, other_key)
+    duplicates.add(other_name, 'outlines-b')
+    assert duplicates.find('outlines-b') == other_name
+
+
+def test_fingerprints_of_other_settings_are_not_reused(fonts_dir, write_font, info, alphabet, texts):
+    store = open_feature_store(fonts_dir, info)
+    path = write_font('Original')
+    name, sha256, key = font_cache_entry(store, path, alphabet, texts, 'meanpool')
+    store_font_features(store, path, np.zeros(4, np.float32), 0.3, sha256, key, fingerprint='outlines-a')
+
+    assert DuplicateIndex(store, alphabet, texts, 'cls').find('outlines-a') is None
+    assert DuplicateIndex(store, alphabet, texts, 'meanpool', stored=False).find('outlines-a') is None
+
+
+def test_duplicate_groups_expand_in_place(fonts_dir, write_font, info, alphabet, texts):
+    store = open_feature_store(fonts_dir, info)
+    fingerprints = {'A': 'outlines-a', 'B': None, 'C': 'outlines-a', 'D': 'outlines-d'}
+    for family, fingerprint in fingerprints.items():
+        path = write_font(family)
+        _, sha256, key = font_cache_entry(store, path, alphabet, texts, 'meanpool')
+        store_font_features(store, path, np.zeros(4, np.float32), 0.3, sha256, key, fingerprint=fingerprint)
+    store.save()
+
+    font_names = ['A_regular', 'B_regular', 'C_regular', 'D_regular']
+    groups = load_duplicate_groups(fonts_dir, font_names)
+    assert groups == [[0, 2], [1], [3]]
+    assert expand_duplicates([2, 0, 1], groups) == [3, 0, 2, 1]
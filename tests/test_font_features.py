@@ -0,0 +1,40 @@
+import numpy as np
+
+from font_dedup import DuplicateIndex
+from font_features import FeatureComputation, font_cache_entry, open_feature_store, store_font_features
+
+
+def test_fonts_are_cached_copied_deferred_or_embedded(fonts_dir, write_font, info, alphabet, texts):
+    store = open_feature_store(fonts_dir, info)
+    cached = write_font('Cached')
+    _, sha256, key = font_cache_entry(store, cached, alphabet, texts, 'meanpool')
+    store_font_features(store, cached, np.ones(4, np.float32), 0.5, sha256, key, fingerprint='outlines-a')
+
+    paths = [cached, write_font('CopyOfCached'), write_font('New'), write_font('CopyOfNew'), write_font('Other')]
+    fingerprints = dict(zip(paths, ['outlines-a', 'outlines-a', 'outlines-n', 'outlines-n', None]))
+    duplicates = DuplicateIndex(store, alphabet, texts, 'meanpool')
+    computation = FeatureComputation(store, alphabet, texts, False, feature_mode='meanpool', duplicates=duplicates,
+                                     fingerprints=fingerprints)
+
+    # The copy of a font being embedded waits for its features
+    assert list(computation.fonts_to_embed(paths)) == [paths[2], paths[4]]
+    assert computation.statuses == {paths[0]: 'cached', paths[1]: 'duplicate'}
+    assert computation.deferred == {paths[3]: 'outlines-n'}
+
+    ttf_sha256, key, fingerprint = computation.misses[paths[2]]
+    store_font_features(store, paths[2], np.full(4, 2.0, np.float32), 0.7, ttf_sha256, key, fingerprint)
+    duplicates.add('New_regular', fingerprint)
+    computation.finish()
+    assert computation.statuses[paths[3]] == 'duplicate' and computation.counts['duplicate'] == 2
+    np.testing.assert_array_equal(store.matrix()[store.fonts['CopyOfNew_regular']['row']], np.full(4, 2.0))
+    assert store.fonts['CopyOfNew_regular']['duplicate_of'] == 'New_regular'
+
+
+def test_without_dedup_all_misses_are_embedded(fonts_dir, write_font, info, alphabet, texts):
+    store = open_feature_store(fonts_dir, info)
+    paths = [write_font('Alpha', data=b'same font'), write_font('Beta', data=b'same font')]
+    computation = FeatureComputation(store, alphabet, texts, False, feature_mode='meanpool')
+
+    # Fonts that can not be read fail without stopping the others
+    assert list(computation.fonts_to_embed(paths + [fonts_dir + '/Missing/regular.ttf'])) == paths
+    assert computation.statuses == {} and computation.failed() == 1
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import font_harvester
+
+
+class FontServer(BaseHTTPRequestHandler):
+    """Stand-in for the Google Fonts API and its font files, with ETags, range requests and scripted failures."""
+
+    files = {}
+    failures = {}
+    truncations = {}
+    requests = []
+
+    def do_GET(self):
+        FontServer.requests.append((self.path, dict(self.headers)))
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        if self.failures.get(self.path):
+            self.failures[self.path] -= 1
+            self.send_error(503)
+            return
+
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        # A truncated response announces the whole body, sends half of it and closes the connection
+        if self.truncations.get(self.path):
+            self.truncations[self.path] -= 1
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(font_harvester, 'DEFAULT_HARVEST_BACKOFF', 0)
+    FontServer.files, FontServer.failures, FontServer.truncations, FontServer.requests = {}, {}, {}, []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FontServer)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def publish(url, families, last_modified='2024-01-01'):
+    """Serve a font list of families, each with regular and italic files of distinct random content."""
+    items = []
+    for family in families:
+        files = {}
+        for variant in ('regular', 'italic'):
+            path = f'/fonts/{family}-{variant}.ttf'
+            FontServer.files[path] = os.urandom(200_000)
+            files[variant] = url + path
+        items.append({'family': family, 'subsets': ['latin'], 'lastModified': last_modified, 'files': files})
+    FontServer.files['/webfonts.json'] = json.dumps({'items': items}).encode('utf-8')
+    return items
+
+
+def harvest(url, save_path):
+    font_harvester.harvest_fonts(None, str(save_path), ['latin'], ['regular', 'italic'], concurrency=2, retries=2,
+                                 api_url=url + '/webfonts.json')
+
+
+def requests_of(path):
+    return [headers for request_path, headers in FontServer.requests if request_path == path]
+
+
+def assert_harvested(save_path, items):
+    for font in items:
+        font_dir = save_path / font['family']
+        assert json.loads((font_dir / 'info.json').read_text()) == font
+        for variant, url in font['files'].items():
+            assert (font_dir / f'{variant}.ttf').read_bytes() == FontServer.files[url[url.index('/fonts/'):]]
+        assert not [name for name in os.listdir(font_dir) if '.part' in name]
+
+
+def test_harvest_downloads_all_files(server, tmp_path):
+    items = publish(server, ['Alpha', 'Beta'])
+    harvest(server, tmp_path)
+    assert_harvested(tmp_path, items)
+    downloads = json.loads((tmp_path / 'Alpha' / font_harvester.DOWNLOADS_FILE_NAME).read_text())
+    assert set(downloads) == {'regular.ttf', 'italic.ttf'} and all(entry['etag'] for entry in downloads.values())
+
+
+def test_unchanged_files_are_not_downloaded_again(server, tmp_path):
+    items = publish(server, ['Alpha'])
+    harvest(server, tmp_path)
+
+    # A new version of the family in the list with the same files: every file is answered with 304 Not Modified
+    items[0]['lastModified'] = '2024-02-01'
+    FontServer.files['/webfonts.json'] = json.dumps({'items': items}).encode('utf-8')
+    FontServer.requests = []
+    stats = font_harvester.HarvestStats()
+    font_harvester.harvest_font(items[0], str(tmp_path / 'Alpha'), ['regular', 'italic'], stats=stats)
+    assert (stats.downloaded, stats.unchanged) == (0, 2)
+    assert all(headers.get('If-None-Match') for headers in requests_of('/fonts/Alpha-regular.ttf'))
+    assert_harvested(tmp_path, items)
+
+
+def test_failed_requests_are_retried(server, tmp_path):
+    items = publish(server, ['Alpha'])
+    FontServer.failures['/fonts/Alpha-regular.ttf'] = 2
+    harvest(server, tmp_path)
+    assert len(requests_of('/fonts/Alpha-regular.ttf')) == 3
+    assert_harvested(tmp_path, items)
+
+
+def test_interrupted_download_is_resumed(server, tmp_path):
+    items = publish(server, ['Alpha'])
+    FontServer.truncations['/fonts/Alpha-italic.ttf'] = 1
+    harvest(server, tmp_path)
+    first, resumed = requests_of('/fonts/Alpha-italic.ttf')
+    assert 'Range' not in first
+    assert resumed['Range'].startswith('bytes=') and resumed['Range'] != 'bytes=0-' and resumed['If-Range']
+    assert_harvested(tmp_path, items)
+
+
+def test_incomplete_download_keeps_the_previous_file(server, tmp_path):
+    items = publish(server, ['Alpha'])
+    harvest(server, tmp_path)
+    path = str(tmp_path / 'Alpha' / 'regular.ttf')
+    previous = json.loads((tmp_path / 'Alpha' / font_harvester.DOWNLOADS_FILE_NAME).read_text())['regular.ttf']
+    old_body = FontServer.files['/fonts/Alpha-regular.ttf']
+
+    # The file changes and every download of it breaks off: the old file stays in place next to the partial one
+    FontServer.files['/fonts/Alpha-regular.ttf'] = new_body = os.urandom(300_000)
+    FontServer.truncations['/fonts/Alpha-regular.ttf'] = 3
+    with pytest.raises(Exception):
+        font_harvester.download_file(items[0]['files']['regular'], path, previous=previous, retries=1)
+    assert open(path, 'rb').read() == old_body
+    partial_size = os.path.getsize(path + '.part')
+    assert 0 < partial_size < len(new_body)
+
+    # The next attempt continues the partial file and renames it into place
+    metadata, downloaded = font_harvester.download_file(items[0]['files']['regular'], path, previous=previous)
+    assert downloaded and metadata['content_length'] == str(len(new_body))
+    assert open(path, 'rb').read() == new_body
+    assert not os.path.exists(path + '.part') and not os.path.exists(path + '.part.json')
+    assert requests_of('/fonts/Alpha-regular.ttf')[-1]['Range'] == f'bytes={partial_size}-'
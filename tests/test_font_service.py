@@ -0,0 +1,150 @@
+import http.client
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from feature_store import FeatureStore
+from font_service import FontIndex, FontServer, QueryBatcher, service_handler
+
+NUM_FONTS = 40
+
+
+class UnreadableFonts:
+    """Index stand-in that records uploaded fonts and rejects them."""
+
+    def __init__(self):
+        self.uploads = []
+
+    def embed(self, ttf_data):
+        self.uploads.append(ttf_data)
+        raise ValueError('not a font')
+
+
+@pytest.fixture
+def service():
+    index = UnreadableFonts()
+    server = FontServer(('127.0.0.1', 0), service_handler(index, None, 10, max_font_bytes=1000))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1], index
+    server.shutdown()
+    server.server_close()
+
+
+def post(port, content_length, body=b''):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.putrequest('POST', '/similar?k=5')
+    if content_length is not None:
+        connection.putheader('Content-Length', content_length)
+    connection.endheaders(body)
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())
+    connection.close()
+    return result
+
+
+@pytest.mark.parametrize('content_length', [None, '', 'abc', '-5', '1.5'])
+def test_upload_without_valid_length_is_rejected(service, content_length):
+    port, index = service
+    status, body = post(port, content_length)
+    assert status == 400 and 'Content-Length' in body['error']
+    assert index.uploads == []
+
+
+def test_upload_above_maximum_is_rejected_before_reading(service):
+    port, index = service
+    status, body = post(port, '5000000')
+    assert status == 413 and '1000 bytes' in body['error']
+    assert index.uploads == []
+
+
+def test_upload_within_maximum_is_read(service):
+    port, index = service
+    status, body = post(port, '1000', b'x' * 1000)
+    assert status == 422
+    assert index.uploads == [b'x' * 1000]
+
+
+@pytest.fixture
+def font_index_files(fonts_dir, info):
+    """Feature store of random font features and a sorted font list that leaves out the last font. Returns the
+    features by font and the list."""
+    features = np.random.default_rng(0).normal(size=(NUM_FONTS, 12)).astype(np.float32)
+    store = FeatureStore(fonts_dir)
+    store.reset(info)
+    names = [f'Font{i:02d}_regular' for i in range(NUM_FONTS)]
+    for name, vector in zip(names, features):
+        store.put(name, os.path.join(fonts_dir, f'{name}.ttf'), name, vector, 0.5)
+    store.save()
+
+    font_list = list(np.random.default_rng(1).permutation(names[:-1]))
+    with open(os.path.join(fonts_dir, 'ordered_fonts_list.txt'), 'w') as f:
+        f.writelines(f'{name}\n' for name in font_list)
+    return features, font_list
+
+
+def brute_force_nearest(features, query, k, excluded, metric):
+    features, query = features.astype(np.float64), query.astype(np.float64)
+    if metric == 'euclidean':
+        distances = np.sqrt(((features - query) ** 2).sum(axis=1))
+    else:
+        distances = 1 - features @ query / (np.linalg.norm(features, axis=1) * np.linalg.norm(query))
+    order = [int(i) for i in np.argsort(distances) if i != excluded][:k]
+    return order, distances[order]
+
+
+@pytest.mark.parametrize('memory_bytes', [1 << 20, 0])
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_nearest_fonts_match_a_brute_force_search(fonts_dir, font_index_files, metric, memory_bytes):
+    features, _ = font_index_files
+    index = FontIndex(fonts_dir, os.path.join(fonts_dir, 'ordered_fonts_list.txt'), metric, memory_bytes)
+    assert isinstance(index.features, np.memmap) == (memory_bytes == 0)
+
+    queries = np.concatenate([features[[3, 17, 29]], np.random.default_rng(2).normal(size=(3, 12))])
+    ks, excluded = [1, 5, NUM_FONTS + 10, 7, NUM_FONTS, 3], [3, 17, 29, None, None, None]
+    for query, k, font, result in zip(queries, ks, excluded, index.nearest(queries, ks, excluded)):
+        expected, distances = brute_force_nearest(features, query, k, font, metric)
+        assert [i for i, _ in result] == expected
+        np.testing.assert_allclose([distance for _, distance in result], distances, rtol=1e-4, atol=1e-4)
+        assert font not in expected
+
+
+def test_batcher_answers_concurrent_queries_in_batches(fonts_dir, font_index_files):
+    features, _ = font_index_files
+    index = FontIndex(fonts_dir, os.path.join(fonts_dir, 'ordered_fonts_list.txt'))
+    batcher = QueryBatcher(index, max_batch=8, max_wait=1.0)
+
+    futures = [batcher.submit(features[font], 4, font) for font in range(20)]
+    for font, future in enumerate(futures):
+        expected, _ = brute_force_nearest(features, features[font], 4, font, 'euclidean')
+        assert [i for i, _ in future.result(timeout=10)] == expected
+    assert batcher.queries == 20 and batcher.batches == 3
+
+    # A failing batch fails its queries, and the batcher keeps answering
+    with pytest.raises(ValueError):
+        batcher.submit(np.zeros(5, np.float32), 4).result(timeout=10)
+    assert len(batcher.submit(features[0], 4, 0).result(timeout=10)) == 4
+
+
+def test_similar_fonts_report_their_list_positions(fonts_dir, font_index_files):
+    _, font_list = font_index_files
+    index = FontIndex(fonts_dir, os.path.join(fonts_dir, 'ordered_fonts_list.txt'))
+    server = FontServer(('127.0.0.1', 0), service_handler(index, QueryBatcher(index, max_wait=0.001), 100))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+        connection.request('GET', f'/similar?font={font_list[5]}&k={NUM_FONTS}')
+        body = json.loads(connection.getresponse().read())
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert body['font'] == font_list[5] and body['position'] == 5
+    assert len(body['neighbours']) == NUM_FONTS - 1 and font_list[5] not in [n['font'] for n in body['neighbours']]
+    for neighbour in body['neighbours']:
+        assert neighbour['position'] == (font_list.index(neighbour['font']) if neighbour['font'] in font_list
+                                         else None)
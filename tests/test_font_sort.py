@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from font_sort import calculate_distance_matrix, load_sort_state, path_length, save_sort_state, \
+    sort_state_settings, update_sort_state
+
+SETTINGS = sort_state_settings({'feature_mode': 'meanpool'}, 'euclidean')
+
+
+def fonts_on_a_line(positions):
+    """Names, cache keys and features of fonts at positions on a line, whose shortest path visits them in order."""
+    names = sorted(positions)
+    features = np.array([[positions[name], 0.0] for name in names])
+    keys = [f'{name}@{positions[name]}' for name in names]
+    return names, keys, features
+
+
+def saved_sort_state(font_directory, positions):
+    names, keys, features = fonts_on_a_line(positions)
+    distance_matrix = calculate_distance_matrix(features, range(len(names)))
+    path = sorted(range(len(names)), key=lambda i: positions[names[i]])
+    save_sort_state(font_directory, SETTINGS, names, keys, distance_matrix, path)
+    return load_sort_state(font_directory, SETTINGS)
+
+
+def update(font_directory, positions):
+    state = load_sort_state(font_directory, SETTINGS)
+    names, keys, features = fonts_on_a_line(positions)
+    path = update_sort_state(font_directory, state, SETTINGS, features, range(len(names)), names, keys)
+    return names, features, path
+
+
+def assert_sorted_in_order(font_directory, positions, names, features, path):
+    assert sorted(path) == list(range(len(names)))
+    assert [positions[names[i]] for i in path] == sorted(positions.values())
+
+    # The saved slots hold exactly the distances of a full computation
+    state = load_sort_state(font_directory, SETTINGS)
+    slots = [state['font_names'].index(name) for name in names]
+    np.testing.assert_allclose(state['distance_matrix'][np.ix_(slots, slots)],
+                               calculate_distance_matrix(features, range(len(names))))
+    assert [state['font_names'][slot] for slot in state['path']] == [names[i] for i in path]
+
+
+def test_inserted_changed_and_removed_fonts(tmp_path):
+    positions = {f'font{i:02d}': float(i) for i in range(10)}
+    saved_sort_state(str(tmp_path), positions)
+
+    # font03 is deleted, font07 changed and moved, font10 is new and takes the slot of font03
+    del positions['font03']
+    positions['font07'] = 2.5
+    positions['font10'] = 5.5
+    names, features, path = update(str(tmp_path), positions)
+
+    assert_sorted_in_order(str(tmp_path), positions, names, features, path)
+    state = load_sort_state(str(tmp_path), SETTINGS)
+    assert state['font_names'][3] == 'font10' and len(state['font_names']) == 10
+    slots = [state['font_names'].index(name) for name in names]
+    assert path_length([slots[i] for i in path], state['distance_matrix']) == \
+        pytest.approx(max(positions.values()) - min(positions.values()))
+
+
+def test_new_fonts_beyond_the_spare_slots_grow_the_matrix(tmp_path):
+    positions = {f'font{i:02d}': float(i) for i in range(4)}
+    capacity = len(saved_sort_state(str(tmp_path), positions)['distance_matrix'])
+
+    positions.update({f'font{i:02d}': i + 0.5 for i in range(4, 4 + capacity)})
+    names, features, path = update(str(tmp_path), positions)
+
+    assert_sorted_in_order(str(tmp_path), positions, names, features, path)
+    assert len(load_sort_state(str(tmp_path), SETTINGS)['distance_matrix']) > capacity
+
+
+def test_unchanged_fonts_keep_their_path(tmp_path):
+    positions = {f'font{i:02d}': float(i * i) for i in range(8)}
+    state = saved_sort_state(str(tmp_path), positions)
+
+    names, _, path = update(str(tmp_path), positions)
+    assert path == state['path']
+
+
+def test_interrupted_update_computes_the_changed_fonts_again(tmp_path, monkeypatch):
+    import font_sort
+
+    positions = {f'font{i:02d}': float(i) for i in range(6)}
+    saved_sort_state(str(tmp_path), positions)
+
+    # The update is interrupted after the distances of the changed font02 are written, then font02 is reverted
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(font_sort, 'update_font_path', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        update(str(tmp_path), dict(positions, font02=4.5))
+    monkeypatch.undo()
+
+    names, features, path = update(str(tmp_path), positions)
+    assert_sorted_in_order(str(tmp_path), positions, names, features, path)
+
+
+def test_sort_state_of_other_settings_is_ignored(tmp_path):
+    positions = {f'font{i}': float(i) for i in range(4)}
+    names, keys, features = fonts_on_a_line(positions)
+    distance_matrix = calculate_distance_matrix(features, range(len(names)))
+    save_sort_state(str(tmp_path), SETTINGS, names, keys, distance_matrix, [0, 1, 2, 3])
+
+    loaded = load_sort_state(str(tmp_path), SETTINGS)
+    assert loaded['font_names'] == names and loaded['path'] == [0, 1, 2, 3]
+    np.testing.assert_array_equal(loaded['distance_matrix'][:4, :4], distance_matrix)
+    assert load_sort_state(str(tmp_path), sort_state_settings({'feature_mode': 'meanpool'}, 'cosine')) is None
+    assert load_sort_state(str(tmp_path), sort_state_settings({'feature_mode': 'cls'}, 'euclidean')) is None
+    assert load_sort_state(str(tmp_path), sort_state_settings({'feature_mode': 'meanpool'}, 'euclidean',
+                                                              'float32')) is None
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from font_sort import improve_font_path, optimized_font_path, path_length
+from path_search import PathSearch, improve_path, nearest_neighbours, relocate_first_improvement
+
+
+def random_distance_matrix(seed, num_fonts=25, dim=8):
+    features = np.random.default_rng(seed).random((num_fonts, dim))
+    return np.sqrt(((features[:, None] - features[None]) ** 2).sum(axis=-1))
+
+
+def relocation_search(ordered_indices, distance_matrix):
+    """improve_font_path before the local search engine, the reference the improved path is compared to."""
+    def calculate_path_length(path):
+        return sum(distance_matrix[path[i], path[i + 1]] for i in range(len(path) - 1))
+
+    best_path = ordered_indices[:]
+    best_length = calculate_path_length(best_path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(best_path)):
+            for j in range(len(best_path)):
+                if i == j:
+                    continue
+                new_path = best_path[:i] + best_path[i + 1:]
+                new_path.insert(j, best_path[i])
+                new_length = calculate_path_length(new_path)
+                if new_length < best_length:
+                    best_path = new_path
+                    best_length = new_length
+                    improved = True
+                    break
+    return best_path
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_search_returns_a_shorter_permutation(seed):
+    distance_matrix = random_distance_matrix(seed)
+    start = list(np.random.default_rng(seed).permutation(len(distance_matrix)))
+    search = PathSearch(start, distance_matrix.item, nearest_neighbours(distance_matrix, 8))
+    search.run(distance_matrix=distance_matrix)
+
+    assert sorted(search.path) == list(range(len(distance_matrix)))
+    assert search.length == pytest.approx(path_length(search.path, distance_matrix))
+    assert search.length <= path_length(start, distance_matrix)
+
+
+def test_search_of_active_fonts_keeps_the_path_valid():
+    distance_matrix = random_distance_matrix(0, num_fonts=40)
+    start = optimized_font_path(distance_matrix)
+    path, history = improve_path(start, distance_matrix.item, nearest_neighbours(distance_matrix, 5), active=start[:5])
+    assert sorted(path) == list(range(40))
+    assert history[-1][1] == pytest.approx(path_length(path, distance_matrix)) and history[-1][1] <= history[0][1]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_vectorized_relocation_matches_the_reference(seed):
+    distance_matrix = random_distance_matrix(seed)
+    start = optimized_font_path(distance_matrix)
+    assert relocate_first_improvement(start, distance_matrix) == relocation_search(start, distance_matrix)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_improved_path_is_never_longer_than_the_reference(seed):
+    distance_matrix = random_distance_matrix(seed)
+    start = optimized_font_path(distance_matrix)
+    path = improve_font_path(start, distance_matrix)
+    assert sorted(path) == list(range(len(distance_matrix)))
+    assert path_length(path, distance_matrix) <= path_length(relocation_search(start, distance_matrix),
+                                                             distance_matrix) + 1e-9
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_search_of_float32_distances_ends_in_a_local_optimum(seed):
+    distance_matrix = (random_distance_matrix(seed) * 10000).astype(np.float32)
+    start = optimized_font_path(distance_matrix)
+    search = PathSearch(start, distance_matrix.item, nearest_neighbours(distance_matrix, 8))
+    history = search.run(time_budget=5, distance_matrix=distance_matrix)
+
+    # Rounding of float32 distances must not make moves that leave the path unchanged look shorter
+    assert history[-1][0] < 5
+    assert search.length == pytest.approx(path_length(search.path, distance_matrix))